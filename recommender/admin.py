@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import Restaurant, Rating, RestaurantLink
+from .models import Restaurant, Rating, RestaurantLink, UserRecommendation
 
 @admin.register(Restaurant)
 class RestaurantAdmin(admin.ModelAdmin):
-    list_display = ('rest_id', 'name', 'avg_rating', 'review_count', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating')
+    list_display = ('rest_id', 'name', 'avg_rating', 'review_count', 'popularity_score', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating')
     search_fields = ('name',)
     list_filter = ('avg_rating',)
 
@@ -17,3 +17,9 @@ class RatingAdmin(admin.ModelAdmin):
 class RestaurantLinkAdmin(admin.ModelAdmin):
     list_display = ('source', 'target', 'weight')
     search_fields = ('source__name', 'target__name')
+
+@admin.register(UserRecommendation)
+class UserRecommendationAdmin(admin.ModelAdmin):
+    list_display = ('user_id', 'rank', 'restaurant', 'score', 'version', 'created_at')
+    search_fields = ('user_id',)
+    list_filter = ('version',)
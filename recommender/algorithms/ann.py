@@ -0,0 +1,204 @@
+import numpy as np
+from ..artifacts import ArtifactHandle, IdMap, artifact_store
+from ..models import Restaurant
+from .similarity import gather_rows
+
+# 与 RecommenderService.get_similar_restaurants_fast 一致的特征顺序
+FEATURE_FIELDS = ('avg_rating', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating')
+
+# 哈希桶坐标合并为一个整数键时使用的乘数（大素数，溢出回绕不影响正确性）
+_KEY_MULTIPLIERS = np.array([73856093, 19349663, 83492791, 2654435761, 805459861], dtype=np.int64)
+# 表编号的乘数，与所有坐标乘数都不同，不同表的桶键不会系统性地重合
+_TABLE_MULTIPLIER = 3674653429
+
+
+def key_multipliers(n_projections):
+    """n_projections 个互不相同的坐标乘数
+
+    不超过5个时使用固定的素数（与已发布的索引兼容），更多时用固定种子补充奇数乘数，
+    同样的投影数总是得到同样的乘数。
+    """
+    if n_projections <= len(_KEY_MULTIPLIERS):
+        return _KEY_MULTIPLIERS[:n_projections]
+    rng = np.random.default_rng(n_projections)
+    multipliers = list(_KEY_MULTIPLIERS)
+    while len(multipliers) < n_projections:
+        candidate = int(rng.integers(1 << 31, 1 << 40)) | 1
+        if candidate not in multipliers and candidate != _TABLE_MULTIPLIER:
+            multipliers.append(candidate)
+    return np.array(multipliers, dtype=np.int64)
+
+
+class L1LSHIndex:
+    """基于 p-stable 局部敏感哈希的近似最近邻索引（L1距离）
+
+    每张哈希表用 n_projections 个柯西分布随机投影把特征向量映射到整数桶坐标，
+    L1距离相近的向量落入同一个桶的概率更高。查询时取所有表中同桶的餐厅作为
+    候选，再按精确的L1距离重排；候选不足时退回全量精确计算。
+    所有表的桶键（已混入表编号）合并为一个有序数组，一次 searchsorted 即可完成查找。
+
+    索引是构建时餐厅平均分的快照，评分变化后不会自动更新，需要重新运行
+    build_ann_index（导入数据时会自动重建）；查询结果总是按精确的L1距离重排，
+    快照过旧只影响候选集，不会返回不存在的餐厅。
+    """
+
+    arrays = ('restaurant_ids', 'features', 'avg_ratings', 'projections', 'offsets', 'bucket_keys', 'bucket_members')
+
+    def __init__(self, restaurant_ids, features, avg_ratings, projections, offsets,
+                 bucket_width, bucket_keys, bucket_members, restaurant_order=None):
+        self.restaurant_ids = np.asarray(restaurant_ids, dtype=np.int64)
+        self.features = np.asarray(features, dtype=np.float64)
+        self.avg_ratings = np.asarray(avg_ratings, dtype=np.float64)
+        self.projections = np.asarray(projections, dtype=np.float64)  # (表数, 维数, 投影数)
+        self.offsets = np.asarray(offsets, dtype=np.float64)          # (表数, 投影数)
+        self.bucket_width = float(bucket_width)
+        self.bucket_keys = np.asarray(bucket_keys, dtype=np.int64)        # 有序桶键
+        self.bucket_members = np.asarray(bucket_members, dtype=np.int64)  # 对应的餐厅下标
+        self.restaurant_index = IdMap(self.restaurant_ids, restaurant_order)
+
+    @classmethod
+    def build(cls, restaurant_ids, features, avg_ratings, n_tables=24, n_projections=5,
+              bucket_width=2.0, seed=42):
+        """构建索引"""
+        if n_tables < 1 or n_projections < 1:
+            raise ValueError('哈希表数量和投影数都必须至少为1')
+        if bucket_width <= 0:
+            raise ValueError('哈希桶宽度必须为正数')
+        features = np.asarray(features, dtype=np.float64)
+        rng = np.random.default_rng(seed)
+        projections = rng.standard_cauchy(size=(n_tables, features.shape[1], n_projections))
+        offsets = rng.uniform(0, bucket_width, size=(n_tables, n_projections))
+        keys = cls._hash(features, projections, offsets, bucket_width).ravel()
+        order = np.argsort(keys, kind='stable')
+        return cls(
+            restaurant_ids, features, avg_ratings, projections, offsets, bucket_width,
+            keys[order], order % len(features) if len(features) else order
+        )
+
+    @staticmethod
+    def _hash(features, projections, offsets, bucket_width):
+        """计算每张表中每个向量的桶键，返回 (表数, 向量数)"""
+        buckets = np.floor(
+            (np.einsum('nd,tdp->tnp', features, projections) + offsets[:, None, :]) / bucket_width
+        ).astype(np.int64)
+        n_tables, _, n_projections = buckets.shape
+        tables = np.arange(n_tables, dtype=np.int64)[:, None] * _TABLE_MULTIPLIER
+        return buckets @ key_multipliers(n_projections) + tables
+
+    def __len__(self):
+        return len(self.restaurant_ids)
+
+    def candidates(self, vector):
+        """返回与查询向量同桶的餐厅下标"""
+        keys = self._hash(np.asarray(vector, dtype=np.float64)[None], self.projections,
+                          self.offsets, self.bucket_width)[:, 0]
+        lo = np.searchsorted(self.bucket_keys, keys, side='left')
+        hi = np.searchsorted(self.bucket_keys, keys, side='right')
+        positions, _ = gather_rows(np.stack([lo, hi], axis=1).ravel(), np.arange(0, 2 * len(keys), 2))
+        # 去重：同一家餐厅可能出现在多张表的桶中
+        seen = np.zeros(len(self), dtype=bool)
+        seen[self.bucket_members[positions]] = True
+        return np.flatnonzero(seen)
+
+    def _rank(self, vector, positions, k, exclude_id):
+        """按L1距离升序、平均分降序、rest_id升序排出前k个"""
+        if exclude_id is not None and exclude_id in self.restaurant_index:
+            positions = positions[positions != self.restaurant_index[exclude_id]]
+        distances = np.abs(self.features[positions] - vector).sum(axis=1)
+        if len(positions) > k > 0:
+            # 先取出距离不超过第k小距离的餐厅（保留并列），再精确排序
+            kth = np.partition(distances, k - 1)[k - 1]
+            keep = distances <= kth
+            positions, distances = positions[keep], distances[keep]
+        order = np.lexsort((
+            self.restaurant_ids[positions], -self.avg_ratings[positions], distances
+        ))[:k]
+        return self.restaurant_ids[positions[order]], distances[order]
+
+    def query(self, vector, k=4, exclude_id=None):
+        """近似查询最近的k家餐厅，返回(rest_id数组, L1距离数组)"""
+        vector = np.asarray(vector, dtype=np.float64)
+        positions = self.candidates(vector)
+        # 排除自身后候选不足k个时退回精确查询
+        if len(positions) <= k:
+            return self.exact(vector, k, exclude_id)
+        return self._rank(vector, positions, k, exclude_id)
+
+    def exact(self, vector, k=4, exclude_id=None):
+        """暴力精确查询"""
+        return self._rank(np.asarray(vector, dtype=np.float64), np.arange(len(self)), k, exclude_id)
+
+    def to_arrays(self):
+        """发布为产物时的 (数组, 元数据)"""
+        arrays = {name: getattr(self, name) for name in self.arrays}
+        arrays['restaurant_order'] = self.restaurant_index.order
+        return arrays, {'bucket_width': self.bucket_width}
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        return cls(
+            artifact['restaurant_ids'], artifact['features'], artifact['avg_ratings'],
+            artifact['projections'], artifact['offsets'], artifact.meta['bucket_width'],
+            artifact['bucket_keys'], artifact['bucket_members'], artifact['restaurant_order']
+        )
+
+
+def recall_at_k(index, queries, k=4):
+    """用暴力查询的结果评估近似查询的 recall@k
+
+    queries 为餐厅下标数组，每家餐厅以自身特征向量查询（排除自身）。
+    距离与第k个精确结果相同的餐厅都算作命中，避免并列时的误判。
+    """
+    hits = total = 0
+    for position in queries:
+        rest_id = int(index.restaurant_ids[position])
+        vector = index.features[position]
+        exact_ids, exact_distances = index.exact(vector, k, exclude_id=rest_id)
+        approx_ids, approx_distances = index.query(vector, k, exclude_id=rest_id)
+        if not len(exact_ids):
+            continue
+        hits += int(np.sum(approx_distances <= exact_distances[-1] + 1e-12))
+        total += len(exact_ids)
+    return hits / total if total else 1.0
+
+
+def similar_restaurant_queryset():
+    """参与相似餐厅查询的餐厅：评价数足够且名称有效"""
+    return Restaurant.objects.filter(review_count__gte=10).exclude(name__iexact='nan')
+
+
+def build_ann_index(queryset=None, **params):
+    """从数据库读取餐厅评分特征并构建索引，params 透传给 L1LSHIndex.build"""
+    if queryset is None:
+        queryset = similar_restaurant_queryset()
+    rows = np.array(
+        list(queryset.order_by('rest_id').values_list('rest_id', *FEATURE_FIELDS)),
+        dtype=np.float64
+    ).reshape(-1, len(FEATURE_FIELDS) + 1)
+    features = np.nan_to_num(rows[:, 1:])
+    return L1LSHIndex.build(rows[:, 0].astype(np.int64), features, features[:, 0], **params)
+
+
+ANN_ARTIFACT = 'ann'
+
+
+_ann_index = ArtifactHandle(ANN_ARTIFACT, L1LSHIndex.from_artifact, build=lambda: build_ann_index().to_arrays())
+
+
+def get_ann_index():
+    """获取进程内共享的近似最近邻索引（文件映射）
+
+    还没有发布过时在本进程内从数据库构建（不发布）；build_ann_index 命令发布新版本后自动切换。
+    """
+    return _ann_index.get()
+
+
+def publish_ann_index(keep=3, **params):
+    """从数据库重新构建索引并发布为新版本，返回(索引, 版本号)；params 透传给 L1LSHIndex.build"""
+    index = build_ann_index(**params)
+    return index, artifact_store.publish(ANN_ARTIFACT, *index.to_arrays(), keep=keep)
+
+
+def reset_ann_index():
+    """丢弃已加载的索引，下次访问时重新加载"""
+    _ann_index.reset()
@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import numpy as np
-from django.db.models import Avg, Count, F, ExpressionWrapper, FloatField, Q
-from django.db.models.functions import Ln
-from django.db import models
+from django.db import close_old_connections
 from ..models import Restaurant, Rating
+from .matrix import INVALID_NAMES, RestaurantFeatureMatrix, get_feature_matrix, get_rating_matrix
+from .factorization import get_mf_model
 
 class BaseRecommender(ABC):
     """推荐算法基类"""
@@ -30,34 +33,21 @@ class BaseRecommender(ABC):
 
     def filter_valid_restaurants(self, queryset):
         """过滤有效的餐厅"""
-        return queryset.exclude(
-            Q(name__isnull=True) | 
-            Q(name__exact='') | 
-            Q(name__iexact='nan') |
-            Q(name__iexact='null')
-        ).filter(
+        return self.exclude_invalid_names(queryset).filter(
             review_count__gt=0
         )
 
+    def exclude_invalid_names(self, queryset):
+        """排除名称缺失的餐厅"""
+        return queryset.exclude(INVALID_NAMES)
+
 class PopularityRecommender(BaseRecommender):
     """基于流行度的推荐"""
     
     def recommend(self, user_id=None, restaurant_id=None, n_recommendations=5):
-        # 计算综合得分：评分 * ln(1 + 评论数)
-        restaurants = Restaurant.objects.annotate(
-            log_reviews=ExpressionWrapper(
-                Ln(1.0 + F('review_count')),
-                output_field=FloatField()
-            )
-        ).annotate(
-            popularity_score=ExpressionWrapper(
-                F('avg_rating') * F('log_reviews'),
-                output_field=FloatField()
-            )
-        )
-        
-        # 先过滤有效餐厅，再排序和切片
-        restaurants = self.filter_valid_restaurants(restaurants)
+        # 热度得分（贝叶斯平均）随评分累计字段维护。有评论的餐厅得分都大于0，
+        # 用得分的范围条件代替 review_count>0，查询沿 popularity_score 索引倒序扫描取前N
+        restaurants = self.exclude_invalid_names(Restaurant.objects.filter(popularity_score__gt=0))
         return restaurants.order_by('-popularity_score')[:n_recommendations]
 
 class ContentBasedRecommender(BaseRecommender):
@@ -72,59 +62,25 @@ class ContentBasedRecommender(BaseRecommender):
         except Restaurant.DoesNotExist:
             return Restaurant.objects.none()
             
-        # 获取用户对该餐厅的评分
-        ratings = Rating.objects.filter(restaurant_id=restaurant_id)
-        if not ratings.exists():
+        # 没有评分的餐厅没有特征向量
+        if not target_restaurant.review_count:
             return Restaurant.objects.none()
             
-        # 计算平均评分特征向量
-        avg_ratings = ratings.aggregate(
-            avg_rating=Avg('rating'),
-            avg_env=Avg('rating_env'),
-            avg_flavor=Avg('rating_flavor'),
-            avg_service=Avg('rating_service')
-        )
-        
-        # 构建特征向量
-        target_vector = np.array([
-            avg_ratings['avg_rating'] or 0,
-            avg_ratings['avg_env'] or 0,
-            avg_ratings['avg_flavor'] or 0,
-            avg_ratings['avg_service'] or 0
-        ])
+        # 目标餐厅的平均评分特征向量
+        target_vector = RestaurantFeatureMatrix.vector_of(target_restaurant)
         
-        # 获取有效的餐厅列表
-        valid_restaurants = self.filter_valid_restaurants(
-            Restaurant.objects.exclude(rest_id=restaurant_id)
+        # 在所有有效餐厅的特征矩阵上一次性计算余弦相似度
+        matrix = get_feature_matrix()
+        similar_ids, _ = matrix.most_similar(
+            target_vector,
+            n=n_recommendations,
+            exclude_id=restaurant_id
         )
+        similar_ids = similar_ids.tolist()
         
-        # 计算相似度
-        similar_restaurants = []
-        for restaurant in valid_restaurants:
-            r_ratings = Rating.objects.filter(restaurant_id=restaurant.rest_id)
-            if not r_ratings.exists():
-                continue
-                
-            r_avg_ratings = r_ratings.aggregate(
-                avg_rating=Avg('rating'),
-                avg_env=Avg('rating_env'),
-                avg_flavor=Avg('rating_flavor'),
-                avg_service=Avg('rating_service')
-            )
-            
-            r_vector = np.array([
-                r_avg_ratings['avg_rating'] or 0,
-                r_avg_ratings['avg_env'] or 0,
-                r_avg_ratings['avg_flavor'] or 0,
-                r_avg_ratings['avg_service'] or 0
-            ])
-            
-            similarity = self.calculate_similarity(target_vector, r_vector)
-            similar_restaurants.append((restaurant, similarity))
-        
-        # 排序并返回最相似的餐厅
-        similar_restaurants.sort(key=lambda x: x[1], reverse=True)
-        return [r[0] for r in similar_restaurants[:n_recommendations]]
+        # 按相似度顺序返回最相似的餐厅
+        restaurant_dict = Restaurant.objects.in_bulk(similar_ids)
+        return [restaurant_dict[r_id] for r_id in similar_ids if r_id in restaurant_dict]
 
 class CollaborativeRecommender(BaseRecommender):
     """基于协同过滤的推荐"""
@@ -133,129 +89,170 @@ class CollaborativeRecommender(BaseRecommender):
         if not user_id:
             return Restaurant.objects.none()
             
-        # 获取用户的评分记录
-        user_ratings = Rating.objects.filter(user_id=user_id)
-        if not user_ratings.exists():
+        # 获取进程内共享的用户-餐厅稀疏评分矩阵
+        matrix = get_rating_matrix()
+        user_idx = matrix.user_index.get(user_id)
+        if user_idx is None:
             return Restaurant.objects.none()
             
-        # 构建用户-餐厅评分矩阵
-        user_restaurant_matrix = {}
-        all_ratings = Rating.objects.all()
-        for rating in all_ratings:
-            if rating.user_id not in user_restaurant_matrix:
-                user_restaurant_matrix[rating.user_id] = {}
-            user_restaurant_matrix[rating.user_id][rating.restaurant_id] = rating.rating
-            
-        # 找到相似用户
-        similar_users = []
-        target_user_ratings = user_restaurant_matrix[user_id]
-        
-        for other_user, other_ratings in user_restaurant_matrix.items():
-            if other_user == user_id:
-                continue
-                
-            # 获取共同评分的餐厅
-            common_restaurants = set(target_user_ratings.keys()) & set(other_ratings.keys())
-            if not common_restaurants:
-                continue
-                
-            # 构建评分向量
-            vector1 = np.array([target_user_ratings[r] for r in common_restaurants])
-            vector2 = np.array([other_ratings[r] for r in common_restaurants])
-            
-            similarity = self.calculate_similarity(vector1, vector2)
-            similar_users.append((other_user, similarity))
-            
-        # 排序找出最相似的用户
-        similar_users.sort(key=lambda x: x[1], reverse=True)
-        similar_users = similar_users[:10]  # 取前10个相似用户
-        
-        # 基于相似用户的评分推荐餐厅
-        restaurant_scores = {}
-        for similar_user, similarity in similar_users:
-            user_ratings = user_restaurant_matrix[similar_user]
-            for restaurant_id, rating in user_ratings.items():
-                if restaurant_id not in target_user_ratings:  # 只推荐用户没有评分过的餐厅
-                    if restaurant_id not in restaurant_scores:
-                        restaurant_scores[restaurant_id] = []
-                    restaurant_scores[restaurant_id].append(rating * similarity)
-                    
-        # 计算加权平均评分
-        restaurant_avg_scores = {
-            r_id: np.mean(scores) 
-            for r_id, scores in restaurant_scores.items()
-        }
+        # 找到相似用户（取前10个）
+        similar_users, similarities = matrix.similar_users(user_idx, n_users=10)
         
-        # 排序并返回推荐结果
-        recommended_restaurants = sorted(
-            restaurant_avg_scores.items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )[:n_recommendations]
+        # 基于相似用户的评分推荐餐厅，只推荐用户没有评分过的餐厅
+        restaurant_idx, scores = matrix.score_unrated(user_idx, similar_users, similarities)
+        recommended_ids = matrix.restaurant_ids[restaurant_idx[:n_recommendations]].tolist()
         
         # 获取并过滤有效餐厅
         valid_restaurants = self.filter_valid_restaurants(
-            Restaurant.objects.filter(rest_id__in=[r[0] for r in recommended_restaurants])
+            Restaurant.objects.filter(rest_id__in=recommended_ids)
         )
         
         # 保持原有排序
         restaurant_dict = {r.rest_id: r for r in valid_restaurants}
-        return [restaurant_dict[r[0]] for r in recommended_restaurants if r[0] in restaurant_dict]
+        return [restaurant_dict[r_id] for r_id in recommended_ids if r_id in restaurant_dict]
 
-class HybridRecommender(BaseRecommender):
-    """混合推荐算法"""
+class MatrixFactorizationRecommender(BaseRecommender):
+    """基于矩阵分解的推荐
+
+    用户和餐厅的隐因子由 train_mf 命令离线训练，推荐时只需一次向量-矩阵乘法。
+    """
     
+    def recommend(self, user_id=None, restaurant_id=None, n_recommendations=5):
+        if not user_id:
+            return Restaurant.objects.none()
+            
+        model = get_mf_model()
+        if model is None:
+            return Restaurant.objects.none()
+            
+        scores = model.score_user(user_id)
+        if scores is None:
+            return Restaurant.objects.none()
+            
+        # 排除用户评分过的餐厅和当前餐厅
+        exclude_ids = set(self.get_user_ratings(user_id).values_list('restaurant_id', flat=True))
+        if restaurant_id:
+            exclude_ids.add(restaurant_id)
+            
+        # 多取一些候选，过滤无效餐厅后仍能凑够数量
+        candidate_ids, _ = model.top_n(scores, n_recommendations * 3, exclude_ids=exclude_ids)
+        candidate_ids = candidate_ids.tolist()
+        valid_restaurants = self.filter_valid_restaurants(
+            Restaurant.objects.filter(rest_id__in=candidate_ids)
+        )
+        
+        # 保持预测评分的排序
+        restaurant_dict = {r.rest_id: r for r in valid_restaurants}
+        return [restaurant_dict[r_id] for r_id in candidate_ids if r_id in restaurant_dict][:n_recommendations]
+
+class HybridRecommender(BaseRecommender):
+    """混合推荐算法
+
+    三个子推荐器在线程池中并发执行（各自的数据库查询和矩阵运算互不依赖），
+    结果在合并后的候选集上用 NumPy 一次性加权求和，按得分顺序返回餐厅列表。
+    每个阶段的耗时记录在 last_timings 中（秒）。
+    """
+
+    weights = {
+        'popularity': 0.3,
+        'content': 0.3,
+        'collaborative': 0.4
+    }
+
     def __init__(self):
         self.popularity_rec = PopularityRecommender()
         self.content_rec = ContentBasedRecommender()
         self.collab_rec = CollaborativeRecommender()
-        
+        self.last_timings = {}
+
     def recommend(self, user_id=None, restaurant_id=None, n_recommendations=5):
-        recommendations = []
-        weights = {
-            'popularity': 0.3,
-            'content': 0.3,
-            'collaborative': 0.4
-        }
-        
-        # 获取各种推荐结果
-        popularity_recs = self.popularity_rec.recommend(
-            n_recommendations=n_recommendations
-        )
-        content_recs = self.content_rec.recommend(
-            restaurant_id=restaurant_id,
-            n_recommendations=n_recommendations
-        ) if restaurant_id else []
-        collab_recs = self.collab_rec.recommend(
+        restaurants, self.last_timings = self.recommend_with_timings(
             user_id=user_id,
+            restaurant_id=restaurant_id,
             n_recommendations=n_recommendations
-        ) if user_id else []
-        
-        # 合并推荐结果
-        restaurant_scores = {}
-        
-        # 添加基于流行度的推荐
-        for i, rest in enumerate(popularity_recs):
-            score = weights['popularity'] * (1.0 - i/len(popularity_recs))
-            restaurant_scores[rest.rest_id] = restaurant_scores.get(rest.rest_id, 0) + score
-            
-        # 添加基于内容的推荐
-        for i, rest in enumerate(content_recs):
-            score = weights['content'] * (1.0 - i/len(content_recs))
-            restaurant_scores[rest.rest_id] = restaurant_scores.get(rest.rest_id, 0) + score
-            
-        # 添加协同过滤推荐
-        for i, rest in enumerate(collab_recs):
-            score = weights['collaborative'] * (1.0 - i/len(collab_recs))
-            restaurant_scores[rest.rest_id] = restaurant_scores.get(rest.rest_id, 0) + score
-            
-        # 排序并返回最终推荐结果
-        recommended_restaurants = sorted(
-            restaurant_scores.items(), 
-            key=lambda x: x[1], 
-            reverse=True
-        )[:n_recommendations]
-        
-        return Restaurant.objects.filter(
-            rest_id__in=[r[0] for r in recommended_restaurants]
-        ) 
\ No newline at end of file
+        )
+        return restaurants
+
+    def recommend_with_timings(self, user_id=None, restaurant_id=None, n_recommendations=5):
+        """返回(按得分排序的餐厅列表, 各阶段耗时)，餐厅上附带 hybrid_score"""
+        start = time.perf_counter()
+        sources = {'popularity': (self.popularity_rec, {})}
+        if restaurant_id:
+            sources['content'] = (self.content_rec, {'restaurant_id': restaurant_id})
+        if user_id:
+            sources['collaborative'] = (self.collab_rec, {'user_id': user_id})
+
+        executor = _get_executor()
+        futures = {
+            name: executor.submit(_timed_recommend, recommender, n_recommendations=n_recommendations, **kwargs)
+            for name, (recommender, kwargs) in sources.items()
+        }
+        results = {}
+        timings = {}
+        for name, future in futures.items():
+            results[name], timings[name] = future.result()
+
+        fuse_start = time.perf_counter()
+        restaurants = self.fuse(results, n_recommendations)
+        timings['fusion'] = time.perf_counter() - fuse_start
+        timings['total'] = time.perf_counter() - start
+        return restaurants, timings
+
+    def fuse(self, results, n_recommendations):
+        """在共享候选集上加权合并各来源的排名
+
+        第i名（共len名）得分为 权重 * (1 - i/len)，同一餐厅的得分相加；
+        得分相同时按首次出现的顺序（流行度、内容、协同）排列。
+        """
+        ids = []
+        scores = []
+        instances = {}
+        for name, recs in results.items():
+            if not recs:
+                continue
+            ids.extend(r.rest_id for r in recs)
+            scores.append(self.weights[name] * (1.0 - np.arange(len(recs)) / len(recs)))
+            for r in recs:
+                instances.setdefault(r.rest_id, r)
+        if not ids:
+            return []
+
+        candidate_ids, first_seen, inverse = np.unique(
+            np.array(ids, dtype=np.int64), return_index=True, return_inverse=True
+        )
+        totals = np.zeros(len(candidate_ids))
+        # np.add.at 按顺序累加，与逐条相加的浮点结果一致
+        np.add.at(totals, inverse, np.concatenate(scores))
+        order = np.lexsort((first_seen, -totals))[:n_recommendations]
+
+        restaurants = []
+        for idx in order.tolist():
+            restaurant = instances[int(candidate_ids[idx])]
+            restaurant.hybrid_score = float(totals[idx])
+            restaurants.append(restaurant)
+        return restaurants
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """进程内共享的线程池，供混合推荐并发执行子推荐器"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='hybrid-recommender')
+    return _executor
+
+
+def _timed_recommend(recommender, **kwargs):
+    """在工作线程中执行子推荐器，返回(餐厅列表, 耗时)"""
+    start = time.perf_counter()
+    try:
+        # 在线程内求值查询集，查询也在工作线程中完成
+        return list(recommender.recommend(**kwargs)), time.perf_counter() - start
+    finally:
+        # 工作线程有自己的数据库连接，按 CONN_MAX_AGE 及时关闭
+        close_old_connections()
@@ -0,0 +1,98 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+from .similarity import gather_rows
+
+_worker_state = {}
+
+
+def iter_chunks(iterable, size):
+    """把可迭代对象按固定大小切分为列表，不会一次性读入全部元素"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def align_rated_items(model, matrix):
+    """把评分矩阵对齐到模型的用户行和餐厅列
+
+    返回 CSR 形式的 (indptr, indices)：模型中每个用户评分过、且在模型中存在的餐厅列号。
+    """
+    user_rows = np.array([matrix.user_index.get(u, -1) for u in model.user_ids.tolist()], dtype=np.int64)
+    restaurant_columns = model.restaurant_index.lookup(matrix.restaurant_ids)
+
+    known = np.flatnonzero(user_rows >= 0)
+    positions, lengths = gather_rows(matrix.indptr, user_rows[known])
+    owners = np.repeat(known, lengths)
+    columns = restaurant_columns[matrix.indices[positions]]
+    keep = columns >= 0
+    owners, columns = owners[keep], columns[keep]
+
+    indptr = np.zeros(len(model.user_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owners, minlength=len(model.user_ids)), out=indptr[1:])
+    return indptr, columns  # owners 已按用户行有序，columns 即为 CSR 的列号
+
+
+def init_worker(user_factors, item_factors, rated_indptr, rated_indices, candidate_mask):
+    """进程池初始化：保存模型因子和已评分餐厅的只读副本"""
+    _worker_state.update(
+        user_factors=user_factors, item_factors=np.asarray(item_factors, dtype=np.float64),
+        rated_indptr=rated_indptr, rated_indices=rated_indices,
+        candidate_mask=candidate_mask
+    )
+
+
+def top_n_for_users(user_rows, n=10):
+    """为一批用户同时计算推荐
+
+    一次矩阵乘法得到 (用户数, 餐厅数) 的预测评分，把已评分餐厅和无效餐厅置为 -inf，
+    再逐行选出得分最高的n个。返回 (餐厅列号, 得分) 两个 (用户数, n) 数组，
+    可推荐餐厅不足n个时多余位置的得分为 -inf。
+    """
+    state = _worker_state
+    user_rows = np.asarray(user_rows, dtype=np.int64)
+    scores = state['user_factors'][user_rows].astype(np.float64) @ state['item_factors'].T
+    scores[:, ~state['candidate_mask']] = -np.inf
+
+    positions, lengths = gather_rows(state['rated_indptr'], user_rows)
+    scores[np.repeat(np.arange(len(user_rows)), lengths), state['rated_indices'][positions]] = -np.inf
+
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        empty = np.empty((len(user_rows), 0))
+        return empty.astype(np.int64), empty
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    # 每行按得分降序、列号升序排序
+    order = np.lexsort((top, -top_scores), axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def map_ordered(func, tasks, workers=1, initializer=None, initargs=(), max_pending=None):
+    """按输入顺序依次产出 (tag, func(arg))，tasks 为 (tag, arg) 的可迭代对象
+
+    workers 大于1时使用进程池，同时在途的任务数不超过 max_pending（默认为进程数的2倍），
+    避免一次性提交全部输入导致结果堆积在内存中。
+    """
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        for tag, arg in tasks:
+            yield tag, func(arg)
+        return
+
+    max_pending = max_pending or workers * 2
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        for tag, arg in tasks:
+            pending.append((tag, executor.submit(func, arg)))
+            if len(pending) >= max_pending:
+                tag, future = pending.popleft()
+                yield tag, future.result()
+        while pending:
+            tag, future = pending.popleft()
+            yield tag, future.result()
@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ..artifacts import ArtifactHandle, IdMap
+
+# 每个求解块内参与外积累加的评分条数上限，控制 (条数, k, k) 临时数组的大小
+MAX_BLOCK_ENTRIES = 4096
+
+
+def _plan_blocks(indptr, max_entries=MAX_BLOCK_ENTRIES):
+    """把行划分为连续区间，使每个区间内的评分条数不超过上限（单行超出时自成一块）"""
+    n_rows = len(indptr) - 1
+    blocks = []
+    start = 0
+    while start < n_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + max_entries, side='right')) - 1
+        end = max(end, start + 1)
+        blocks.append((start, min(end, n_rows)))
+        start = min(end, n_rows)
+    return blocks
+
+
+def _solve_block(indptr, indices, data, fixed, reg, block):
+    """对一组连续的行求解带正则的最小二乘
+
+    每行 x 满足 (Σ v vᵀ + reg·n·I) x = Σ r·v，v 为该行评分对应的另一侧因子。
+    """
+    start, end = block
+    lo, hi = indptr[start], indptr[end]
+    k = fixed.shape[1]
+    counts = np.diff(indptr[start:end + 1])
+    result = np.zeros((end - start, k))
+    if hi == lo:
+        return result
+
+    factors = fixed[indices[lo:hi]]
+    ratings = data[lo:hi].astype(np.float64)
+    nonempty = counts > 0
+    if end - start == 1:
+        gram = (factors.T @ factors)[None]
+        rhs = (factors.T @ ratings)[None]
+    else:
+        segments = (indptr[start:end] - lo)[nonempty]
+        gram = np.add.reduceat(factors[:, :, None] * factors[:, None, :], segments, axis=0)
+        rhs = np.add.reduceat(factors * ratings[:, None], segments, axis=0)
+    gram += reg * counts[nonempty][:, None, None] * np.eye(k)
+    result[nonempty] = np.linalg.solve(gram, rhs[..., None])[..., 0]
+    return result
+
+
+def _solve_side(executor, indptr, indices, data, fixed, reg, blocks):
+    """并行求解一侧（用户或餐厅）的全部因子"""
+    parts = executor.map(
+        lambda block: _solve_block(indptr, indices, data, fixed, reg, block),
+        blocks
+    )
+    return np.vstack(list(parts))
+
+
+def train_als(matrix, n_factors=32, reg=0.1, iterations=10, n_threads=1, seed=42, callback=None):
+    """用交替最小二乘（ALS）在显式评分上训练矩阵分解
+
+    matrix 为 RatingMatrix；每轮先固定餐厅因子求解用户因子，再反过来求解。
+    批量的 np.linalg.solve 会释放GIL，因此各块可以在线程池中并行计算。
+    callback(iteration, rmse) 在每轮结束后调用。返回 (用户因子, 餐厅因子)。
+    """
+    rng = np.random.default_rng(seed)
+    user_factors = np.zeros((matrix.n_users, n_factors))
+    item_factors = rng.normal(scale=0.1, size=(matrix.n_restaurants, n_factors))
+    user_blocks = _plan_blocks(matrix.indptr)
+    item_blocks = _plan_blocks(matrix.col_indptr)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for iteration in range(iterations):
+            user_factors = _solve_side(
+                executor, matrix.indptr, matrix.indices, matrix.data,
+                item_factors, reg, user_blocks
+            )
+            item_factors = _solve_side(
+                executor, matrix.col_indptr, matrix.col_indices, matrix.col_data,
+                user_factors, reg, item_blocks
+            )
+            if callback:
+                callback(iteration + 1, training_rmse(matrix, user_factors, item_factors))
+    return user_factors, item_factors
+
+
+def training_rmse(matrix, user_factors, item_factors):
+    """训练集上的均方根误差"""
+    users = np.repeat(np.arange(matrix.n_users), np.diff(matrix.indptr))
+    predictions = np.einsum('ij,ij->i', user_factors[users], item_factors[matrix.indices])
+    return float(np.sqrt(np.mean((predictions - matrix.data) ** 2)))
+
+
+class MatrixFactorizationModel:
+    """矩阵分解模型：用户因子、餐厅因子及其ID映射"""
+
+    files = ('user_ids', 'restaurant_ids', 'user_factors', 'item_factors')
+
+    def __init__(self, user_ids, restaurant_ids, user_factors, item_factors,
+                 user_order=None, restaurant_order=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.restaurant_ids = np.asarray(restaurant_ids, dtype=np.int64)
+        self.user_factors = np.asarray(user_factors, dtype=np.float32)
+        self.item_factors = np.asarray(item_factors, dtype=np.float32)
+        self.user_index = IdMap(self.user_ids, user_order)
+        self.restaurant_index = IdMap(self.restaurant_ids, restaurant_order)
+
+    @property
+    def n_factors(self):
+        return self.item_factors.shape[1]
+
+    def to_arrays(self):
+        """发布为产物时的数组（包括ID映射的排序下标）"""
+        return {
+            **{name: getattr(self, name) for name in self.files},
+            'user_order': self.user_index.order,
+            'restaurant_order': self.restaurant_index.order,
+        }
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        return cls(*(artifact[name] for name in cls.files), artifact['user_order'], artifact['restaurant_order'])
+
+    def score_user(self, user_id):
+        """计算用户对所有餐厅的预测评分，未知用户返回None"""
+        user_idx = self.user_index.get(user_id)
+        if user_idx is None:
+            return None
+        return self.item_factors @ self.user_factors[user_idx]
+
+    def top_n(self, scores, n, exclude_ids=()):
+        """从预测评分中选出得分最高的n家餐厅，返回(rest_id数组, 得分数组)"""
+        scores = scores.astype(np.float64)
+        exclude = [self.restaurant_index[r] for r in exclude_ids if r in self.restaurant_index]
+        scores[exclude] = -np.inf
+        n = min(n, len(scores) - len(exclude))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.lexsort((top, -scores[top]))]
+        return self.restaurant_ids[top], scores[top]
+
+
+MF_ARTIFACT = 'mf'
+
+
+_mf_model = ArtifactHandle(MF_ARTIFACT, MatrixFactorizationModel.from_artifact)
+
+
+def get_mf_model():
+    """获取进程内共享的矩阵分解模型（文件映射），发布新版本后自动切换；没有训练过时返回None"""
+    return _mf_model.get()
+
+
+def reset_mf_model():
+    """丢弃已加载的模型，下次访问时重新加载"""
+    _mf_model.reset()
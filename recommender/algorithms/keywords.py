@@ -0,0 +1,107 @@
+from django.db import connections
+import threading
+import numpy as np
+from ..cache import recommender_cache
+from ..models import Restaurant
+
+# SQLite 的 LIKE 只对 ASCII 字母不区分大小写
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def ascii_lower(text):
+    """只把 ASCII 大写字母转为小写"""
+    return text.translate(_ASCII_LOWER)
+
+
+def case_folder(using='default'):
+    """与数据库 icontains 一致的大小写折叠：SQLite 只折叠 ASCII，其他数据库按 Unicode 折叠"""
+    return ascii_lower if connections[using].vendor == 'sqlite' else str.lower
+
+
+class KeywordIndex:
+    """餐厅名称的 n-gram 倒排索引，用于关键词（子串）查找
+
+    对每个名称记录其中所有的单字和相邻两字（统一转为小写），查询时：
+    单字关键词直接取单字倒排表；多字关键词取其所有两字片段倒排表的交集，
+    再用子串匹配校验（交集只保证每个片段都出现过）。新的关键词不需要扫描全部名称。
+    fold 为大小写折叠函数，默认与数据库的 name__icontains 一致（见 case_folder）。
+    """
+
+    def __init__(self, restaurant_ids, names, fold=None):
+        self.fold = fold or case_folder()
+        self.restaurant_ids = np.asarray(restaurant_ids, dtype=np.int64)
+        self.names = [self.fold(name or '') for name in names]
+        postings = {}
+        for position, name in enumerate(self.names):
+            grams = set(name)
+            grams.update(name[i:i + 2] for i in range(len(name) - 1))
+            for gram in grams:
+                postings.setdefault(gram, []).append(position)
+        self.postings = {gram: np.array(positions, dtype=np.int64) for gram, positions in postings.items()}
+
+    @classmethod
+    def from_queryset(cls, queryset=None):
+        """从餐厅表构建索引"""
+        if queryset is None:
+            queryset = Restaurant.objects.all()
+        rows = list(queryset.order_by('rest_id').values_list('rest_id', 'name'))
+        return cls([r[0] for r in rows], [r[1] for r in rows])
+
+    def _positions(self, keyword):
+        keyword = self.fold(keyword)
+        if not keyword:
+            return np.arange(len(self.names))
+        if len(keyword) == 1:
+            return self.postings.get(keyword, np.empty(0, dtype=np.int64))
+
+        # 从最短的倒排表开始求交集
+        grams = sorted(
+            {keyword[i:i + 2] for i in range(len(keyword) - 1)},
+            key=lambda gram: len(self.postings.get(gram, ()))
+        )
+        positions = self.postings.get(grams[0], np.empty(0, dtype=np.int64))
+        for gram in grams[1:]:
+            if not len(positions):
+                break
+            positions = np.intersect1d(positions, self.postings.get(gram, ()), assume_unique=True)
+        if len(keyword) > 2:
+            positions = np.array([p for p in positions.tolist() if keyword in self.names[p]], dtype=np.int64)
+        return positions
+
+    def search(self, keyword):
+        """名称包含关键词（大小写规则同 icontains）的餐厅ID数组，按ID升序"""
+        return self.restaurant_ids[self._positions(keyword)]
+
+    def search_any(self, keywords):
+        """名称包含任一关键词的餐厅ID数组，按ID升序"""
+        if not keywords:
+            return np.empty(0, dtype=np.int64)
+        positions = np.unique(np.concatenate([self._positions(k) for k in keywords]))
+        return self.restaurant_ids[positions]
+
+
+_keyword_index = None
+_keyword_index_generation = None
+_keyword_index_lock = threading.Lock()
+
+
+def get_keyword_index():
+    """获取进程内共享的名称关键词索引
+
+    首次调用时构建；推荐缓存的 global 代数变化（例如重新导入数据）后自动重建。
+    """
+    global _keyword_index, _keyword_index_generation
+    generation = recommender_cache.generations(['global'])[0]
+    if _keyword_index is None or _keyword_index_generation != generation:
+        with _keyword_index_lock:
+            if _keyword_index is None or _keyword_index_generation != generation:
+                _keyword_index = KeywordIndex.from_queryset()
+                _keyword_index_generation = generation
+    return _keyword_index
+
+
+def reset_keyword_index():
+    """丢弃已构建的索引，下次访问时重新构建"""
+    global _keyword_index
+    with _keyword_index_lock:
+        _keyword_index = None
@@ -0,0 +1,311 @@
+from django.db.models import Q
+import numpy as np
+from ..artifacts import ArtifactHandle, IdMap, artifact_store
+from ..cache import LocalReplica
+from ..models import Restaurant, Rating
+from .similarity import gather_rows
+
+# 名称缺失的餐厅
+INVALID_NAMES = Q(name__isnull=True) | Q(name__exact='') | Q(name__iexact='nan') | Q(name__iexact='null')
+
+
+def _first_seen_index(ids):
+    """按首次出现的顺序为ID编号，返回(去重后的ID数组, 每个元素的编号)"""
+    unique_ids, first_pos, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    order = np.argsort(first_pos, kind='stable')
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return unique_ids[order], rank[inverse]
+
+
+def _compress(major, minor, values, n_major):
+    """按major维度稳定排序并压缩，返回(indptr, indices, data)"""
+    order = np.argsort(major, kind='stable')
+    indptr = np.zeros(n_major + 1, dtype=np.int64)
+    np.cumsum(np.bincount(major, minlength=n_major), out=indptr[1:])
+    return indptr, minor[order], values[order]
+
+
+class RatingMatrix:
+    """用户-餐厅稀疏评分矩阵
+
+    同时保存CSR（按用户）和CSC（按餐厅）两种压缩格式。用户和餐厅按其在
+    评分表中首次出现的顺序编号，每行/列内的元素保持评分记录的原始顺序，
+    从而与逐条遍历评分记录的结果保持一致的排序。
+    """
+
+    def __init__(self, user_ids, restaurant_ids, ratings):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        restaurant_ids = np.asarray(restaurant_ids, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.int8)
+
+        self.user_ids, user_idx = _first_seen_index(user_ids)
+        self.restaurant_ids, rest_idx = _first_seen_index(restaurant_ids)
+        self.user_index = {u: i for i, u in enumerate(self.user_ids.tolist())}
+        self.restaurant_index = {r: i for i, r in enumerate(self.restaurant_ids.tolist())}
+
+        self.n_users = len(self.user_ids)
+        self.n_restaurants = len(self.restaurant_ids)
+        self.nnz = len(ratings)
+
+        self.indptr, self.indices, self.data = _compress(
+            user_idx, rest_idx, ratings, self.n_users
+        )
+        self.col_indptr, self.col_indices, self.col_data = _compress(
+            rest_idx, user_idx, ratings, self.n_restaurants
+        )
+
+    @classmethod
+    def from_queryset(cls, queryset=None):
+        """从评分记录构建矩阵"""
+        if queryset is None:
+            queryset = Rating.objects.all()
+        queryset = queryset.order_by('id').values_list('user_id', 'restaurant_id', 'rating')
+        records = np.fromiter(
+            queryset.iterator(chunk_size=20000),
+            dtype=[('user_id', np.int64), ('restaurant_id', np.int64), ('rating', np.int8)],
+            count=queryset.count()
+        )
+        return cls(records['user_id'], records['restaurant_id'], records['rating'])
+
+    def user_row(self, user_idx):
+        """获取用户评分过的餐厅编号及评分"""
+        start, end = self.indptr[user_idx], self.indptr[user_idx + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def similar_users(self, user_idx, n_users=10):
+        """基于共同评分餐厅的余弦相似度查找相似用户
+
+        通过CSC格式一次性取出与目标用户有共同评分餐厅的所有用户，
+        用bincount累加点积与两侧的范数，替代逐用户循环。
+        """
+        items, values = self.user_row(user_idx)
+        positions, lengths = gather_rows(self.col_indptr, items)
+        others = self.col_indices[positions]
+        other_values = self.col_data[positions].astype(np.float64)
+        target_values = np.repeat(values.astype(np.float64), lengths)
+
+        mask = others != user_idx
+        others = others[mask]
+        other_values = other_values[mask]
+        target_values = target_values[mask]
+        if not len(others):
+            return np.empty(0, dtype=np.int32), np.empty(0)
+
+        dot = np.bincount(others, weights=other_values * target_values, minlength=self.n_users)
+        target_sq = np.bincount(others, weights=target_values ** 2, minlength=self.n_users)
+        other_sq = np.bincount(others, weights=other_values ** 2, minlength=self.n_users)
+
+        candidates = np.unique(others)
+        norm1 = np.sqrt(target_sq[candidates])
+        norm2 = np.sqrt(other_sq[candidates])
+        denominator = norm1 * norm2
+        similarity = np.zeros(len(candidates))
+        nonzero = denominator > 0
+        similarity[nonzero] = dot[candidates][nonzero] / denominator[nonzero]
+
+        # 相似度降序，相同时按用户首次出现顺序
+        order = np.lexsort((candidates, -similarity))[:n_users]
+        return candidates[order], similarity[order]
+
+    def score_unrated(self, user_idx, neighbours, weights):
+        """按相似用户加权平均的评分，为目标用户未评分的餐厅打分
+
+        返回按得分降序排列的(餐厅编号, 得分)；得分相同的餐厅按其在
+        相似用户评分记录中首次出现的顺序排列。
+        """
+        positions, _ = gather_rows(self.indptr, neighbours)
+        items = self.indices[positions]
+        lengths = self.indptr[neighbours + 1] - self.indptr[neighbours]
+        contributions = self.data[positions] * np.repeat(weights, lengths)
+
+        rated = np.zeros(self.n_restaurants, dtype=bool)
+        rated[self.user_row(user_idx)[0]] = True
+        mask = ~rated[items]
+        items = items[mask]
+        contributions = contributions[mask]
+        if not len(items):
+            return np.empty(0, dtype=np.int32), np.empty(0)
+
+        totals = np.bincount(items, weights=contributions, minlength=self.n_restaurants)
+        counts = np.bincount(items, minlength=self.n_restaurants)
+        unique_items, first_pos = np.unique(items, return_index=True)
+        scores = totals[unique_items] / counts[unique_items]
+
+        order = np.lexsort((first_pos, -scores))
+        return unique_items[order], scores[order]
+
+
+class RestaurantFeatureMatrix:
+    """餐厅评分特征矩阵
+
+    每行是一家餐厅的[总评分, 环境, 口味, 服务]平均分，按rest_id排序，
+    相似度查询只需一次矩阵-向量乘法。
+    """
+
+    feature_fields = ('avg_rating', 'avg_env_rating', 'avg_flavor_rating', 'avg_service_rating')
+
+    def __init__(self, restaurant_ids, features, norms=None, restaurant_order=None, version=None):
+        self.version = version  # 来源产物的版本号，未发布时为None
+        self.restaurant_ids = np.asarray(restaurant_ids, dtype=np.int64)
+        self.features = np.asarray(features, dtype=np.float64).reshape(-1, len(self.feature_fields))
+        self.norms = np.linalg.norm(self.features, axis=1) if norms is None else np.asarray(norms, dtype=np.float64)
+        self.restaurant_index = IdMap(self.restaurant_ids, restaurant_order)
+
+    def to_arrays(self):
+        """发布为产物时的 (数组, 元数据)"""
+        return {
+            'restaurant_ids': self.restaurant_ids,
+            'features': self.features,
+            'norms': self.norms,
+            'restaurant_order': self.restaurant_index.order,
+        }, {'feature_fields': list(self.feature_fields)}
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        return cls(
+            artifact['restaurant_ids'], artifact['features'], artifact['norms'], artifact['restaurant_order'],
+            artifact.version
+        )
+
+    @classmethod
+    def _rows(cls, queryset):
+        return np.array(
+            list(queryset.order_by('rest_id').values_list('rest_id', *cls.feature_fields)),
+            dtype=np.float64
+        ).reshape(-1, len(cls.feature_fields) + 1)
+
+    @classmethod
+    def from_queryset(cls, queryset=None):
+        """从餐厅的聚合评分字段构建矩阵，默认使用 feature_matrix_queryset()"""
+        if queryset is None:
+            queryset = feature_matrix_queryset()
+        rows = cls._rows(queryset)
+        return cls(rows[:, 0], rows[:, 1:])
+
+    def updated(self, rest_ids, queryset=None):
+        """重新读取 rest_ids 中餐厅的特征，返回更新后的新矩阵，原矩阵（可能是文件映射）不变
+
+        不再属于 queryset 的餐厅被移除，新进入的餐厅按 rest_id 插入。
+        """
+        if queryset is None:
+            queryset = feature_matrix_queryset()
+        rows = self._rows(queryset.filter(rest_id__in=rest_ids))
+        keep = ~np.isin(self.restaurant_ids, np.fromiter(rest_ids, dtype=np.int64))
+        restaurant_ids = np.concatenate([self.restaurant_ids[keep], rows[:, 0].astype(np.int64)])
+        features = np.concatenate([self.features[keep], rows[:, 1:]])
+        norms = np.concatenate([self.norms[keep], np.linalg.norm(rows[:, 1:], axis=1)])
+        order = np.argsort(restaurant_ids, kind='stable')
+        return type(self)(restaurant_ids[order], features[order], norms[order], version=self.version)
+
+    @classmethod
+    def vector_of(cls, restaurant):
+        """获取单个餐厅的特征向量"""
+        return np.array([getattr(restaurant, f) or 0 for f in cls.feature_fields], dtype=np.float64)
+
+    def most_similar(self, vector, n=5, exclude_id=None):
+        """按余弦相似度返回最相似的n家餐厅，结果为(rest_id数组, 相似度数组)"""
+        vector = np.asarray(vector, dtype=np.float64)
+        denominator = self.norms * np.linalg.norm(vector)
+        similarity = np.zeros(len(self.restaurant_ids))
+        nonzero = denominator > 0
+        similarity[nonzero] = (self.features[nonzero] @ vector) / denominator[nonzero]
+
+        candidates = np.ones(len(similarity), dtype=bool)
+        if exclude_id is not None and exclude_id in self.restaurant_index:
+            candidates[self.restaurant_index[exclude_id]] = False
+        candidates = np.flatnonzero(candidates)
+        if n <= 0 or not len(candidates):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # argpartition 找出第n大的相似度，并保留与之并列的餐厅以保证排序稳定
+        if n < len(candidates):
+            kth = np.argpartition(-similarity[candidates], n - 1)[n - 1]
+            threshold = similarity[candidates[kth]]
+            candidates = candidates[similarity[candidates] >= threshold]
+        order = np.lexsort((candidates, -similarity[candidates]))[:n]
+        top = candidates[order]
+        return self.restaurant_ids[top], similarity[top]
+
+
+# 评分增删改（ratings 变化记录）或 global 代数变化后重新构建，两次构建至少间隔
+# RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL 秒，构建期间继续使用旧矩阵
+_rating_matrix = LocalReplica(
+    'ratings', RatingMatrix.from_queryset,
+    interval_setting='RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL', default_interval=60
+)
+
+
+def get_rating_matrix():
+    """获取进程内共享的评分矩阵，首次调用时构建"""
+    return _rating_matrix.get()
+
+
+def reset_rating_matrix():
+    """丢弃已缓存的评分矩阵，下次访问时重新构建"""
+    _rating_matrix.reset()
+
+
+def feature_matrix_queryset():
+    """特征矩阵收录的餐厅：有评论且名称有效（与 BaseRecommender.filter_valid_restaurants 相同）"""
+    return Restaurant.objects.filter(review_count__gt=0).exclude(INVALID_NAMES)
+
+
+FEATURES_ARTIFACT = 'features'
+
+_published_feature_matrix = ArtifactHandle(
+    FEATURES_ARTIFACT, RestaurantFeatureMatrix.from_artifact,
+    build=lambda: RestaurantFeatureMatrix.from_queryset().to_arrays()
+)
+
+_NOT_LOADED = object()
+_loaded_feature_version = _NOT_LOADED
+
+
+def _load_feature_matrix():
+    """首次加载或发布了新版本时使用发布的矩阵；同一版本再次完整加载时（变化记录缺失、
+    超过最长时间）发布的矩阵已经过时，从数据库重新构建"""
+    global _loaded_feature_version
+    published = _published_feature_matrix.get()
+    matrix = published
+    if published.version == _loaded_feature_version:
+        matrix = RestaurantFeatureMatrix.from_queryset()
+        matrix.version = published.version
+    _loaded_feature_version = published.version
+    return matrix
+
+
+# 已发布的矩阵（文件映射）加上评分变化：各进程按 ratings 变化记录重新读取变化的餐厅，
+# 生成内存中的新矩阵，两次更新至少间隔 RECOMMENDER_FEATURE_MATRIX_REFRESH_INTERVAL 秒
+_feature_matrix = LocalReplica(
+    'ratings', _load_feature_matrix, lambda matrix, rest_ids: matrix.updated(rest_ids),
+    interval_setting='RECOMMENDER_FEATURE_MATRIX_REFRESH_INTERVAL'
+)
+
+
+def get_feature_matrix():
+    """获取进程内共享的餐厅特征矩阵
+
+    还没有发布过时在本进程内构建（不发布）；publish_feature_matrix 发布新版本后自动切换。
+    """
+    matrix = _feature_matrix.get()
+    published = _published_feature_matrix.get()
+    if matrix.version != published.version:
+        _feature_matrix.reset()
+        matrix = _feature_matrix.get()
+    return matrix
+
+
+def publish_feature_matrix(keep=3):
+    """重新构建餐厅特征矩阵并发布为新版本，返回版本号"""
+    return artifact_store.publish(
+        FEATURES_ARTIFACT, *RestaurantFeatureMatrix.from_queryset().to_arrays(), keep=keep
+    )
+
+
+def reset_feature_matrix():
+    """丢弃已加载的餐厅特征矩阵，下次访问时重新加载"""
+    global _loaded_feature_version
+    _published_feature_matrix.reset()
+    _feature_matrix.reset()
+    _loaded_feature_version = _NOT_LOADED
@@ -0,0 +1,112 @@
+import numpy as np
+
+# 每个中间三元组(源餐厅, 目标餐厅, 权重)在计算过程中大约占用的字节数
+BYTES_PER_TRIPLE = 64
+
+_worker_state = {}
+
+
+def gather_rows(indptr, rows):
+    """取出压缩矩阵中多行元素的位置，返回(位置数组, 每行长度)"""
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64), lengths
+    # 每个位置 = 所在行的起点 + 行内偏移
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets, lengths
+
+
+def item_norms(col_indptr, col_data):
+    """每家餐厅评分向量的L2范数"""
+    n_items = len(col_indptr) - 1
+    item_of_entry = np.repeat(np.arange(n_items), np.diff(col_indptr))
+    squares = col_data.astype(np.float64) ** 2
+    return np.sqrt(np.bincount(item_of_entry, weights=squares, minlength=n_items))
+
+
+def plan_chunks(indptr, col_indptr, col_indices, max_memory_bytes):
+    """按内存预算把餐厅划分为若干块
+
+    一家餐厅展开共同评分时产生的三元组数量等于其所有评分用户的评分数之和，
+    每块的三元组总数不超过预算（单家餐厅超出预算时自成一块）。
+    """
+    n_items = len(col_indptr) - 1
+    user_lengths = np.diff(indptr)
+    cost = np.zeros(n_items, dtype=np.int64)
+    if len(col_indices):
+        item_of_entry = np.repeat(np.arange(n_items), np.diff(col_indptr))
+        cost = np.bincount(item_of_entry, weights=user_lengths[col_indices], minlength=n_items).astype(np.int64)
+
+    budget = max(1, max_memory_bytes // BYTES_PER_TRIPLE)
+    chunks = []
+    start, used = 0, 0
+    for item in range(n_items):
+        if item > start and used + cost[item] > budget:
+            chunks.append((start, item))
+            start, used = item, 0
+        used += cost[item]
+    if start < n_items:
+        chunks.append((start, n_items))
+    return chunks
+
+
+def init_worker(indptr, indices, data, col_indptr, col_indices, col_data, norms):
+    """进程池初始化：保存评分矩阵的只读副本"""
+    _worker_state.update(
+        indptr=indptr, indices=indices, data=data,
+        col_indptr=col_indptr, col_indices=col_indices, col_data=col_data,
+        norms=norms
+    )
+
+
+def top_k_for_chunk(chunk, top_k=20, min_common=1):
+    """计算一块餐厅的Top-K相似餐厅
+
+    相似度为两家餐厅在全部用户评分向量上的余弦相似度，只有共同评分用户
+    数不少于 min_common 的餐厅对才参与排序。返回(源编号, 目标编号, 相似度)三个数组。
+    """
+    state = _worker_state
+    start, end = chunk
+    items = np.arange(start, end)
+
+    # 1. 取出这块餐厅的所有评分用户
+    positions, lengths = gather_rows(state['col_indptr'], items)
+    users = state['col_indices'][positions]
+    source_ratings = state['col_data'][positions].astype(np.float64)
+    sources = np.repeat(items, lengths)
+
+    # 2. 展开这些用户评分过的所有餐厅
+    positions, lengths = gather_rows(state['indptr'], users)
+    targets = state['indices'][positions].astype(np.int64)
+    weights = np.repeat(source_ratings, lengths) * state['data'][positions]
+    sources = np.repeat(sources, lengths)
+
+    mask = sources != targets
+    sources, targets, weights = sources[mask], targets[mask], weights[mask]
+    if not len(sources):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+
+    # 3. 按(源, 目标)聚合点积与共同评分用户数
+    n_items = len(state['col_indptr']) - 1
+    pairs, inverse = np.unique(sources * n_items + targets, return_inverse=True)
+    dot = np.bincount(inverse, weights=weights)
+    common = np.bincount(inverse)
+    sources, targets = pairs // n_items, pairs % n_items
+
+    norms = state['norms']
+    denominator = norms[sources] * norms[targets]
+    similarity = np.divide(dot, denominator, out=np.zeros_like(dot), where=denominator > 0)
+
+    keep = common >= min_common
+    sources, targets, similarity = sources[keep], targets[keep], similarity[keep]
+
+    # 4. 每个源餐厅保留相似度最高的 top_k 个
+    order = np.lexsort((targets, -similarity, sources))
+    sources, targets, similarity = sources[order], targets[order], similarity[order]
+    group_start = np.searchsorted(sources, sources, side='left')
+    rank = np.arange(len(sources)) - group_start
+    keep = rank < top_k
+    return sources[keep], targets[keep], similarity[keep]
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class RecommenderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'recommender'
+
+    def ready(self):
+        # 注册评分变更时使推荐缓存失效的信号处理
+        from . import signals  # noqa: F401
+        # 注册检查推荐缓存后端是否为多进程共享的系统检查
+        from . import checks  # noqa: F401
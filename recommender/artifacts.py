@@ -0,0 +1,214 @@
+"""版本化的离线计算产物（模型因子、近似最近邻索引、特征矩阵等）
+
+目录结构：
+
+    RECOMMENDER_ARTIFACT_DIR/<名称>/
+        CURRENT                当前版本号（整个文件原子替换）
+        versions/<版本号>/
+            <数组名>.npy        每个数组一个 .npy 文件
+            meta.json          标量参数
+
+发布新版本时先在临时目录中写完所有文件再改名为正式版本目录，最后替换 CURRENT，
+读者不会看到写了一半的版本。数组用 np.load(mmap_mode='r') 只读映射，同一台机器上的
+所有工作进程共享页缓存中的同一份数据。进程内的 ArtifactHandle 在 CURRENT 变化后
+自动切换到新版本，不需要重启；旧版本在被清理前仍可被正在使用它的进程读取。
+
+只有离线任务（import_restaurant_data、build_ann_index、train_mf）发布新版本；
+请求处理过程中还没有发布过的产物只在进程内存中构建，不写入目录。
+"""
+from django.conf import settings
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+
+
+class IdMap:
+    """ID -> 下标的映射，基于ID数组及其排序下标（二分查找）
+
+    两个数组都可以是文件映射，不像 dict 那样在每个进程中各建一份。
+    """
+
+    def __init__(self, ids, order=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.order = np.argsort(self.ids, kind='stable') if order is None else np.asarray(order, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, keys, default=-1):
+        """批量查找，返回下标数组，不存在的ID为 default"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(keys.shape, default, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, keys, sorter=self.order), len(self.ids) - 1)
+        indices = self.order[positions]
+        return np.where(self.ids[indices] == keys, indices, default)
+
+    def get(self, key, default=None):
+        index = int(self.lookup([key])[0])
+        return default if index < 0 else index
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        index = self.get(key)
+        if index is None:
+            raise KeyError(key)
+        return index
+
+
+class Artifact:
+    """已加载的一个版本：数组（只读映射）和元数据"""
+
+    def __init__(self, name, version, arrays, meta):
+        self.name = name
+        self.version = version
+        self.arrays = arrays
+        self.meta = meta
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+
+class ArtifactStore:
+    """产物的发布、读取和清理"""
+
+    pointer = 'CURRENT'
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root or settings.RECOMMENDER_ARTIFACT_DIR
+
+    def path(self, name, *parts):
+        return os.path.join(self.root, name, *parts)
+
+    def current_version(self, name):
+        """当前版本号，还没有发布过时返回None"""
+        try:
+            with open(self.path(name, self.pointer)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def versions(self, name):
+        """已发布的全部版本号（从旧到新）"""
+        try:
+            return sorted(v for v in os.listdir(self.path(name, 'versions')) if not v.startswith('.'))
+        except FileNotFoundError:
+            return []
+
+    def new_version(self):
+        """新版本号：时间（精确到纳秒，按字符串排序即按时间排序）加随机后缀，多个进程同时发布也不会重复"""
+        now = time.time_ns()
+        return f"{time.strftime('%Y%m%d%H%M%S', time.localtime(now // 10 ** 9))}-{now % 10 ** 9:09d}-{uuid.uuid4().hex[:8]}"
+
+    def publish(self, name, arrays, meta=None, keep=3):
+        """写入新版本并切换 CURRENT，返回版本号；只保留最近 keep 个版本"""
+        versions_dir = self.path(name, 'versions')
+        os.makedirs(versions_dir, exist_ok=True)
+        version = self.new_version()
+
+        tmp_dir = os.path.join(versions_dir, f'.{version}.tmp')
+        os.makedirs(tmp_dir)
+        try:
+            for key, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f'{key}.npy'), np.ascontiguousarray(array))
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({**(meta or {}), 'arrays': sorted(arrays)}, f)
+            os.rename(tmp_dir, os.path.join(versions_dir, version))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        pointer_path = self.path(name, self.pointer)
+        tmp_pointer = f'{pointer_path}.tmp-{version}'
+        with open(tmp_pointer, 'w') as f:
+            f.write(version)
+        os.replace(tmp_pointer, pointer_path)
+        self.prune(name, keep)
+        return version
+
+    def load(self, name, version=None, mmap=True):
+        """读取指定版本（默认当前版本），不存在时返回None"""
+        version = version or self.current_version(name)
+        if version is None:
+            return None
+        directory = self.path(name, 'versions', version)
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        arrays = {
+            key: np.load(os.path.join(directory, f'{key}.npy'), mmap_mode='r' if mmap else None)
+            for key in meta.pop('arrays')
+        }
+        return Artifact(name, version, arrays, meta)
+
+    def prune(self, name, keep=3):
+        """删除较旧的版本（当前版本总是保留）"""
+        current = self.current_version(name)
+        for version in self.versions(name)[:-keep or None]:
+            if version != current:
+                shutil.rmtree(self.path(name, 'versions', version), ignore_errors=True)
+
+
+artifact_store = ArtifactStore()
+
+
+class ArtifactHandle:
+    """进程内共享的产物对象，CURRENT 变化后下次访问时切换到新版本
+
+    loader(artifact) 把 Artifact 转换为使用方需要的对象；build() 在还没有发布过时
+    计算并返回 (arrays, meta)，只在本进程内存中使用（版本号为None），不发布——发布由
+    离线任务负责，之后 CURRENT 出现时自动切换。未发布且 build 不存在或返回None时，
+    get() 返回None。
+    """
+
+    def __init__(self, name, loader, build=None, store=None):
+        self.name = name
+        self.loader = loader
+        self.build = build
+        self.store = store or artifact_store
+        self._value = None
+        self._pointer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _pointer_state(self):
+        try:
+            stat = os.stat(self.store.path(self.name, self.store.pointer))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def get(self, build=None):
+        """返回当前版本的对象；build 覆盖构造时传入的 build"""
+        build = build or self.build
+        pointer = self._pointer_state()
+        if not self._loaded or pointer != self._pointer:
+            with self._lock:
+                if not self._loaded or pointer != self._pointer:
+                    artifact = self.store.load(self.name)
+                    built = build() if artifact is None and build is not None else None
+                    if built is not None:
+                        arrays, meta = built
+                        artifact = Artifact(self.name, None, arrays, dict(meta or {}))
+                    self._value = self.loader(artifact) if artifact is not None else None
+                    self._pointer = pointer
+                    self._loaded = True
+        return self._value
+
+    def reset(self):
+        """丢弃已加载的对象，下次访问时重新读取"""
+        with self._lock:
+            self._value = None
+            self._loaded = False
@@ -0,0 +1,202 @@
+"""评分数据的批量加载后端
+
+导入命令把清洗后的评分 DataFrame（列名与 Rating 字段一致）交给加载器写入数据库：
+
+- ORMBulkLoader: 通过 bulk_create 逐个构造模型实例（通用路径）
+- SQLiteBulkLoader: executemany 原生 INSERT，加载期间调整 PRAGMA 并暂时删除 Meta.indexes 声明的索引
+- PostgreSQLBulkLoader: COPY FROM STDIN
+
+get_bulk_loader 根据 settings.DATABASES 中的 ENGINE 自动选择。
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from django.db.models.constants import OnConflict
+import csv
+import io
+import pandas as pd
+from .models import Rating
+
+
+class ORMBulkLoader:
+    """通过 ORM bulk_create 写入"""
+
+    name = 'orm'
+
+    def __init__(self, model=Rating, using='default'):
+        self.model = model
+        self.using = using
+        self.connection = connections[using]
+        opts = model._meta
+        self.fields = [f for f in opts.concrete_fields if not f.primary_key]
+        self.columns = [f.attname for f in self.fields]
+
+    @contextmanager
+    def session(self):
+        """一次加载过程的准备与收尾"""
+        yield self
+
+    def load(self, df, ignore_conflicts=False):
+        """写入一批数据，返回写入的行数"""
+        columns = list(df.columns)
+        objs = [
+            self.model(**dict(zip(columns, values)))
+            for values in df.itertuples(index=False, name=None)
+        ]
+        if objs:  # 只有当列表非空时才创建
+            self.model.objects.using(self.using).bulk_create(objs, ignore_conflicts=ignore_conflicts)
+        return len(objs)
+
+    def table_name(self):
+        return self.connection.ops.quote_name(self.model._meta.db_table)
+
+    def column_names(self):
+        return ', '.join(self.connection.ops.quote_name(f.column) for f in self.fields)
+
+    def datetime_columns(self):
+        return [f.attname for f in self.fields if f.get_internal_type() == 'DateTimeField']
+
+
+class SQLiteBulkLoader(ORMBulkLoader):
+    """SQLite 原生批量插入
+
+    加载期间切换到 WAL 日志（提交时不再每次 fsync，进程崩溃后数据库仍然完整，
+    可以配合断点续传）并加大页缓存，同时删除模型 Meta.indexes 声明的索引，数据写完后
+    再统一重建。唯一约束保留，以便续传时依赖它忽略重复行；外键等字段上的索引也保留。
+    journal_mode 和 synchronous 不能在事务中修改，删除和重建索引也要在事务外进行，
+    因此 session() 必须在事务之外进入（导入命令在打开事务前进入）。
+
+    重建时按 Meta.indexes 补建表上缺少的全部索引：进程在加载中途被杀死时收尾代码不会
+    执行，续传时仍能恢复上次删除的索引。
+    """
+
+    name = 'sqlite'
+
+    pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -262144,  # 负数表示KB，即256MB
+        'temp_store': 'MEMORY',
+    }
+
+    @contextmanager
+    def session(self):
+        if self.connection.in_atomic_block:
+            raise RuntimeError('SQLiteBulkLoader.session() 必须在事务之外进入')
+        with self.connection.cursor() as cursor:
+            previous = self._apply_pragmas(cursor)
+        self._drop_indexes()
+        try:
+            yield self
+        finally:
+            self._restore_indexes()
+            with self.connection.cursor() as cursor:
+                for pragma, value in previous.items():
+                    cursor.execute(f'PRAGMA {pragma} = {value}')
+
+    def _apply_pragmas(self, cursor):
+        previous = {}
+        for pragma, value in self.pragmas.items():
+            cursor.execute(f'PRAGMA {pragma}')
+            previous[pragma] = cursor.fetchone()[0]
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        return previous
+
+    def _index_names(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+                [self.model._meta.db_table]
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def _drop_indexes(self):
+        """删除 Meta.indexes 中表上存在的索引"""
+        existing = self._index_names()
+        with self.connection.schema_editor(atomic=False) as editor:
+            for index in self.model._meta.indexes:
+                if index.name in existing:
+                    editor.remove_index(self.model, index)
+
+    def _restore_indexes(self):
+        """按 Meta.indexes 重建表上缺少的索引"""
+        existing = self._index_names()
+        with self.connection.schema_editor(atomic=False) as editor:
+            for index in self.model._meta.indexes:
+                if index.name not in existing:
+                    editor.add_index(self.model, index)
+
+    def load(self, df, ignore_conflicts=False):
+        if not len(df):
+            return 0
+        df = df[self.columns].copy()
+        for column in self.datetime_columns():
+            # 与 Django 的 SQLite 后端一致：UTC 时间，微秒为0时省略小数部分
+            timestamps = pd.to_datetime(df[column], utc=True).dt.tz_convert('UTC')
+            formatted = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+            whole_seconds = timestamps.dt.microsecond == 0
+            formatted[whole_seconds] = formatted[whole_seconds].str[:-7]
+            df[column] = formatted
+        on_conflict = OnConflict.IGNORE if ignore_conflicts else None
+        sql = '{} {} ({}) VALUES ({})'.format(
+            self.connection.ops.insert_statement(on_conflict=on_conflict),
+            self.table_name(),
+            self.column_names(),
+            ', '.join(['%s'] * len(self.columns))
+        )
+        rows = list(zip(*(df[column].tolist() for column in self.columns)))
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        return len(rows)
+
+
+class PostgreSQLBulkLoader(ORMBulkLoader):
+    """PostgreSQL COPY FROM STDIN 批量加载
+
+    COPY 不支持忽略冲突，需要忽略冲突的批次退回 ORM 路径。
+    同时兼容 psycopg 3 的 cursor.copy 和 psycopg2 的 copy_expert。
+    """
+
+    name = 'postgresql'
+
+    def load(self, df, ignore_conflicts=False):
+        if ignore_conflicts:
+            return super().load(df, ignore_conflicts=True)
+        if not len(df):
+            return 0
+        df = df[self.columns].copy()
+        for column in self.datetime_columns():
+            timestamps = pd.to_datetime(df[column], utc=True).dt.tz_convert('UTC')
+            df[column] = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S.%f+00:00')
+
+        # 字符串都加引号，空字符串才不会被当作NULL
+        buffer = io.StringIO()
+        df.to_csv(buffer, header=False, index=False, quoting=csv.QUOTE_NONNUMERIC)
+        buffer.seek(0)
+        sql = f'COPY {self.table_name()} ({self.column_names()}) FROM STDIN WITH (FORMAT csv)'
+        with self.connection.cursor() as cursor:
+            raw_cursor = cursor.cursor
+            if hasattr(raw_cursor, 'copy'):
+                with raw_cursor.copy(sql) as copy:
+                    copy.write(buffer.getvalue())
+            else:
+                raw_cursor.copy_expert(sql, buffer)
+        return len(df)
+
+
+BULK_LOADERS = {
+    'django.db.backends.sqlite3': SQLiteBulkLoader,
+    'django.db.backends.postgresql': PostgreSQLBulkLoader,
+}
+
+
+def get_bulk_loader(model=Rating, using='default', backend='auto'):
+    """获取批量加载器
+
+    backend 为 'auto' 时根据数据库 ENGINE 选择原生加载器，不支持的数据库使用 ORM；
+    为 'orm' 时强制使用 ORM 路径。
+    """
+    if backend == 'orm':
+        return ORMBulkLoader(model, using)
+    loader_class = BULK_LOADERS.get(settings.DATABASES[using]['ENGINE'], ORMBulkLoader)
+    return loader_class(model, using)
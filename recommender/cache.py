@@ -0,0 +1,367 @@
+"""推荐结果的版本化缓存
+
+缓存键中包含相关作用域的代数（generation）：
+
+- global: 所有推荐缓存，离线任务（导入数据、训练模型、重建索引等）完成后递增
+- restaurant:<rest_id>: 餐厅信息、评价列表、相似餐厅
+- user:<user_id>: 用户的个性化推荐
+- homepage: 首页快照（季节推荐、热门餐厅、评分榜），按时间过期，评分变化不使其失效
+- ratings: 评分的增删改，每一代记录受影响的餐厅ID（见 log_changes），进程内的餐厅目录、
+  排行榜等（LocalReplica）据此只更新变化的餐厅
+
+作用域发生变化时只需递增它的代数，旧键不再被访问，由缓存后端按TTL自然淘汰，
+不需要逐个查找和删除。评分的增删改通过信号（见 signals.py）自动递增对应的
+餐厅和用户代数。缓存键按餐厅或用户划分，不会出现 用户×餐厅 的组合键。
+
+代数和变化记录只有在所有进程共享同一个缓存后端（Redis，见 settings.CACHES）时才能在
+进程之间传递；进程内缓存（LocMemCache）只适用于单进程的开发服务器，见 checks.py。
+
+为了避免缓存过期时大量请求同时回源（缓存击穿），每个条目在逻辑过期后仍保留一段
+时间：同一时刻只有拿到锁（cache.add）的请求重新计算，其余请求继续返回旧值。
+临近过期时还会按概率提前刷新（XFetch），计算越慢的条目越早开始刷新。
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.query import QuerySet
+import functools
+import inspect
+import math
+import random
+import threading
+import time
+
+
+class RecommenderCache:
+    """带代数和击穿保护的缓存封装，并统计每类缓存的命中/未命中次数"""
+
+    def __init__(self, alias='default', prefix='rec', stale_ttl=300, lock_timeout=30,
+                 wait_timeout=1.0, beta=1.0):
+        self.alias = alias
+        self.prefix = prefix
+        self.stale_ttl = stale_ttl        # 逻辑过期后旧值继续保留的秒数
+        self.lock_timeout = lock_timeout  # 重新计算的锁的最长持有时间
+        self.wait_timeout = wait_timeout  # 没有旧值可用时等待其他请求计算完成的最长时间
+        self.beta = beta                  # 提前刷新的力度，越大越早刷新，0表示不提前
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def _generation_key(self, scope):
+        return f'{self.prefix}:gen:{scope}'
+
+    def _new_generation(self):
+        # 代数键被淘汰后以当前时间（毫秒）重新开始，保证不会与淘汰前的旧键重复
+        return int(time.time() * 1000)
+
+    def generations(self, scopes):
+        """一次读取多个作用域的当前代数"""
+        keys = [self._generation_key(scope) for scope in scopes]
+        found = self.backend.get_many(keys)
+        result = []
+        for key in keys:
+            if key not in found:
+                self.backend.add(key, self._new_generation(), None)
+                found[key] = self.backend.get(key)
+            result.append(found[key])
+        return result
+
+    def bump(self, *scopes):
+        """递增作用域的代数，使其下的缓存全部失效"""
+        for scope in scopes:
+            key = self._generation_key(scope)
+            try:
+                self.backend.incr(key)
+            except ValueError:
+                self.backend.add(key, self._new_generation(), None)
+
+    def _changes_key(self, scope, generation):
+        return f'{self.prefix}:changes:{scope}:{generation}'
+
+    def log_changes(self, scope, items, timeout=3600):
+        """递增作用域的代数，并记录这一代变化的条目（如餐厅ID），供各进程增量更新
+
+        代数键不存在（首次使用或已被淘汰）时只重新开始代数，读者会完整重新加载。
+        """
+        key = self._generation_key(scope)
+        try:
+            generation = self.backend.incr(key)
+        except ValueError:
+            self.backend.add(key, self._new_generation(), None)
+            return
+        self.backend.set(self._changes_key(scope, generation), list(items), timeout)
+
+    def changes_between(self, scope, seen, current, limit=1000):
+        """两次 generations(['global', scope]) 的结果之间记录的全部条目（集合）
+
+        global 变化、代数倒退、相差超过 limit 代或有记录缺失（已过期、写入者还没写完）时
+        返回None，调用方应完整重新加载。
+        """
+        if seen is None or seen[0] != current[0] or not 0 <= current[1] - seen[1] <= limit:
+            return None
+        keys = [self._changes_key(scope, g) for g in range(seen[1] + 1, current[1] + 1)]
+        found = self.backend.get_many(keys)
+        if len(found) < len(keys):
+            return None
+        items = set()
+        for key in keys:
+            items.update(found[key])
+        return items
+
+    def invalidate_all(self):
+        """使所有推荐缓存失效"""
+        self.bump('global')
+
+    def make_key(self, name, scopes, *parts):
+        """生成缓存键：名称 + 各作用域代数 + 参数"""
+        scopes = ['global', *scopes]
+        generations = self.generations(scopes)
+        return ':'.join([self.prefix, name, *map(str, generations), *map(str, parts)])
+
+    def get_or_set(self, name, scopes, builder, timeout, *parts, force=False):
+        """读取缓存，未命中或需要刷新时调用 builder() 计算并写入
+
+        缓存的是 (值, 逻辑过期时间, 计算耗时)，builder 返回查询集时写入其求值后的列表。同一个键同时只有一个请求重新计算，
+        其他请求返回旧值；完全没有旧值时短暂等待计算结果，超时后自行计算。
+        force 为 True 时直接重新计算（用于定时预热）。
+        """
+        key = self.make_key(name, scopes, *parts)
+        if force:
+            self._record(name, 'refreshes')
+            return self._rebuild(key, builder, timeout, locked=False)
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, expires_at, delta = entry
+            if not self._should_refresh(expires_at, delta):
+                self._record(name, 'hits')
+                return value
+            if not self._acquire(key):
+                # 其他请求正在重新计算，先返回旧值
+                self._record(name, 'stale')
+                return value
+            self._record(name, 'refreshes')
+            return self._rebuild(key, builder, timeout)
+
+        self._record(name, 'misses')
+        if self._acquire(key):
+            return self._rebuild(key, builder, timeout)
+        entry = self._wait(key)
+        if entry is not None:
+            return entry[0]
+        return self._rebuild(key, builder, timeout, locked=False)
+
+    def _lock_key(self, key):
+        return f'{key}:lock'
+
+    def _acquire(self, key):
+        """尝试获取重新计算的锁（cache.add 仅在键不存在时成功）"""
+        return self.backend.add(self._lock_key(key), 1, self.lock_timeout)
+
+    def _should_refresh(self, expires_at, delta):
+        """已逻辑过期，或按 XFetch 概率决定提前刷新"""
+        now = time.time()
+        if self.beta <= 0 or not delta:
+            return now >= expires_at
+        return now - delta * self.beta * math.log(1.0 - random.random()) >= expires_at
+
+    def _rebuild(self, key, builder, timeout, locked=True):
+        try:
+            start = time.time()
+            value = builder()
+            if isinstance(value, QuerySet):
+                # 查询集在写入前求值，缓存中不保存未执行的查询
+                value = list(value)
+            delta = time.time() - start
+            if timeout is None:
+                self.backend.set(key, (value, math.inf, delta), None)
+            else:
+                self.backend.set(key, (value, time.time() + timeout, delta), timeout + self.stale_ttl)
+            return value
+        finally:
+            if locked:
+                self.backend.delete(self._lock_key(key))
+
+    def _wait(self, key):
+        """等待持有锁的请求写入结果"""
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = self.backend.get(key)
+            if entry is not None:
+                return entry
+        return None
+
+    def _record(self, name, outcome):
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, dict.fromkeys(('hits', 'stale', 'refreshes', 'misses'), 0))
+            stats[outcome] += 1
+
+    def stats(self):
+        """当前进程内各类缓存的统计：命中、返回旧值、提前/过期刷新、未命中次数及命中率
+
+        返回旧值也算作命中。
+        """
+        with self._stats_lock:
+            return {
+                name: {
+                    **counts,
+                    'hit_rate': (counts['hits'] + counts['stale']) / sum(counts.values())
+                }
+                for name, counts in self._stats.items()
+            }
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+
+recommender_cache = RecommenderCache()
+
+
+def invalidate_ratings(user_ids, restaurant_ids, using=None):
+    """评分增删改后调用：事务提交后递增相关用户和餐厅的代数，并在 ratings 变化记录中登记这些餐厅
+
+    在提交后再递增，避免其他请求在提交前用旧数据重新填充缓存。
+    """
+    restaurant_ids = sorted({r for r in restaurant_ids if r is not None})
+    scopes = [*(f'user:{u}' for u in sorted(set(user_ids))), *(f'restaurant:{r}' for r in restaurant_ids)]
+
+    def on_commit():
+        recommender_cache.bump(*scopes)
+        # 各进程的餐厅目录、排行榜等只更新这些餐厅
+        recommender_cache.log_changes('ratings', restaurant_ids)
+
+    transaction.on_commit(on_commit, using=using)
+
+
+class LocalReplica:
+    """进程内由数据库加载、随变化记录增量更新的共享对象（餐厅目录、排行榜、评分矩阵等）
+
+    load() 完整加载；patch(value, items) 根据 scope 下变化的条目返回更新后的对象（可以是
+    原对象），返回None或无法取得变化记录时完整加载。访问时读取 global 和 scope 的代数：
+    有变化且距上次更新至少 interval_setting 秒时，由一个线程更新，其他线程继续使用旧对象。
+    距上次完整加载超过 RECOMMENDER_REPLICA_MAX_AGE 秒时无论代数是否变化都重新加载，
+    代数或变化记录丢失（缓存被清空、没有配置共享缓存）时对象也不会一直过期。
+    """
+
+    def __init__(self, scope, load, patch=None, interval_setting=None, default_interval=5):
+        self.scope = scope
+        self.load = load
+        self.patch = patch
+        self.interval_setting = interval_setting
+        self.default_interval = default_interval
+        self._value = None
+        self._loaded = False
+        self._generations = None
+        self._updated_at = 0.0
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        if self.interval_setting is None:
+            return self.default_interval
+        return getattr(settings, self.interval_setting, self.default_interval)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'RECOMMENDER_REPLICA_MAX_AGE', 3600)
+
+    def get(self):
+        """返回当前对象，首次调用时加载"""
+        generations = recommender_cache.generations(['global', self.scope])
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._set(self.load(), generations, loaded=True)
+            return self._value
+
+        now = time.monotonic()
+        expired = now - self._loaded_at >= self.max_age
+        if expired or (generations != self._generations and now - self._updated_at >= self.interval):
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._update(generations, expired)
+                finally:
+                    self._lock.release()
+        return self._value
+
+    def _update(self, generations, expired=False):
+        value = None
+        if not expired and self.patch is not None:
+            items = recommender_cache.changes_between(self.scope, self._generations, generations)
+            if items is not None:
+                value = self.patch(self._value, items)
+        if value is None:
+            self._set(self.load(), generations, loaded=True)
+        else:
+            self._set(value, generations)
+
+    def _set(self, value, generations, loaded=False):
+        # 代数在加载前读取：加载期间发生的变化下次访问时会再应用一次
+        self._value = value
+        self._generations = generations
+        self._updated_at = time.monotonic()
+        if loaded:
+            self._loaded_at = self._updated_at
+        self._loaded = True
+
+    def reset(self):
+        """丢弃已加载的对象，下次访问时重新加载"""
+        with self._lock:
+            self._value = None
+            self._loaded = False
+
+
+def cached_method(name=None, scopes=None, timeout=300, pack=None, unpack=None):
+    """把 RecommenderService 的方法包装为版本化、带击穿保护的缓存
+
+    缓存键由方法名和全部参数（含默认值）组成；scopes 为可调用对象，
+    接收方法的参数（关键字形式）并返回依赖的作用域列表，例如
+    lambda restaurant_id, **kwargs: [f'restaurant:{restaurant_id}']。
+    pack 把返回值转换为写入缓存的紧凑形式，unpack 在每次返回前还原
+    （例如 hydration.pack_restaurants / hydrate_restaurants）。
+    原方法可通过 .uncached 访问，.refresh(service, ...) 强制重新计算并写入缓存，
+    .packed(service, ...) 返回未还原的缓存内容（便于把多个结果合并为一次还原）。
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        cache_name = name or func.__name__
+
+        def call(self, args, kwargs, force, raw=False):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(list(bound.arguments.items())[1:])
+            builder = lambda: func(self, *args, **kwargs)
+            if pack:
+                builder = lambda: pack(func(self, *args, **kwargs))
+            value = recommender_cache.get_or_set(
+                cache_name,
+                scopes(**arguments) if scopes else [],
+                builder,
+                timeout,
+                *(f'{k}={v}' for k, v in arguments.items()),
+                force=force
+            )
+            return unpack(value) if unpack and not raw else value
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            return call(self, args, kwargs, force=False)
+
+        def refresh(self, *args, **kwargs):
+            """重新计算并写入缓存"""
+            return call(self, args, kwargs, force=True)
+
+        def packed(self, *args, **kwargs):
+            """读取缓存但不调用 unpack"""
+            return call(self, args, kwargs, force=False, raw=True)
+
+        wrapper.uncached = func
+        wrapper.refresh = refresh
+        wrapper.packed = packed
+        return wrapper
+    return decorator
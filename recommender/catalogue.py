@@ -0,0 +1,158 @@
+"""进程内的只读餐厅目录
+
+页面和接口展示推荐结果时只需要餐厅的少数几列（名称、各维度平均分、评论数），
+目录把这些列一次性读入内存：数值列是按 rest_id 排序的 NumPy 数组，名称拼接为一段
+UTF-8 字节并记录偏移，查找时用二分定位，再生成 __slots__ 的 RestaurantCard。
+推荐结果的还原（见 hydration.py）优先从目录取，不再逐次查询数据库。
+
+推荐缓存的 global 代数变化时（导入数据等）重新加载；评分增删改后只重新读取变化记录
+（ratings 作用域）中餐厅的一行，生成更新了这些行的新目录。两次更新至少间隔
+RECOMMENDER_CATALOGUE_REFRESH_INTERVAL 秒，更新期间其他请求继续使用旧目录。
+"""
+import copy
+import sys
+import numpy as np
+from .cache import LocalReplica
+from .models import Restaurant
+
+CARD_FIELDS = (
+    'rest_id', 'name', 'avg_rating', 'avg_flavor_rating',
+    'avg_env_rating', 'avg_service_rating', 'review_count'
+)
+# 推荐结果附带的得分属性
+SCORE_FIELDS = ('similarity_score', 'match_score', 'popularity_score', 'search_score')
+RATING_FIELDS = ('avg_rating', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating')
+
+
+class RestaurantCard:
+    """目录中一家餐厅的只读视图，字段与 Restaurant 同名"""
+
+    __slots__ = CARD_FIELDS + SCORE_FIELDS
+
+    def __init__(self, rest_id, name, avg_rating, avg_flavor_rating, avg_env_rating,
+                 avg_service_rating, review_count):
+        self.rest_id = rest_id
+        self.name = name
+        self.avg_rating = avg_rating
+        self.avg_flavor_rating = avg_flavor_rating
+        self.avg_env_rating = avg_env_rating
+        self.avg_service_rating = avg_service_rating
+        self.review_count = review_count
+
+    @property
+    def pk(self):
+        return self.rest_id
+
+    def __str__(self):
+        return f"{self.name} (ID: {self.rest_id})"
+
+    def __repr__(self):
+        return f'<RestaurantCard: {self}>'
+
+
+class RestaurantCatalogue:
+    """按 rest_id 排序的列式餐厅目录"""
+
+    def __init__(self, rest_ids, names, ratings, review_counts):
+        self.rest_ids = np.asarray(rest_ids, dtype=np.int64)
+        encoded = [(name or '').encode('utf-8') for name in names]
+        self.name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.name_offsets[1:])
+        self.name_bytes = b''.join(encoded)
+        self.ratings = np.asarray(ratings, dtype=np.float64).reshape(-1, len(RATING_FIELDS))
+        self.review_counts = np.asarray(review_counts, dtype=np.int32)
+
+    @classmethod
+    def from_queryset(cls, queryset=None, chunk_size=10000):
+        """从餐厅表加载"""
+        if queryset is None:
+            queryset = Restaurant.objects.all()
+        rows = queryset.order_by('rest_id').values_list(*CARD_FIELDS).iterator(chunk_size=chunk_size)
+        rest_ids, names, ratings, review_counts = [], [], [], []
+        for rest_id, name, *rating_values, review_count in rows:
+            rest_ids.append(rest_id)
+            names.append(name)
+            ratings.append(rating_values)
+            review_counts.append(review_count)
+        return cls(rest_ids, names, ratings, review_counts)
+
+    def __len__(self):
+        return len(self.rest_ids)
+
+    def _card(self, position):
+        start, end = self.name_offsets[position:position + 2].tolist()
+        return RestaurantCard(
+            int(self.rest_ids[position]),
+            self.name_bytes[start:end].decode('utf-8'),
+            *self.ratings[position].tolist(),
+            int(self.review_counts[position])
+        )
+
+    def get(self, rest_id):
+        """按ID查找，不存在时返回None"""
+        return self.in_bulk([rest_id]).get(rest_id)
+
+    def in_bulk(self, rest_ids):
+        """与 QuerySet.in_bulk 相同：返回 {rest_id: RestaurantCard}，目录中没有的ID不出现在结果中"""
+        rest_ids = np.asarray(rest_ids, dtype=np.int64)
+        if not len(rest_ids) or not len(self.rest_ids):
+            return {}
+        positions = np.minimum(np.searchsorted(self.rest_ids, rest_ids), len(self.rest_ids) - 1)
+        found = self.rest_ids[positions] == rest_ids
+        return {int(rest_id): self._card(p) for rest_id, p in zip(rest_ids[found], positions[found].tolist())}
+
+    def updated(self, rows):
+        """返回用 rows（CARD_FIELDS 各列的值）更新了评分和评论数的新目录，原目录不变
+
+        目录中没有某家餐厅或名称发生了变化时返回None（需要重新加载）。
+        """
+        rows = list(rows)
+        if not rows:
+            return self
+        if not len(self.rest_ids):
+            return None
+        rest_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.rest_ids, rest_ids), len(self.rest_ids) - 1)
+        if not (self.rest_ids[positions] == rest_ids).all():
+            return None
+        for position, row in zip(positions.tolist(), rows):
+            start, end = self.name_offsets[position:position + 2].tolist()
+            if self.name_bytes[start:end] != (row[1] or '').encode('utf-8'):
+                return None
+        catalogue = copy.copy(self)
+        catalogue.ratings = self.ratings.copy()
+        catalogue.review_counts = self.review_counts.copy()
+        catalogue.ratings[positions] = [row[2:2 + len(RATING_FIELDS)] for row in rows]
+        catalogue.review_counts[positions] = [row[-1] for row in rows]
+        return catalogue
+
+    def nbytes(self):
+        """目录占用的内存（字节）"""
+        return (
+            self.rest_ids.nbytes + self.name_offsets.nbytes + sys.getsizeof(self.name_bytes)
+            + self.ratings.nbytes + self.review_counts.nbytes
+        )
+
+
+def _patch_catalogue(catalogue, rest_ids):
+    rows = list(Restaurant.objects.filter(rest_id__in=rest_ids).values_list(*CARD_FIELDS))
+    if len(rows) != len(rest_ids):
+        # 餐厅已被删除
+        return None
+    return catalogue.updated(rows)
+
+
+_catalogue = LocalReplica(
+    'ratings', RestaurantCatalogue.from_queryset, _patch_catalogue,
+    interval_setting='RECOMMENDER_CATALOGUE_REFRESH_INTERVAL'
+)
+
+
+def get_catalogue():
+    """获取进程内共享的餐厅目录，首次调用时加载"""
+    return _catalogue.get()
+
+
+def reset_catalogue():
+    """丢弃已加载的目录，下次访问时重新加载"""
+    _catalogue.reset()
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+from .cache import recommender_cache
+
+# 只在当前进程内有效的缓存后端
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """推荐缓存的代数和变化记录必须对所有进程可见"""
+    backend = settings.CACHES.get(recommender_cache.alias, {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_BACKENDS:
+        return [Warning(
+            f'推荐缓存使用进程内后端 {backend}，评分变化、缓存失效和离线任务的结果不会传到其他进程',
+            hint='多进程部署时设置 RECOMMENDER_REDIS_URL 使用共享的 Redis 缓存',
+            id='recommender.W001',
+        )]
+    return []
@@ -0,0 +1,84 @@
+"""缓存中餐厅列表的紧凑表示
+
+推荐结果写入缓存时不保存 Restaurant 实例或查询集，只保存 rest_id 数组和附加得分数组
+（PackedRestaurants），读取时对整个结果（可以是嵌套的字典/列表）一次性还原：
+优先从进程内的餐厅目录（见 catalogue.py）取 RestaurantCard，目录中还没有的餐厅
+再用一次 in_bulk 查询。缓存内容小，反序列化快，也不会在命中时重新执行查询集的 SQL。
+"""
+import copy
+import numpy as np
+from .catalogue import get_catalogue
+from .models import Restaurant
+
+
+class PackedRestaurants:
+    """有序的餐厅ID数组 + 每家餐厅的附加属性（如相似度得分）"""
+
+    __slots__ = ('rest_ids', 'attrs')
+
+    def __init__(self, rest_ids, attrs=None):
+        self.rest_ids = np.asarray(rest_ids, dtype=np.int64)
+        self.attrs = attrs or {}
+
+    def __len__(self):
+        return len(self.rest_ids)
+
+
+def pack_restaurants(value, attrs=()):
+    """把餐厅列表（或值为餐厅列表的字典）转换为 PackedRestaurants
+
+    attrs 为需要保留的附加属性名，餐厅上没有该属性时记为 NaN。
+    """
+    if isinstance(value, dict):
+        return {key: pack_restaurants(item, attrs) for key, item in value.items()}
+    restaurants = list(value)
+    packed_attrs = {}
+    for attr in attrs:
+        values = [getattr(r, attr, None) for r in restaurants]
+        if any(v is not None for v in values):
+            packed_attrs[attr] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return PackedRestaurants([r.rest_id for r in restaurants], packed_attrs)
+
+
+def _iter_packed(value):
+    if isinstance(value, PackedRestaurants):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _iter_packed(item)
+
+
+def _unpack(value, restaurants):
+    if isinstance(value, dict):
+        return {key: _unpack(item, restaurants) for key, item in value.items()}
+    result = []
+    for position, rest_id in enumerate(value.rest_ids.tolist()):
+        restaurant = restaurants.get(rest_id)
+        if restaurant is None:
+            # 缓存写入后被删除的餐厅
+            continue
+        if value.attrs:
+            # 同一家餐厅可能出现在多个列表中且得分不同，附加属性设置在副本上
+            restaurant = copy.copy(restaurant)
+            for attr, values in value.attrs.items():
+                if not np.isnan(values[position]):
+                    setattr(restaurant, attr, float(values[position]))
+        result.append(restaurant)
+    return result
+
+
+def load_restaurants(rest_ids):
+    """按ID取餐厅：先查目录，缺少的（目录加载之后新增的餐厅）再查数据库"""
+    restaurants = get_catalogue().in_bulk(rest_ids)
+    missing = [r for r in rest_ids if r not in restaurants]
+    if missing:
+        restaurants.update(Restaurant.objects.in_bulk(missing))
+    return restaurants
+
+
+def hydrate_restaurants(value):
+    """把 pack_restaurants 的结果还原为餐厅列表（或字典）"""
+    packed = list(_iter_packed(value))
+    rest_ids = np.unique(np.concatenate([p.rest_ids for p in packed])) if packed else ()
+    restaurants = load_restaurants(rest_ids.tolist()) if len(rest_ids) else {}
+    return _unpack(value, restaurants)
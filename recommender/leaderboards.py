@@ -0,0 +1,157 @@
+"""进程内的各评分维度排行榜
+
+首页和 get_top_rated_by_category 需要总评分、口味、环境、服务四个维度的前N家餐厅。
+排行榜为每个维度维护一个按 (-平均分, rest_id) 有序的 SortedList，只收录评论数达到门槛、
+名称有效的餐厅，并且只保留前 RECOMMENDER_LEADERBOARD_SIZE 名；一次调用返回四个维度的
+前N个ID，不再执行四条排序查询。
+
+评分增删改提交后（见 signals.py），各进程从推荐缓存的变化记录（ratings 作用域）得知
+受影响的餐厅，只重新读取这些餐厅的聚合字段，在各维度上以 O(log K) 删除旧位置、插入新位置，
+不重新加载整张表；榜上的餐厅掉出后榜单不足K家时，从内存中的聚合值补齐。global 代数变化
+或变化记录缺失时才重新加载。两次更新至少间隔 RECOMMENDER_LEADERBOARD_REFRESH_INTERVAL 秒，
+期间继续使用旧排行榜。
+"""
+from django.conf import settings
+from sortedcontainers import SortedList
+import heapq
+import threading
+from .cache import LocalReplica
+from .catalogue import RATING_FIELDS
+from .models import Restaurant
+
+LEADERBOARD_FIELDS = ('rest_id', 'name', 'review_count') + RATING_FIELDS
+
+
+def _is_valid_name(name):
+    return (name or '').lower() != 'nan'
+
+
+class RatingLeaderboards:
+    """评论数不少于 min_reviews 的餐厅在各评分维度上的排行，每个维度保留前 size 名"""
+
+    def __init__(self, min_reviews, rows=(), size=None):
+        self.min_reviews = min_reviews
+        self.size = size or settings.RECOMMENDER_LEADERBOARD_SIZE
+        self._values = {}
+        # 各维度平均分大于0的候选餐厅数（包括榜外的）
+        self._counts = dict.fromkeys(RATING_FIELDS, 0)
+        self._boards = {field: SortedList() for field in RATING_FIELDS}
+        self._lock = threading.Lock()
+        for rest_id, name, review_count, *values in rows:
+            if self._eligible(name, review_count):
+                self._values[rest_id] = values
+                for field, value in zip(RATING_FIELDS, values):
+                    if value > 0:
+                        self._counts[field] += 1
+        for field in RATING_FIELDS:
+            self._rebuild(field)
+
+    @classmethod
+    def from_queryset(cls, min_reviews, queryset=None, chunk_size=10000, size=None):
+        """从餐厅表加载"""
+        if queryset is None:
+            queryset = Restaurant.objects.all()
+        rows = queryset.filter(review_count__gte=min_reviews).exclude(
+            name__iexact='nan'
+        ).values_list(*LEADERBOARD_FIELDS).iterator(chunk_size=chunk_size)
+        return cls(min_reviews, rows, size)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _eligible(self, name, review_count):
+        return review_count >= self.min_reviews and _is_valid_name(name)
+
+    def _rebuild(self, field):
+        """从全部候选餐厅的聚合值重新选出该维度的前 size 名"""
+        position = RATING_FIELDS.index(field)
+        self._boards[field] = SortedList(heapq.nsmallest(self.size, (
+            (-values[position], rest_id) for rest_id, values in self._values.items() if values[position] > 0
+        )))
+
+    def _remove(self, rest_id):
+        values = self._values.pop(rest_id, None)
+        if values is None:
+            return
+        for field, value in zip(RATING_FIELDS, values):
+            if value > 0:
+                self._counts[field] -= 1
+                self._boards[field].discard((-value, rest_id))
+
+    def _add(self, rest_id, values):
+        self._values[rest_id] = values
+        for field, value in zip(RATING_FIELDS, values):
+            if value <= 0:
+                continue
+            board = self._boards[field]
+            entry = (-value, rest_id)
+            # 榜外的餐厅都排在榜尾之后：只有排在榜尾之前，或者没有榜外餐厅时才能直接上榜
+            if len(board) == self._counts[field] or (board and entry < board[-1]):
+                board.add(entry)
+                if len(board) > self.size:
+                    board.pop()
+            self._counts[field] += 1
+
+    def _refill(self):
+        for field, board in self._boards.items():
+            if len(board) < min(self.size, self._counts[field]):
+                self._rebuild(field)
+
+    def update(self, rest_id, name, review_count, *values):
+        """餐厅的聚合字段变化后调整它在各维度上的位置；不再满足门槛的餐厅移出排行榜"""
+        with self._lock:
+            self._remove(rest_id)
+            if self._eligible(name, review_count):
+                self._add(rest_id, values)
+            self._refill()
+
+    def remove(self, rest_id):
+        """餐厅被删除"""
+        with self._lock:
+            self._remove(rest_id)
+            self._refill()
+
+    def top(self, limit):
+        """一次返回各维度平均分最高的 limit 家餐厅：{平均分字段: [rest_id, ...]}，同分按 rest_id 升序"""
+        if limit > self.size:
+            raise ValueError(f'排行榜只保留前 {self.size} 名，无法返回前 {limit} 名')
+        with self._lock:
+            return {field: [rest_id for _, rest_id in board[:limit]] for field, board in self._boards.items()}
+
+
+def _apply_changes(leaderboards, rest_ids):
+    rows = {row[0]: row for row in Restaurant.objects.filter(
+        pk__in=rest_ids
+    ).values_list(*LEADERBOARD_FIELDS)}
+    for rest_id in rest_ids:
+        if rest_id in rows:
+            leaderboards.update(*rows[rest_id])
+        else:
+            leaderboards.remove(rest_id)
+    return leaderboards
+
+
+_leaderboards = {}
+_leaderboard_lock = threading.Lock()
+
+
+def get_leaderboards(min_reviews):
+    """获取进程内共享的、门槛为 min_reviews 的排行榜，首次调用时加载"""
+    replica = _leaderboards.get(min_reviews)
+    if replica is None:
+        with _leaderboard_lock:
+            replica = _leaderboards.get(min_reviews)
+            if replica is None:
+                replica = LocalReplica(
+                    'ratings', lambda: RatingLeaderboards.from_queryset(min_reviews), _apply_changes,
+                    interval_setting='RECOMMENDER_LEADERBOARD_REFRESH_INTERVAL'
+                )
+                _leaderboards[min_reviews] = replica
+    return replica.get()
+
+
+def reset_leaderboards():
+    """丢弃已加载的排行榜，下次访问时重新加载"""
+    with _leaderboard_lock:
+        for replica in _leaderboards.values():
+            replica.reset()
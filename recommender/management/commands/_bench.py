@@ -0,0 +1,27 @@
+"""基准测试命令的公共工具（下划线开头，不会注册为管理命令）"""
+from contextlib import contextmanager
+from django.db import connection
+import os
+import shutil
+import tempfile
+
+
+@contextmanager
+def benchmark_database():
+    """在独立的临时数据库中运行基准测试，结束后销毁
+
+    SQLite 使用临时目录下的文件数据库，而不是测试默认的内存数据库，
+    以便测到真实的磁盘写入开销。
+    """
+    tmpdir = None
+    if connection.vendor == 'sqlite':
+        tmpdir = tempfile.mkdtemp(prefix='recommender-bench-')
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
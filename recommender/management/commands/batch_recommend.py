@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+import csv
+import json
+import os
+import sys
+import time
+from recommender.models import Rating
+from recommender.services import RecommenderService
+
+class Command(BaseCommand):
+    help = '批量为大量用户生成个性化推荐，以 JSONL 或 CSV 格式流式输出（用于邮件/推送活动）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', default=None, help='用户ID文件，每行一个，"-" 表示标准输入（默认: 所有有评分的用户）')
+        parser.add_argument('--output', default='-', help='输出文件，"-" 表示标准输出')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='输出格式')
+        parser.add_argument('--limit', type=int, default=10, help='每个用户的推荐数量')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每次矩阵运算包含的用户数')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行计算的进程数')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        service = RecommenderService()
+        results = service.get_batch_recommendations(
+            self.read_user_ids(options['input']),
+            limit=options['limit'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers']
+        )
+
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', encoding='utf-8', newline='')
+        try:
+            write = self.write_csv if options['format'] == 'csv' else self.write_jsonl
+            count, fallback = write(output, results)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        # 进度信息写到标准错误，避免混入标准输出中的结果
+        self.stderr.write(self.style.SUCCESS(
+            f'完成 {count} 个用户（其中 {fallback} 个使用热门餐厅兜底），'
+            f'耗时 {time.time() - start_time:.1f} 秒'
+        ))
+
+    def read_user_ids(self, path):
+        """逐行读取用户ID；未指定文件时遍历所有有评分的用户"""
+        if path is None:
+            yield from Rating.objects.values_list('user_id', flat=True).distinct().order_by('user_id').iterator()
+            return
+        source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        try:
+            for line_number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield int(line)
+                except ValueError:
+                    raise CommandError(f'第 {line_number} 行不是有效的用户ID: {line}')
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+    def write_jsonl(self, output, results):
+        """每个用户一行 JSON"""
+        count = fallback = 0
+        for result in results:
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            count += 1
+            fallback += result['source'] == 'popular'
+        return count, fallback
+
+    def write_csv(self, output, results):
+        """每条推荐一行：user_id, rank, rest_id, score, source"""
+        writer = csv.writer(output)
+        writer.writerow(['user_id', 'rank', 'rest_id', 'score', 'source'])
+        count = fallback = 0
+        for result in results:
+            scores = result['scores'] or [''] * len(result['restaurants'])
+            for rank, (rest_id, score) in enumerate(zip(result['restaurants'], scores), 1):
+                writer.writerow([result['user_id'], rank, rest_id, score, result['source']])
+            count += 1
+            fallback += result['source'] == 'popular'
+        return count, fallback
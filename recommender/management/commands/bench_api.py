@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.urls import reverse
+from importlib import import_module
+import asyncio
+import numpy as np
+import time
+from recommender.models import Restaurant
+
+ENDPOINTS = ('restaurant_ratings_api', 'similar_restaurants_api', 'recommendations_api')
+
+
+class Command(BaseCommand):
+    help = '对 JSON 接口做并发压测：在进程内直接调用 ASGI 应用（与 asgi.py 部署方式相同），统计各并发度下的吞吐量和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='每个并发度发出的请求总数')
+        parser.add_argument('--concurrency', default='1,8,32', help='逗号分隔的并发度')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='逗号分隔的接口名（URL name）')
+        parser.add_argument('--username', default=None, help='以该用户登录后请求（默认匿名）')
+        parser.add_argument('--db-latency', type=float, default=0, help='每条SQL额外等待的毫秒数，模拟通过网络访问数据库的往返延迟')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        rest_ids = list(Restaurant.objects.filter(review_count__gt=0).values_list('rest_id', flat=True))
+        if not rest_ids:
+            raise CommandError('数据库中没有评分过的餐厅')
+        endpoints = [e for e in options['endpoints'].split(',') if e]
+        paths = [
+            reverse(f'recommender:{endpoints[i % len(endpoints)]}', kwargs={'rest_id': rest_id})
+            for i, rest_id in enumerate(rng.choice(rest_ids, options['requests']).tolist())
+        ]
+        headers = [(b'host', b'localhost')]
+        if options['username']:
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.login(options["username"])}'.encode()))
+
+        if options['db_latency']:
+            self.simulate_db_latency(options['db_latency'] / 1000)
+
+        application = get_asgi_application()
+        self.stdout.write(f'{"并发":>6}{"请求/秒":>10}{"平均(ms)":>10}{"p95(ms)":>10}{"失败":>6}')
+        for concurrency in [int(c) for c in options['concurrency'].split(',')]:
+            elapsed, latencies, failures = asyncio.run(self.run(application, paths, headers, concurrency))
+            self.stdout.write(
+                f'{concurrency:>6}{len(paths) / elapsed:>10.1f}{np.mean(latencies):>10.1f}'
+                f'{np.percentile(latencies, 95):>10.1f}{failures:>6}'
+            )
+
+    def simulate_db_latency(self, seconds):
+        """给之后新建的每个数据库连接加上固定的查询延迟（sleep 期间释放 GIL，与等待网络相同）"""
+        def delay(execute, sql, params, many, context):
+            time.sleep(seconds)
+            return execute(sql, params, many, context)
+
+        def install(sender, connection, **kwargs):
+            # 同一个线程的连接关闭后重连会再次触发信号，只加一次
+            if delay not in connection.execute_wrappers:
+                connection.execute_wrappers.append(delay)
+
+        connection_created.connect(install, weak=False)
+
+    def login(self, username):
+        """创建已登录的会话，返回会话键"""
+        try:
+            user = get_user_model().objects.get(username=username)
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'用户不存在: {username}')
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    async def run(self, application, paths, headers, concurrency):
+        """用 concurrency 个协程依次取出路径发请求，返回(总耗时, 各请求延迟ms, 失败数)"""
+        queue = list(reversed(paths))
+        latencies = []
+        failures = 0
+
+        async def client():
+            nonlocal failures
+            while queue:
+                path = queue.pop()
+                start = time.perf_counter()
+                status = await self.request(application, path, headers)
+                latencies.append((time.perf_counter() - start) * 1000)
+                failures += status != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - start, latencies, failures
+
+    async def request(self, application, path, headers):
+        """发出一个 GET 请求，返回状态码"""
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        received = False
+        disconnected = asyncio.Event()
+        status = None
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body' and not message.get('more_body'):
+                disconnected.set()
+
+        await application(scope, receive, send)
+        return status
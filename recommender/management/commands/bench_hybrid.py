@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+import numpy as np
+from recommender.algorithms.base import HybridRecommender
+from recommender.models import Rating, Restaurant
+
+class Command(BaseCommand):
+    help = '统计混合推荐各阶段（流行度、内容、协同、合并）的耗时，使用当前数据库中的用户和餐厅'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=100, help='抽样的(用户, 餐厅)对数量')
+        parser.add_argument('--limit', type=int, default=6, help='每次推荐的数量')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        user_ids = list(Rating.objects.values_list('user_id', flat=True).distinct())
+        rest_ids = list(Restaurant.objects.filter(review_count__gt=0).values_list('rest_id', flat=True))
+        if not user_ids or not rest_ids:
+            self.stdout.write(self.style.ERROR('数据库中没有评分数据'))
+            return
+
+        recommender = HybridRecommender()
+        # 先执行一次，排除构建进程内矩阵的开销
+        recommender.recommend(user_id=user_ids[0], restaurant_id=rest_ids[0])
+
+        timings = {}
+        for user_id, restaurant_id in zip(
+            rng.choice(user_ids, options['samples']).tolist(),
+            rng.choice(rest_ids, options['samples']).tolist()
+        ):
+            _, stage_timings = recommender.recommend_with_timings(
+                user_id=user_id,
+                restaurant_id=restaurant_id,
+                n_recommendations=options['limit']
+            )
+            for stage, elapsed in stage_timings.items():
+                timings.setdefault(stage, []).append(elapsed * 1000)
+
+        self.stdout.write(f'{"阶段":<14}{"平均(ms)":>10}{"p95(ms)":>10}')
+        for stage, values in timings.items():
+            self.stdout.write(f'{stage:<14}{np.mean(values):>10.2f}{np.percentile(values, 95):>10.2f}')
+        # 各子推荐器并发执行，总耗时接近其中最慢的一个
+        slowest = max((s for s in timings if s not in ('fusion', 'total')), key=lambda s: np.mean(timings[s]))
+        self.stdout.write(self.style.SUCCESS(f'最慢的阶段: {slowest}'))
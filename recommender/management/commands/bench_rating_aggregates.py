@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count
+from django.utils import timezone
+import numpy as np
+from recommender.models import Restaurant, Rating
+from tqdm import tqdm
+from recommender.utils import Timer
+from ._bench import benchmark_database
+
+
+def legacy_update_ratings(restaurant):
+    """改写前的 Restaurant.update_ratings：每家餐厅一次 Avg/Count 聚合查询，再保存整行"""
+    ratings = restaurant.ratings.all()
+    if ratings:
+        aggs = ratings.aggregate(
+            avg_rating=Avg('rating'),
+            avg_flavor=Avg('rating_flavor'),
+            avg_env=Avg('rating_env'),
+            avg_service=Avg('rating_service'),
+            count=Count('id')
+        )
+
+        restaurant.avg_rating = aggs['avg_rating'] or 0
+        restaurant.avg_flavor_rating = aggs['avg_flavor'] or 0
+        restaurant.avg_env_rating = aggs['avg_env'] or 0
+        restaurant.avg_service_rating = aggs['avg_service'] or 0
+        restaurant.review_count = aggs['count']
+    else:
+        restaurant.avg_rating = 0
+        restaurant.avg_flavor_rating = 0
+        restaurant.avg_env_rating = 0
+        restaurant.avg_service_rating = 0
+        restaurant.review_count = 0
+
+    restaurant.save()
+
+
+class Command(BaseCommand):
+    help = '对比逐餐厅 update_ratings 与分组聚合 + 批量写回的评分统计耗时（使用临时数据库）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--restaurants', type=int, default=100000, help='合成餐厅数量')
+        parser.add_argument('--ratings-per-restaurant', type=int, default=5, help='每家餐厅的平均评分数')
+        parser.add_argument('--batch-size', type=int, default=5000, help='批量写回的批大小')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            timer = Timer(self.stdout)
+            self.stdout.write('生成合成数据...')
+            with timer.phase('生成数据'):
+                self.generate(options)
+
+            self.stdout.write('逐餐厅 update_ratings（改写前的实现）：')
+            with timer.phase('update_ratings 循环'):
+                for restaurant in tqdm(Restaurant.objects.all()):
+                    legacy_update_ratings(restaurant)
+            expected = self.snapshot()
+
+            Restaurant.objects.update(
+                avg_rating=0, avg_flavor_rating=0, avg_env_rating=0, avg_service_rating=0,
+                review_count=0, rating_sum=0, popularity_score=0
+            )
+            self.stdout.write('分组聚合 + 批量写回：')
+            with timer.phase('refresh_rating_aggregates'):
+                Restaurant.objects.refresh_rating_aggregates(batch_size=options['batch_size'])
+
+            if self.snapshot() != expected:
+                self.stdout.write(self.style.ERROR('两种方式的统计结果不一致'))
+                return
+
+            legacy = timer.timings['update_ratings 循环']
+            fast = timer.timings['refresh_rating_aggregates']
+            self.stdout.write(self.style.SUCCESS(
+                f'结果一致，加速 {legacy / fast:.1f} 倍（{legacy:.2f} 秒 -> {fast:.2f} 秒）'
+            ))
+
+    def generate(self, options):
+        rng = np.random.default_rng(options['seed'])
+        n_restaurants = options['restaurants']
+        n_ratings = n_restaurants * options['ratings_per_restaurant']
+
+        Restaurant.objects.bulk_create(
+            [Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, n_restaurants + 1)],
+            batch_size=5000
+        )
+
+        # 每条评分使用不同的用户ID，避免违反(user_id, restaurant)唯一约束
+        restaurant_ids = rng.integers(1, n_restaurants + 1, size=n_ratings)
+        scores = rng.integers(1, 6, size=(n_ratings, 4))
+        now = timezone.now()
+        Rating.objects.bulk_create(
+            [
+                Rating(
+                    user_id=i, restaurant_id=rest_id, rating=s[0],
+                    rating_env=s[1], rating_flavor=s[2], rating_service=s[3],
+                    timestamp=now
+                )
+                for i, (rest_id, s) in enumerate(zip(restaurant_ids.tolist(), scores.tolist()))
+            ],
+            batch_size=5000
+        )
+
+    def snapshot(self):
+        # 只比较改写前的实现维护的字段（累计和与热度得分是之后加入的）
+        return list(Restaurant.objects.order_by('rest_id').values_list(
+            'review_count', 'avg_rating', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating'
+        ))
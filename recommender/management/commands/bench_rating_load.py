@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import get_current_timezone
+import numpy as np
+import pandas as pd
+from recommender.bulk_load import get_bulk_loader
+from recommender.models import Restaurant, Rating
+from recommender.utils import Timer
+from ._bench import benchmark_database
+
+class Command(BaseCommand):
+    help = '对比 ORM bulk_create 与数据库原生批量加载写入评分的耗时（使用临时数据库）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ratings', type=int, default=500000, help='合成评分数量')
+        parser.add_argument('--restaurants', type=int, default=10000, help='合成餐厅数量')
+        parser.add_argument('--batch-size', type=int, default=10000, help='每批写入的行数')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            timer = Timer(self.stdout)
+            Restaurant.objects.bulk_create(
+                [Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, options['restaurants'] + 1)],
+                batch_size=5000
+            )
+            df = self.generate(options)
+
+            results = {}
+            for backend in ['orm', 'auto']:
+                Rating.objects.delete_all()
+                loader = get_bulk_loader(Rating, backend=backend)
+                self.stdout.write(f'{loader.name}:')
+                with timer.phase(loader.name), loader.session(), transaction.atomic():
+                    for i in range(0, len(df), options['batch_size']):
+                        loader.load(df.iloc[i:i + options['batch_size']])
+                results[loader.name] = list(Rating.objects.order_by('user_id').values_list(
+                    'user_id', 'restaurant_id', 'rating', 'rating_env',
+                    'rating_flavor', 'rating_service', 'timestamp', 'comment'
+                ))
+
+            native = get_bulk_loader(Rating).name
+            if native == 'orm':
+                self.stdout.write(self.style.WARNING('当前数据库没有原生批量加载器'))
+                return
+            if results['orm'] != results[native]:
+                self.stdout.write(self.style.ERROR('两种方式写入的数据不一致'))
+                return
+            speedup = timer.timings['orm'] / timer.timings[native]
+            self.stdout.write(self.style.SUCCESS(
+                f'结果一致，{native} 比 orm 快 {speedup:.1f} 倍（{len(df)} 条评分）'
+            ))
+
+    def generate(self, options):
+        """生成与 import_restaurant_data 清洗结果格式相同的评分数据"""
+        rng = np.random.default_rng(options['seed'])
+        n = options['ratings']
+        scores = rng.integers(1, 6, size=(n, 4))
+        micros = 1300000000000000 + rng.integers(0, 10 ** 14, size=n)
+        micros[::10] -= micros[::10] % 1000000  # 部分时间戳为整秒
+        timestamps = pd.to_datetime(micros, unit='us', utc=True).tz_convert(get_current_timezone())
+        return pd.DataFrame({
+            'user_id': np.arange(n),
+            'restaurant_id': rng.integers(1, options['restaurants'] + 1, size=n),
+            'rating': scores[:, 0],
+            'rating_env': scores[:, 1],
+            'rating_flavor': scores[:, 2],
+            'rating_service': scores[:, 3],
+            'timestamp': timestamps.to_pydatetime(),
+            'comment': rng.choice(['', '味道不错', '服务很好，环境一般'], size=n),
+        })
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+import numpy as np
+from recommender.algorithms.ann import ANN_ARTIFACT, publish_ann_index, recall_at_k, reset_ann_index
+from recommender.artifacts import artifact_store
+from recommender.cache import recommender_cache
+
+class Command(BaseCommand):
+    help = (
+        '构建相似餐厅的近似最近邻索引（L1距离 LSH），发布为新版本并报告 recall@k；'
+        '索引是餐厅平均分的快照，评分变化较多后需要重新运行'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tables', type=int, default=24, help='哈希表数量')
+        parser.add_argument('--projections', type=int, default=5, help='每张表的随机投影数')
+        parser.add_argument('--bucket-width', type=float, default=2.0, help='哈希桶宽度')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--k', type=int, default=4, help='评估 recall@k 时的k')
+        parser.add_argument('--samples', type=int, default=200, help='评估使用的查询数量（0表示不评估）')
+        parser.add_argument('--keep', type=int, default=3, help='保留的索引版本数')
+
+    def handle(self, *args, **options):
+        if options['tables'] < 1 or options['projections'] < 1:
+            raise CommandError('--tables 和 --projections 都必须至少为1')
+        if options['bucket_width'] <= 0:
+            raise CommandError('--bucket-width 必须为正数')
+
+        start_time = time.time()
+        index, version = publish_ann_index(
+            keep=options['keep'],
+            n_tables=options['tables'],
+            n_projections=options['projections'],
+            bucket_width=options['bucket_width'],
+            seed=options['seed']
+        )
+        self.stdout.write(f'索引餐厅数: {len(index)}，构建耗时 {time.time() - start_time:.2f} 秒')
+        if not len(index):
+            self.stdout.write(self.style.WARNING('没有符合条件的餐厅，索引为空'))
+
+        reset_ann_index()
+        recommender_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f'索引已发布到 {artifact_store.path(ANN_ARTIFACT)}（版本 {version}）'))
+
+        if options['samples'] and len(index):
+            self.report(index, options['k'], options['samples'], options['seed'])
+
+    def report(self, index, k, samples, seed):
+        """抽样评估近似查询的召回率与耗时"""
+        rng = np.random.default_rng(seed)
+        queries = rng.choice(len(index), size=min(samples, len(index)), replace=False)
+        recall = recall_at_k(index, queries, k)
+
+        timings = {}
+        for name, query in (('近似', index.query), ('精确', index.exact)):
+            begin = time.perf_counter()
+            for position in queries:
+                query(index.features[position], k, exclude_id=int(index.restaurant_ids[position]))
+            timings[name] = (time.perf_counter() - begin) / len(queries) * 1000
+
+        self.stdout.write(f'recall@{k}: {recall:.4f}（{len(queries)} 个查询）')
+        for name, ms in timings.items():
+            self.stdout.write(f'{name}查询平均耗时: {ms:.3f} ms')
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import time
+from recommender.models import RestaurantLink
+from recommender.algorithms.matrix import RatingMatrix
+from recommender.algorithms.similarity import init_worker, item_norms, plan_chunks, top_k_for_chunk
+from tqdm import tqdm
+
+class Command(BaseCommand):
+    help = '根据共同评分离线计算餐厅之间的Top-K相似度，并写入RestaurantLink'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=20, help='每家餐厅保留的相似餐厅数量')
+        parser.add_argument('--min-common', type=int, default=1, help='两家餐厅至少需要的共同评分用户数')
+        parser.add_argument('--max-memory-mb', type=int, default=256, help='每个计算块的内存预算（MB）')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行计算的进程数')
+        parser.add_argument('--batch-size', type=int, default=10000, help='批量写入的记录数')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+
+        # 1. 构建评分矩阵
+        self.stdout.write('构建用户-餐厅评分矩阵...')
+        matrix = RatingMatrix.from_queryset()
+        self.stdout.write(f'用户数: {matrix.n_users}, 餐厅数: {matrix.n_restaurants}, 评分数: {matrix.nnz}')
+        if not matrix.nnz:
+            self.stdout.write(self.style.WARNING('没有评分数据，跳过相似度计算'))
+            return
+
+        # 2. 按内存预算划分计算块
+        chunks = plan_chunks(
+            matrix.indptr, matrix.col_indptr, matrix.col_indices,
+            options['max_memory_mb'] * 1024 * 1024
+        )
+        self.stdout.write(f'共 {len(chunks)} 个计算块，使用 {options["workers"]} 个进程')
+
+        worker_args = (
+            matrix.indptr, matrix.indices, matrix.data,
+            matrix.col_indptr, matrix.col_indices, matrix.col_data,
+            item_norms(matrix.col_indptr, matrix.col_data)
+        )
+        compute = partial(top_k_for_chunk, top_k=options['top_k'], min_common=options['min_common'])
+
+        # 3. 并行计算并分批写入
+        written = 0
+        with transaction.atomic():
+            RestaurantLink.objects.all().delete()
+            with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                initializer=init_worker,
+                initargs=worker_args
+            ) as executor:
+                for sources, targets, weights in tqdm(executor.map(compute, chunks), total=len(chunks)):
+                    source_ids = matrix.restaurant_ids[sources].tolist()
+                    target_ids = matrix.restaurant_ids[targets].tolist()
+                    links = [
+                        RestaurantLink(source_id=s, target_id=t, weight=w)
+                        for s, t, w in zip(source_ids, target_ids, weights.tolist())
+                    ]
+                    RestaurantLink.objects.bulk_create(links, batch_size=options['batch_size'])
+                    written += len(links)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'写入 {written} 条餐厅关联，耗时 {time.time() - start_time:.1f} 秒'
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+import time
+from recommender.search import RestaurantSearchIndex
+from tqdm import tqdm
+
+class Command(BaseCommand):
+    help = '增量更新餐厅全文搜索索引（名称 + 评论），--full 时全量重建'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='清空后全量重建（评分被修改或删除后使用）')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批重建的餐厅数')
+
+    def handle(self, *args, **options):
+        index = RestaurantSearchIndex()
+        if not index.available:
+            self.stdout.write(self.style.WARNING('当前数据库不支持 FTS5 全文索引，跳过'))
+            return
+
+        start_time = time.time()
+        self.stdout.write(f'当前评分水位: {index.watermark()}')
+        with tqdm(total=0) as progress:
+            def report(done, total):
+                progress.total = total
+                progress.update(done - progress.n)
+            count = index.update(full=options['full'], batch_size=options['batch_size'], progress=report)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'重建 {count} 家餐厅的索引，新水位 {index.watermark()}，耗时 {time.time() - start_time:.1f} 秒'
+        ))
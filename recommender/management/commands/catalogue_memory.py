@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+import numpy as np
+import tracemalloc
+from recommender.catalogue import RATING_FIELDS, RestaurantCatalogue
+from recommender.models import Restaurant
+
+class Command(BaseCommand):
+    help = '报告进程内餐厅目录的内存占用（按每10万家餐厅折算），并与同样数量的 Restaurant 实例对比'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=None, help='不读数据库，生成N家合成餐厅测量')
+        parser.add_argument('--sample', type=int, default=10000, help='测量 Restaurant 实例占用时使用的数量')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            n = options['synthetic']
+            rng = np.random.default_rng(42)
+            catalogue = RestaurantCatalogue(
+                np.arange(1, n + 1),
+                [f'火锅餐厅{i}' for i in range(1, n + 1)],
+                rng.uniform(1, 5, size=(n, len(RATING_FIELDS))),
+                rng.integers(0, 500, size=n)
+            )
+        else:
+            catalogue = RestaurantCatalogue.from_queryset()
+        if not len(catalogue):
+            self.stdout.write(self.style.ERROR('目录为空'))
+            return
+
+        per_restaurant = catalogue.nbytes() / len(catalogue)
+        self.stdout.write(f'目录: {len(catalogue)} 家餐厅，{catalogue.nbytes() / 1024 / 1024:.2f} MB')
+        self.stdout.write(f'  每家餐厅 {per_restaurant:.1f} 字节，每10万家 {per_restaurant * 100000 / 1024 / 1024:.2f} MB')
+
+        # 对比：同样的数据以 Restaurant 模型实例常驻内存
+        sample = min(options['sample'], len(catalogue))
+        cards = catalogue.in_bulk(catalogue.rest_ids[:sample])
+        tracemalloc.start()
+        # 名称重新解码一次，使每个实例持有自己的字符串（与从数据库读取时相同）
+        instances = [
+            Restaurant(
+                name=card.name.encode('utf-8').decode('utf-8'),
+                **{field: getattr(card, field) for field in ('rest_id', *RATING_FIELDS, 'review_count')}
+            )
+            for card in cards.values()
+        ]
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        per_instance = used / len(instances)
+        self.stdout.write(
+            f'Restaurant 实例: 每家 {per_instance:.1f} 字节，每10万家 {per_instance * 100000 / 1024 / 1024:.2f} MB'
+            f'（目录为其 {per_restaurant / per_instance:.1%}）'
+        )
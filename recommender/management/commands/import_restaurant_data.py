@@ -1,21 +1,65 @@
 from django.core.management.base import BaseCommand
-from django.utils.timezone import make_aware
+from django.utils.timezone import get_current_timezone
 from django.db import models, transaction
 import pandas as pd
 import numpy as np
 from recommender.models import Restaurant, Rating
+from recommender.algorithms.ann import publish_ann_index
+from recommender.algorithms.matrix import publish_feature_matrix
+from recommender.bulk_load import get_bulk_loader
+from recommender.cache import recommender_cache
+import json
 import os
-from datetime import datetime
 from tqdm import tqdm
+from recommender.utils import Timer
+
+# 流式导入时 ratings.csv 各列的类型；评分和时间戳可能缺失，所以用浮点数读取
+RATING_DTYPES = {
+    'userId': 'int64',
+    'restId': 'int64',
+    'rating': 'float32',
+    'rating_env': 'float32',
+    'rating_flavor': 'float32',
+    'rating_service': 'float32',
+    'timestamp': 'float64',
+    'comment': 'object',
+}
+
+# 缺失评分的默认值
+RATING_DEFAULTS = {
+    'rating': 0,
+    'rating_env': 1,
+    'rating_flavor': 1,
+    'rating_service': 1,
+    'comment': ''
+}
 
 class Command(BaseCommand):
     help = '从CSV文件导入餐厅数据'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--data-dir', default='data', help='CSV文件所在目录')
+        parser.add_argument(
+            '--streaming', action='store_true',
+            help='分块流式导入评分，每块单独提交事务，内存占用只取决于块大小'
+        )
+        parser.add_argument('--chunksize', type=int, default=50000, help='流式导入时每块的行数')
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help='流式导入的断点文件路径（默认: <data-dir>/.import_checkpoint.json）'
+        )
+        parser.add_argument('--resume', action='store_true', help='从断点文件继续上次中断的流式导入')
+        parser.add_argument(
+            '--loader', choices=['auto', 'orm'], default='auto',
+            help='评分写入方式：auto 根据数据库自动选择原生批量加载（SQLite/PostgreSQL），orm 使用 bulk_create'
+        )
+
+    def handle(self, *args, **options):
         # 文件路径
-        restaurants_file = 'data/restaurants.csv'
-        ratings_file = 'data/ratings.csv'
-        links_file = 'data/links.csv'
+        data_dir = options['data_dir']
+        restaurants_file = os.path.join(data_dir, 'restaurants.csv')
+        ratings_file = os.path.join(data_dir, 'ratings.csv')
+        links_file = os.path.join(data_dir, 'links.csv')
 
         # 检查文件是否存在
         for file_path in [restaurants_file, ratings_file, links_file]:
@@ -23,116 +67,225 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.ERROR(f'文件不存在: {file_path}'))
                 return
 
+        self.timer = Timer(self.stdout)
+        self.loader = get_bulk_loader(Rating, backend=options['loader'])
+        self.stdout.write(f'评分写入方式: {self.loader.name}')
         try:
-            with transaction.atomic():
-                # 清空现有数据
-                self.stdout.write('清除现有数据...')
-                Restaurant.objects.all().delete()
-                Rating.objects.all().delete()
-
-                # 1. 导入餐厅数据
-                self.stdout.write('开始导入餐厅数据...')
-                df_restaurants = pd.read_csv(restaurants_file)
-                self.stdout.write(f'发现 {len(df_restaurants)} 条餐厅数据')
-                
-                restaurants = [
-                    Restaurant(
-                        rest_id=row['restId'],
-                        name=row['name']
-                    )
-                    for _, row in df_restaurants.iterrows()
-                ]
-                Restaurant.objects.bulk_create(restaurants)
-                self.stdout.write(f'成功导入 {len(restaurants)} 家餐厅')
-
-                # 2. 导入评分数据
-                self.stdout.write('开始导入评分数据...')
-                # 读取时填充NaN值
-                df_ratings = pd.read_csv(ratings_file)
-                # 填充缺失值
-                df_ratings = df_ratings.fillna({
-                    'rating': 0,
-                    'rating_env': 1,
-                    'rating_flavor': 1,
-                    'rating_service': 1,
-                    'comment': ''
-                })
-                self.stdout.write(f'发现 {len(df_ratings)} 条评分数据')
-                
-                # 打印时间戳示例
-                self.stdout.write(f'时间戳示例: {df_ratings["timestamp"].iloc[0]}')
-                
-                # 批量创建评分
-                batch_size = 10000
-                for i in tqdm(range(0, len(df_ratings), batch_size)):
-                    batch = df_ratings.iloc[i:i+batch_size]
-                    ratings = []
-                    for _, row in batch.iterrows():
-                        try:
-                            # 处理时间戳
-                            timestamp = make_aware(datetime.fromtimestamp(row['timestamp']/1000))  # 除以1000转换毫秒为秒
-                            
-                            # 确保评分值是有效的整数
-                            rating = int(row['rating']) if not np.isnan(row['rating']) else 0
-                            rating_env = int(row['rating_env']) if not np.isnan(row['rating_env']) else 1
-                            rating_flavor = int(row['rating_flavor']) if not np.isnan(row['rating_flavor']) else 1
-                            rating_service = int(row['rating_service']) if not np.isnan(row['rating_service']) else 1
-                            
-                            ratings.append(Rating(
-                                user_id=row['userId'],
-                                restaurant_id=row['restId'],
-                                rating=rating,
-                                rating_env=rating_env,
-                                rating_flavor=rating_flavor,
-                                rating_service=rating_service,
-                                timestamp=timestamp,
-                                comment=str(row.get('comment', ''))
-                            ))
-                        except Exception as e:
-                            self.stdout.write(self.style.WARNING(f'处理评分数据时出错: {str(e)}, 行数据: {row.to_dict()}'))
-                            continue
-                    
-                    if ratings:  # 只有当列表非空时才创建
-                        Rating.objects.bulk_create(ratings)
-                    self.stdout.write(f'已导入 {i + len(batch)} 条评分数据')
-
-                # 3. 更新餐厅评分
-                self.stdout.write('更新餐厅评分统计...')
-                for restaurant in tqdm(Restaurant.objects.all()):
-                    restaurant.update_ratings()
-
-                # 4. 导入大众点评ID
-                self.stdout.write('导入大众点评ID...')
-                df_links = pd.read_csv(links_file)
-                for _, row in df_links.iterrows():
-                    Restaurant.objects.filter(rest_id=row['restId']).update(
-                        dianping_id=row['dianpingId']
-                    )
-
-                # 打印统计信息
-                restaurant_count = Restaurant.objects.count()
-                rating_count = Rating.objects.count()
-                rated_restaurant_count = Restaurant.objects.filter(review_count__gt=0).count()
-
-                self.stdout.write(self.style.SUCCESS(
-                    f'\n导入完成！\n'
-                    f'餐厅总数: {restaurant_count}\n'
-                    f'评分总数: {rating_count}\n'
-                    f'有评分的餐厅数: {rated_restaurant_count}'
-                ))
-
-                # 打印一些示例数据
-                self.stdout.write('\n示例餐厅数据:')
-                for restaurant in Restaurant.objects.filter(review_count__gt=0)[:5]:
-                    self.stdout.write(
-                        f'\n餐厅: {restaurant.name} (ID: {restaurant.rest_id})\n'
-                        f'  总评分: {restaurant.avg_rating:.2f}\n'
-                        f'  评论数: {restaurant.review_count}\n'
-                        f'  口味评分: {restaurant.avg_flavor_rating:.2f}\n'
-                        f'  环境评分: {restaurant.avg_env_rating:.2f}\n'
-                        f'  服务评分: {restaurant.avg_service_rating:.2f}'
-                    )
+            if options['streaming'] or options['resume']:
+                checkpoint_file = options['checkpoint'] or os.path.join(data_dir, '.import_checkpoint.json')
+                self.import_streaming(
+                    restaurants_file, ratings_file, links_file,
+                    checkpoint_file, options['chunksize'], options['resume']
+                )
+            else:
+                # 加载器的准备（PRAGMA、删除索引）不能在事务中进行，先于事务进入
+                with self.loader.session(), transaction.atomic():
+                    self.clear_data()
+                    self.import_restaurants(restaurants_file)
+                    self.import_ratings(ratings_file)
+                    self.update_aggregates()
+                    self.import_links(links_file)
+            self.publish_artifacts()
+            # 数据整体替换，所有推荐缓存失效
+            recommender_cache.invalidate_all()
+            self.print_summary()
+            self.print_timings()
 
         except Exception as e:
             self.stdout.write(self.style.ERROR(f'导入过程中出错: {str(e)}'))
-            raise 
\ No newline at end of file
+            raise
+
+    def publish_artifacts(self):
+        """重新发布依赖餐厅评分的特征矩阵和近似最近邻索引，各工作进程自动切换到新版本"""
+        self.stdout.write('发布餐厅特征矩阵和相似餐厅索引...')
+        with self.timer.phase('发布特征产物'):
+            publish_feature_matrix()
+            publish_ann_index()
+
+    def clear_data(self):
+        """清空现有数据"""
+        self.stdout.write('清除现有数据...')
+        with self.timer.phase('清除现有数据'):
+            # 先删除评分，避免级联删除时为每条评分发送信号
+            Rating.objects.delete_all()
+            Restaurant.objects.all().delete()
+
+    def import_restaurants(self, restaurants_file):
+        """1. 导入餐厅数据"""
+        self.stdout.write('开始导入餐厅数据...')
+        with self.timer.phase('导入餐厅'):
+            df_restaurants = pd.read_csv(restaurants_file)
+            self.stdout.write(f'发现 {len(df_restaurants)} 条餐厅数据')
+            
+            restaurants = [
+                Restaurant(rest_id=rest_id, name=name)
+                for rest_id, name in zip(df_restaurants['restId'].tolist(), df_restaurants['name'].tolist())
+            ]
+            Restaurant.objects.bulk_create(restaurants)
+        self.stdout.write(f'成功导入 {len(restaurants)} 家餐厅')
+
+    def import_ratings(self, ratings_file):
+        """2. 一次性读入并导入评分数据"""
+        self.stdout.write('开始导入评分数据...')
+        with self.timer.phase('读取评分CSV'):
+            # 读取时填充NaN值
+            df_ratings = pd.read_csv(ratings_file)
+            df_ratings = df_ratings.fillna(RATING_DEFAULTS)
+        self.stdout.write(f'发现 {len(df_ratings)} 条评分数据')
+        
+        # 打印时间戳示例
+        self.stdout.write(f'时间戳示例: {df_ratings["timestamp"].iloc[0]}')
+        
+        # 按列清洗数据，再分批创建评分
+        with self.timer.phase('清洗评分数据'):
+            df_ratings = self.clean_ratings(df_ratings)
+        batch_size = 10000
+        with self.timer.phase('写入评分'):
+            for i in tqdm(range(0, len(df_ratings), batch_size)):
+                batch = df_ratings.iloc[i:i+batch_size]
+                self.loader.load(batch)
+                self.stdout.write(f'已导入 {i + len(batch)} 条评分数据')
+
+    def import_streaming(self, restaurants_file, ratings_file, links_file,
+                         checkpoint_file, chunksize, resume):
+        """分块流式导入
+
+        每个评分块在独立事务中写入，提交后把已处理的行数写入断点文件。
+        中断后使用 --resume 会跳过已提交的行继续导入；断点之后的第一块
+        可能已经提交过，因此该块忽略唯一约束冲突。
+        """
+        checkpoint = self.load_checkpoint(checkpoint_file) if resume else None
+        if resume and checkpoint is None:
+            self.stdout.write(self.style.WARNING(f'断点文件不存在: {checkpoint_file}，重新开始导入'))
+
+        if checkpoint is None:
+            with transaction.atomic():
+                self.clear_data()
+                self.import_restaurants(restaurants_file)
+            checkpoint = {'ratings_file': os.path.abspath(ratings_file), 'rows_done': 0, 'ratings_done': False}
+            self.save_checkpoint(checkpoint_file, checkpoint)
+        elif checkpoint['ratings_file'] != os.path.abspath(ratings_file):
+            raise ValueError(f'断点文件对应的评分文件是 {checkpoint["ratings_file"]}，与当前文件不一致')
+
+        if not checkpoint['ratings_done']:
+            rows_done = checkpoint['rows_done']
+            self.stdout.write(f'开始流式导入评分数据（每块 {chunksize} 行，从第 {rows_done} 行开始）...')
+            reader = pd.read_csv(ratings_file, dtype=RATING_DTYPES, chunksize=chunksize)
+            rows_seen = 0
+            first_chunk = True
+            with self.timer.phase('流式导入评分'), self.loader.session():
+                for chunk in tqdm(reader):
+                    # 跳过已提交的行（评论中可能含换行，不能按文件行号跳过）
+                    rows_seen += len(chunk)
+                    if rows_seen <= rows_done:
+                        continue
+                    chunk = chunk.iloc[max(0, len(chunk) - (rows_seen - rows_done)):]
+
+                    df_ratings = self.clean_ratings(chunk.fillna(RATING_DEFAULTS))
+                    with transaction.atomic():
+                        self.loader.load(df_ratings, ignore_conflicts=resume and first_chunk)
+                    first_chunk = False
+                    checkpoint['rows_done'] += len(chunk)
+                    self.save_checkpoint(checkpoint_file, checkpoint)
+                    self.stdout.write(f'已导入 {checkpoint["rows_done"]} 条评分数据')
+            checkpoint['ratings_done'] = True
+            self.save_checkpoint(checkpoint_file, checkpoint)
+
+        with transaction.atomic():
+            self.update_aggregates()
+            self.import_links(links_file)
+        os.remove(checkpoint_file)
+
+    def load_checkpoint(self, checkpoint_file):
+        """读取断点文件，不存在时返回None"""
+        if not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_checkpoint(self, checkpoint_file, checkpoint):
+        """原子地写入断点文件"""
+        tmp_file = f'{checkpoint_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, checkpoint_file)
+
+    def update_aggregates(self):
+        """3. 更新餐厅评分"""
+        self.stdout.write('更新餐厅评分统计...')
+        with self.timer.phase('更新评分统计'):
+            updated = Restaurant.objects.refresh_rating_aggregates()
+        self.stdout.write(f'已更新 {updated} 家餐厅的评分统计')
+
+    def import_links(self, links_file):
+        """4. 导入大众点评ID"""
+        self.stdout.write('导入大众点评ID...')
+        with self.timer.phase('导入大众点评ID'):
+            df_links = pd.read_csv(links_file)
+            # dianping_id 是字符串字段，按原始值转成字符串后批量更新
+            rows = [
+                [str(dianping_id), rest_id]
+                for rest_id, dianping_id in zip(df_links['restId'].tolist(), df_links['dianpingId'].tolist())
+            ]
+            Restaurant.objects.update_by_pk(['dianping_id'], rows)
+        self.stdout.write(f'已更新 {len(rows)} 条大众点评ID')
+
+    def print_timings(self):
+        """打印各阶段耗时"""
+        self.stdout.write('\n各阶段耗时:')
+        for label, elapsed in self.timer.timings.items():
+            self.stdout.write(f'  {label}: {elapsed:.2f} 秒')
+        self.stdout.write(f'  合计: {sum(self.timer.timings.values()):.2f} 秒')
+
+    def print_summary(self):
+        """打印统计信息"""
+        restaurant_count = Restaurant.objects.count()
+        rating_count = Rating.objects.count()
+        rated_restaurant_count = Restaurant.objects.filter(review_count__gt=0).count()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'\n导入完成！\n'
+            f'餐厅总数: {restaurant_count}\n'
+            f'评分总数: {rating_count}\n'
+            f'有评分的餐厅数: {rated_restaurant_count}'
+        ))
+
+        # 打印一些示例数据
+        self.stdout.write('\n示例餐厅数据:')
+        for restaurant in Restaurant.objects.filter(review_count__gt=0)[:5]:
+            self.stdout.write(
+                f'\n餐厅: {restaurant.name} (ID: {restaurant.rest_id})\n'
+                f'  总评分: {restaurant.avg_rating:.2f}\n'
+                f'  评论数: {restaurant.review_count}\n'
+                f'  口味评分: {restaurant.avg_flavor_rating:.2f}\n'
+                f'  环境评分: {restaurant.avg_env_rating:.2f}\n'
+                f'  服务评分: {restaurant.avg_service_rating:.2f}'
+            )
+
+    def clean_ratings(self, df_ratings):
+        """按列清洗评分数据，返回列名与 Rating 字段一致的 DataFrame
+
+        时间戳为毫秒，换算为当前时区的aware时间；评分截断为整数。
+        时间戳、ID或评分无法转换的行会被跳过并打印警告。
+        """
+        score_columns = ['rating', 'rating_env', 'rating_flavor', 'rating_service']
+        numeric = df_ratings[['userId', 'restId', 'timestamp', *score_columns]].apply(
+            pd.to_numeric, errors='coerce'
+        )
+        valid = np.isfinite(numeric.to_numpy(dtype=np.float64)).all(axis=1)
+        for _, row in df_ratings[~valid].iterrows():
+            self.stdout.write(self.style.WARNING(f'处理评分数据时出错: 无效的数值, 行数据: {row.to_dict()}'))
+        numeric = numeric[valid]
+
+        # 毫秒时间戳先取整到微秒，与 datetime.fromtimestamp 的精度一致
+        micros = np.round(numeric['timestamp'].to_numpy(dtype=np.float64) * 1000).astype(np.int64)
+        timestamps = pd.to_datetime(micros, unit='us', utc=True).tz_convert(get_current_timezone())
+
+        cleaned = pd.DataFrame({
+            'user_id': numeric['userId'].astype(np.int64),
+            'restaurant_id': numeric['restId'].astype(np.int64),
+            **{column: numeric[column].astype(np.int64) for column in score_columns},
+            'timestamp': timestamps.to_pydatetime(),
+            'comment': df_ratings.loc[valid, 'comment'].astype(str) if 'comment' in df_ratings else '',
+        }, index=numeric.index)
+        return cleaned.reset_index(drop=True)
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from datetime import timedelta
+import os
+import time
+from recommender.models import Rating, UserRecommendation
+from recommender.services import RecommenderService
+from recommender.algorithms.batch import iter_chunks
+from recommender.cache import recommender_cache
+from tqdm import tqdm
+
+class Command(BaseCommand):
+    help = '为活跃用户预先计算个性化推荐，写入 UserRecommendation 表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help='每个用户保存的推荐数量（多保存一些，页面过滤已评分餐厅后仍然够用）')
+        parser.add_argument('--active-days', type=int, default=None, help='只处理最近N天内有评分的用户（默认: 所有有评分的用户）')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每次矩阵运算及写入事务包含的用户数')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行计算的进程数')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        ratings = Rating.objects.all()
+        if options['active_days'] is not None:
+            ratings = ratings.filter(timestamp__gte=timezone.now() - timedelta(days=options['active_days']))
+        user_ids = list(ratings.values_list('user_id', flat=True).distinct().order_by('user_id'))
+        self.stdout.write(f'活跃用户数: {len(user_ids)}')
+
+        version = (UserRecommendation.objects.aggregate(v=Max('version'))['v'] or 0) + 1
+        created_at = timezone.now()
+        service = RecommenderService()
+        results = service.get_batch_recommendations(
+            user_ids,
+            limit=options['limit'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers']
+        )
+
+        stored = skipped = 0
+        with tqdm(total=len(user_ids)) as progress:
+            for chunk in iter_chunks(results, options['chunk_size']):
+                # 只保存模型给出的推荐；热门兜底的用户不写入，页面访问时实时计算
+                chunk_users = [r['user_id'] for r in chunk]
+                rows = [
+                    UserRecommendation(
+                        user_id=r['user_id'], restaurant_id=rest_id, rank=rank,
+                        score=score, version=version, created_at=created_at
+                    )
+                    for r in chunk if r['source'] == 'mf'
+                    for rank, (rest_id, score) in enumerate(zip(r['restaurants'], r['scores']), 1)
+                ]
+                # 每块用户在一个事务中整体替换，页面不会读到新旧混合的结果
+                with transaction.atomic():
+                    UserRecommendation.objects.filter(user_id__in=chunk_users).delete()
+                    UserRecommendation.objects.bulk_create(rows)
+                stored += sum(r['source'] == 'mf' for r in chunk)
+                skipped += sum(r['source'] != 'mf' for r in chunk)
+                progress.update(len(chunk))
+
+        # 清理本次没有覆盖到的旧批次（例如已不再活跃的用户）
+        pruned, _ = UserRecommendation.objects.exclude(version=version).delete()
+        recommender_cache.invalidate_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'批次 {version}: 保存 {stored} 个用户的推荐，{skipped} 个用户不在模型中已跳过，'
+            f'清理旧记录 {pruned} 条，耗时 {time.time() - start_time:.1f} 秒'
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from datetime import datetime
+import time
+from recommender.services import RecommenderService
+
+class Command(BaseCommand):
+    help = '重新计算首页快照并写入缓存（可由定时任务周期性执行）'
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        service = RecommenderService()
+        snapshot = service.get_homepage_snapshot.refresh(service, month=datetime.now().month)
+        self.stdout.write(self.style.SUCCESS(
+            f'首页快照已刷新（{snapshot.season}季，热门 {len(snapshot.popular_restaurants)} 家，'
+            f'季节推荐 {len(snapshot.seasonal_restaurants)} 家），耗时 {time.time() - start_time:.2f} 秒'
+        ))
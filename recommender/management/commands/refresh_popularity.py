@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+import time
+from recommender.cache import recommender_cache
+from recommender.models import Restaurant, popularity_prior
+
+class Command(BaseCommand):
+    help = '按当前的先验设置重算所有餐厅的热度得分（修改 RECOMMENDER_POPULARITY_PRIOR_* 后执行）'
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        prior_mean, prior_count = popularity_prior()
+        updated = Restaurant.objects.refresh_popularity_scores()
+        recommender_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(
+            f'已重算 {updated} 家餐厅的热度得分（先验平均分 {prior_mean}，先验评论数 {prior_count}），'
+            f'耗时 {time.time() - start_time:.2f} 秒'
+        ))
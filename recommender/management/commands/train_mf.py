@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+import os
+import time
+from recommender.algorithms.factorization import (
+    MF_ARTIFACT,
+    MatrixFactorizationModel,
+    reset_mf_model,
+    train_als,
+)
+from recommender.algorithms.matrix import RatingMatrix
+from recommender.artifacts import artifact_store
+from recommender.cache import recommender_cache
+
+class Command(BaseCommand):
+    help = '离线训练矩阵分解推荐模型（ALS），并保存用户/餐厅因子矩阵'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--factors', type=int, default=32, help='隐因子维度')
+        parser.add_argument('--iterations', type=int, default=10, help='ALS 迭代轮数')
+        parser.add_argument('--reg', type=float, default=0.1, help='正则化系数')
+        parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='求解使用的线程数')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', type=int, default=3, help='保留的模型版本数')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        self.stdout.write('构建用户-餐厅评分矩阵...')
+        matrix = RatingMatrix.from_queryset()
+        self.stdout.write(f'用户数: {matrix.n_users}, 餐厅数: {matrix.n_restaurants}, 评分数: {matrix.nnz}')
+        if not matrix.nnz:
+            self.stdout.write(self.style.WARNING('没有评分数据，跳过训练'))
+            return
+
+        self.stdout.write(
+            f'开始训练：因子数 {options["factors"]}，迭代 {options["iterations"]} 轮，'
+            f'{options["threads"]} 个线程'
+        )
+        user_factors, item_factors = train_als(
+            matrix,
+            n_factors=options['factors'],
+            reg=options['reg'],
+            iterations=options['iterations'],
+            n_threads=options['threads'],
+            seed=options['seed'],
+            callback=lambda i, rmse: self.stdout.write(f'  第 {i} 轮: RMSE {rmse:.4f}')
+        )
+
+        model = MatrixFactorizationModel(matrix.user_ids, matrix.restaurant_ids, user_factors, item_factors)
+        # 各工作进程在下次访问时自动切换到新版本
+        version = artifact_store.publish(
+            MF_ARTIFACT, model.to_arrays(),
+            {'factors': options['factors'], 'reg': options['reg'], 'iterations': options['iterations']},
+            keep=options['keep']
+        )
+        reset_mf_model()
+        recommender_cache.invalidate_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'模型已发布到 {artifact_store.path(MF_ARTIFACT)}（版本 {version}），耗时 {time.time() - start_time:.1f} 秒'
+        ))
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='restaurantlink',
+            index=models.Index(fields=['source', '-weight'], name='recommender_source__8da588_idx'),
+        ),
+    ]
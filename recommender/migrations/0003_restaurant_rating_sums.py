@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:55
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_rating_sums(apps, schema_editor):
+    """根据已有评分回填累计字段"""
+    Restaurant = apps.get_model('recommender', 'Restaurant')
+    Rating = apps.get_model('recommender', 'Rating')
+    totals = Rating.objects.values('restaurant_id').annotate(
+        rating_total=Sum('rating'),
+        flavor_total=Sum('rating_flavor'),
+        env_total=Sum('rating_env'),
+        service_total=Sum('rating_service'),
+    )
+    for row in totals.iterator():
+        Restaurant.objects.filter(pk=row['restaurant_id']).update(
+            rating_sum=row['rating_total'],
+            flavor_rating_sum=row['flavor_total'],
+            env_rating_sum=row['env_total'],
+            service_rating_sum=row['service_total'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0002_restaurantlink_source_weight_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='env_rating_sum',
+            field=models.IntegerField(default=0, verbose_name='环境评分累计'),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='flavor_rating_sum',
+            field=models.IntegerField(default=0, verbose_name='口味评分累计'),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='rating_sum',
+            field=models.IntegerField(default=0, verbose_name='总评分累计'),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='service_rating_sum',
+            field=models.IntegerField(default=0, verbose_name='服务评分累计'),
+        ),
+        migrations.RunPython(populate_rating_sums, migrations.RunPython.noop),
+    ]
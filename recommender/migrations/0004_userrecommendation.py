@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0003_restaurant_rating_sums'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(verbose_name='用户ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='排名')),
+                ('score', models.FloatField(verbose_name='预测评分')),
+                ('version', models.IntegerField(db_index=True, verbose_name='生成批次')),
+                ('created_at', models.DateTimeField(verbose_name='生成时间')),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_recommendations', to='recommender.restaurant', verbose_name='推荐餐厅')),
+            ],
+            options={
+                'verbose_name': '用户推荐',
+                'verbose_name_plural': '用户推荐',
+                'unique_together': {('user_id', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, transaction
+from django.db.utils import OperationalError
+
+SEARCH_TABLE = 'recommender_restaurant_search'
+STATE_TABLE = 'recommender_search_state'
+
+
+def fts5_available(connection):
+    """SQLite 是否支持 FTS5（编译时未启用时创建虚拟表会报 no such module）"""
+    try:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE temp.recommender_fts5_probe USING fts5(x)')
+            cursor.execute('DROP TABLE temp.recommender_fts5_probe')
+    except OperationalError:
+        return False
+    return True
+
+
+def create_search_tables(apps, schema_editor):
+    """创建 FTS5 搜索表（仅支持 FTS5 的 SQLite，否则跳过，搜索退回名称模糊匹配）"""
+    if schema_editor.connection.vendor != 'sqlite' or not fts5_available(schema_editor.connection):
+        return
+    # prefix='1' 为单字前缀查询建立索引（单个汉字的查询使用前缀匹配）
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(name, comments, tokenize='unicode61', prefix='1')"
+    )
+    # rank 列按 bm25 排序，名称列的权重为评论列的10倍
+    schema_editor.execute(
+        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"
+    )
+    schema_editor.execute(
+        f'CREATE TABLE {STATE_TABLE} (name varchar(50) NOT NULL PRIMARY KEY, value integer NOT NULL)'
+    )
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+    schema_editor.execute(f'DROP TABLE IF EXISTS {STATE_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0004_userrecommendation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:53
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Cast
+
+
+def populate_popularity_score(apps, schema_editor):
+    """根据已有的评分累计字段回填热度得分（贝叶斯平均）"""
+    Restaurant = apps.get_model('recommender', 'Restaurant')
+    prior_mean = getattr(settings, 'RECOMMENDER_POPULARITY_PRIOR_MEAN', 3.0)
+    prior_count = getattr(settings, 'RECOMMENDER_POPULARITY_PRIOR_COUNT', 10)
+    Restaurant.objects.filter(review_count__gt=0).update(
+        popularity_score=(Value(float(prior_mean * prior_count)) + Cast(F('rating_sum'), FloatField()))
+        / (Value(float(prior_count)) + Cast(F('review_count'), FloatField()))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0005_restaurant_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='popularity_score',
+            field=models.FloatField(db_index=True, default=0, verbose_name='热度得分'),
+        ),
+        migrations.RunPython(populate_popularity_score, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,101 @@
-from django.db import models
+from django.conf import settings
+from django.db import connections, models, transaction
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg
+from django.db.models import Case, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, NullIf
+from django.db.models.lookups import GreaterThan
+from .cache import invalidate_ratings, recommender_cache
+
+# 评分字段 -> (累计字段, 平均分字段)
+RATING_AGGREGATE_FIELDS = {
+    'rating': ('rating_sum', 'avg_rating'),
+    'rating_flavor': ('flavor_rating_sum', 'avg_flavor_rating'),
+    'rating_env': ('env_rating_sum', 'avg_env_rating'),
+    'rating_service': ('service_rating_sum', 'avg_service_rating'),
+}
+
+def popularity_prior():
+    """热度得分的先验：(先验平均分, 先验评论数)"""
+    return (
+        getattr(settings, 'RECOMMENDER_POPULARITY_PRIOR_MEAN', 3.0),
+        getattr(settings, 'RECOMMENDER_POPULARITY_PRIOR_COUNT', 10),
+    )
+
+def popularity_score(rating_sum, review_count):
+    """贝叶斯平均的热度得分：把先验评论数条先验平均分的评论与实际评论一起平均
+
+    评论少的餐厅得分向先验平均分收缩，评论越多越接近实际平均分；没有评论时为0。
+    """
+    if not review_count:
+        return 0.0
+    prior_mean, prior_count = popularity_prior()
+    return (prior_mean * prior_count + rating_sum) / (prior_count + review_count)
+
+def popularity_score_expression(rating_sum, review_count):
+    """与 popularity_score 相同的计算，用于 UPDATE 语句中的数据库表达式"""
+    prior_mean, prior_count = popularity_prior()
+    return Case(
+        When(
+            GreaterThan(review_count, 0),
+            then=(Value(float(prior_mean * prior_count)) + Cast(rating_sum, FloatField()))
+            / (Value(float(prior_count)) + Cast(review_count, FloatField()))
+        ),
+        default=Value(0.0),
+        output_field=FloatField()
+    )
+
+class RestaurantManager(models.Manager):
+    def refresh_rating_aggregates(self, batch_size=5000):
+        """用一次分组聚合重新统计所有餐厅的评分，并分批写回
+
+        先把所有餐厅的统计字段清零，再用 update_by_pk 批量写回有评分的餐厅。
+        返回有评分的餐厅数量。
+        """
+        totals = Rating.objects.values('restaurant_id').annotate(
+            count=models.Count('id'),
+            **{sum_field: Sum(rating_field) for rating_field, (sum_field, _) in RATING_AGGREGATE_FIELDS.items()}
+        ).order_by()
+
+        fields = ['review_count']
+        for sum_field, avg_field in RATING_AGGREGATE_FIELDS.values():
+            fields += [sum_field, avg_field]
+        fields.append('popularity_score')
+
+        params = []
+        for row in totals.iterator():
+            values = [row['count']]
+            for sum_field, _ in RATING_AGGREGATE_FIELDS.values():
+                values += [row[sum_field], row[sum_field] / row['count']]
+            values.append(popularity_score(row['rating_sum'], row['count']))
+            params.append(values + [row['restaurant_id']])
+
+        with transaction.atomic(using=self.db):
+            self.update(**dict.fromkeys(fields, 0))
+            self.update_by_pk(fields, params, batch_size=batch_size)
+        return len(params)
+
+    def refresh_popularity_scores(self):
+        """按当前的先验设置用一条UPDATE重算所有餐厅的热度得分，返回更新的行数"""
+        return self.update(popularity_score=popularity_score_expression(F('rating_sum'), F('review_count')))
+
+    def update_by_pk(self, fields, rows, batch_size=5000):
+        """按主键批量更新指定字段
+
+        rows 中每一项为 [字段值..., 主键]，值需已是数据库可接受的类型。
+        使用参数化的 UPDATE 语句 executemany 分批执行，避免 bulk_update
+        为每一行构造 CASE WHEN 表达式的开销。
+        """
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        opts = self.model._meta
+        sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+            quote_name(opts.db_table),
+            ', '.join(f'{quote_name(opts.get_field(f).column)} = %s' for f in fields),
+            quote_name(opts.pk.column)
+        )
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany(sql, rows[i:i + batch_size])
 
 class Restaurant(models.Model):
     """餐厅模型"""
@@ -15,6 +110,17 @@ class Restaurant(models.Model):
     avg_service_rating = models.FloatField(default=0, verbose_name='平均服务评分')
     review_count = models.IntegerField(default=0, verbose_name='评论数量', db_index=True)
 
+    # 评分累计字段（用于增量维护平均分）
+    rating_sum = models.IntegerField(default=0, verbose_name='总评分累计')
+    flavor_rating_sum = models.IntegerField(default=0, verbose_name='口味评分累计')
+    env_rating_sum = models.IntegerField(default=0, verbose_name='环境评分累计')
+    service_rating_sum = models.IntegerField(default=0, verbose_name='服务评分累计')
+
+    # 热度得分（总评分的贝叶斯平均，随评分累计字段一起维护），热门排行按此字段的索引取前N
+    popularity_score = models.FloatField(default=0, verbose_name='热度得分', db_index=True)
+
+    objects = RestaurantManager()
+
     class Meta:
         verbose_name = '餐厅'
         verbose_name_plural = '餐厅'
@@ -29,31 +135,73 @@ class Restaurant(models.Model):
         return f"{self.name} (ID: {self.rest_id})"
 
     def update_ratings(self):
-        """更新餐厅的评分统计"""
-        ratings = self.ratings.all()
-        if ratings:
-            aggs = ratings.aggregate(
-                avg_rating=Avg('rating'),
-                avg_flavor=Avg('rating_flavor'),
-                avg_env=Avg('rating_env'),
-                avg_service=Avg('rating_service'),
-                count=models.Count('id')
-            )
-            
-            self.avg_rating = aggs['avg_rating'] or 0
-            self.avg_flavor_rating = aggs['avg_flavor'] or 0
-            self.avg_env_rating = aggs['avg_env'] or 0
-            self.avg_service_rating = aggs['avg_service'] or 0
-            self.review_count = aggs['count']
-        else:
-            self.avg_rating = 0
-            self.avg_flavor_rating = 0
-            self.avg_env_rating = 0
-            self.avg_service_rating = 0
-            self.review_count = 0
+        """重新统计餐厅的全部评分（用于修复累计字段）"""
+        aggs = self.ratings.aggregate(
+            count=models.Count('id'),
+            **{sum_field: Sum(rating_field) for rating_field, (sum_field, _) in RATING_AGGREGATE_FIELDS.items()}
+        )
+        self.review_count = aggs['count']
+        for sum_field, avg_field in RATING_AGGREGATE_FIELDS.values():
+            total = aggs[sum_field] or 0
+            setattr(self, sum_field, total)
+            setattr(self, avg_field, total / self.review_count if self.review_count else 0)
+        self.popularity_score = popularity_score(self.rating_sum, self.review_count)
         
         self.save()
 
+    @classmethod
+    def adjust_ratings(cls, restaurant_id, count_delta, rating_deltas):
+        """原子地调整评分累计值，并在同一条UPDATE中重新计算平均分和热度得分
+
+        rating_deltas 为 {评分字段: 增量}，耗时与餐厅已有的评论数无关。
+        """
+        new_count = F('review_count') + count_delta
+        updates = {'review_count': new_count}
+        for rating_field, (sum_field, avg_field) in RATING_AGGREGATE_FIELDS.items():
+            new_sum = F(sum_field) + rating_deltas.get(rating_field, 0)
+            updates[sum_field] = new_sum
+            updates[avg_field] = Coalesce(
+                Cast(new_sum, FloatField()) / NullIf(new_count, 0),
+                Value(0.0)
+            )
+        updates['popularity_score'] = popularity_score_expression(updates['rating_sum'], new_count)
+        return cls.objects.filter(pk=restaurant_id).update(**updates)
+
+class RatingManager(models.Manager):
+    def delete_all(self):
+        """删除全部评分：直接执行一条 DELETE，不逐条加载对象、不发送信号，返回删除的行数
+
+        只用于整体重建数据的场景，调用方需要自行重算餐厅评分累计值；推荐缓存在这里整体失效。
+        """
+        connection = connections[self.db]
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {connection.ops.quote_name(self.model._meta.db_table)}')
+            deleted = cursor.rowcount
+        recommender_cache.invalidate_all()
+        return deleted
+
+    def bulk_create_with_aggregates(self, objs, batch_size=None):
+        """批量创建评分，并按餐厅合并增量更新评分累计值
+
+        bulk_create 不发送 post_save 信号，这里和 signals.py 一样在提交后使相关用户和餐厅的
+        缓存失效并登记变化的餐厅。
+        """
+        objs = list(objs)
+        counts = {}
+        sums = {}
+        for rating in objs:
+            counts[rating.restaurant_id] = counts.get(rating.restaurant_id, 0) + 1
+            restaurant_sums = sums.setdefault(rating.restaurant_id, dict.fromkeys(RATING_AGGREGATE_FIELDS, 0))
+            for rating_field in RATING_AGGREGATE_FIELDS:
+                restaurant_sums[rating_field] += getattr(rating, rating_field)
+
+        with transaction.atomic(using=self.db):
+            created = self.bulk_create(objs, batch_size=batch_size)
+            for restaurant_id, count in counts.items():
+                Restaurant.adjust_ratings(restaurant_id, count, sums[restaurant_id])
+            invalidate_ratings([rating.user_id for rating in objs], counts, using=self.db)
+        return created
+
 class Rating(models.Model):
     """评分模型"""
     user_id = models.IntegerField(verbose_name='用户ID', db_index=True)
@@ -82,6 +230,8 @@ class Rating(models.Model):
     timestamp = models.DateTimeField(verbose_name='评分时间')
     comment = models.TextField(blank=True, null=True, verbose_name='评论内容')
 
+    objects = RatingManager()
+
     class Meta:
         verbose_name = '评分'
         verbose_name_plural = '评分'
@@ -94,9 +244,53 @@ class Rating(models.Model):
     def __str__(self):
         return f"User {self.user_id} -> Restaurant {self.restaurant.name}"
 
+    def _stored_ratings(self):
+        """读取数据库中当前保存的餐厅ID及各项评分"""
+        if self.pk is None or self._state.adding:
+            return None
+        return Rating.objects.filter(pk=self.pk).values(
+            'restaurant_id', *RATING_AGGREGATE_FIELDS
+        ).first()
+
+    def _refresh_restaurant(self):
+        """同步已加载的餐厅对象上的聚合字段"""
+        if Rating.restaurant.is_cached(self):
+            self.restaurant.refresh_from_db(fields=[
+                'review_count', 'popularity_score',
+                *(f for fields in RATING_AGGREGATE_FIELDS.values() for f in fields)
+            ])
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.restaurant.update_ratings()
+        with transaction.atomic():
+            previous = self._stored_ratings()
+            # 供 post_save 信号使用：评分改到其他餐厅时，原餐厅的缓存也要失效
+            self._previous_restaurant_id = previous['restaurant_id'] if previous else None
+            super().save(*args, **kwargs)
+            
+            current = {f: getattr(self, f) for f in RATING_AGGREGATE_FIELDS}
+            if previous is None:
+                Restaurant.adjust_ratings(self.restaurant_id, 1, current)
+            elif previous['restaurant_id'] == self.restaurant_id:
+                Restaurant.adjust_ratings(self.restaurant_id, 0, {
+                    f: current[f] - previous[f] for f in RATING_AGGREGATE_FIELDS
+                })
+            else:
+                Restaurant.adjust_ratings(previous['restaurant_id'], -1, {
+                    f: -previous[f] for f in RATING_AGGREGATE_FIELDS
+                })
+                Restaurant.adjust_ratings(self.restaurant_id, 1, current)
+        self._refresh_restaurant()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            previous = self._stored_ratings()
+            result = super().delete(*args, **kwargs)
+            if previous is not None:
+                Restaurant.adjust_ratings(previous['restaurant_id'], -1, {
+                    f: -previous[f] for f in RATING_AGGREGATE_FIELDS
+                })
+        self._refresh_restaurant()
+        return result
 
 class RestaurantLink(models.Model):
     """餐厅关联模型"""
@@ -118,6 +312,31 @@ class RestaurantLink(models.Model):
         verbose_name = '餐厅关联'
         verbose_name_plural = '餐厅关联'
         unique_together = ('source', 'target')
+        indexes = [
+            models.Index(fields=['source', '-weight']),
+        ]
 
     def __str__(self):
         return f"{self.source.name} -> {self.target.name}"
+
+class UserRecommendation(models.Model):
+    """预先计算的用户个性化推荐（由 materialize_recommendations 命令生成）"""
+    user_id = models.IntegerField(verbose_name='用户ID')
+    restaurant = models.ForeignKey(
+        Restaurant,
+        on_delete=models.CASCADE,
+        related_name='user_recommendations',
+        verbose_name='推荐餐厅'
+    )
+    rank = models.PositiveSmallIntegerField(verbose_name='排名')
+    score = models.FloatField(verbose_name='预测评分')
+    version = models.IntegerField(verbose_name='生成批次', db_index=True)
+    created_at = models.DateTimeField(verbose_name='生成时间')
+
+    class Meta:
+        verbose_name = '用户推荐'
+        verbose_name_plural = '用户推荐'
+        unique_together = ('user_id', 'rank')
+
+    def __str__(self):
+        return f"User {self.user_id} #{self.rank} -> Restaurant {self.restaurant_id}"
@@ -0,0 +1,179 @@
+"""餐厅全文搜索（名称 + 评论）
+
+使用 SQLite FTS5，每家餐厅一行文档（name、comments 两列），rowid 即 rest_id，
+排序使用 FTS5 的 rank 列，迁移中已将其配置为 bm25(10.0, 1.0)（名称列权重更高）。FTS5 自带的分词器不会切分中文，因此写入和查询前
+先在 Python 中预分词：连续的中文切成相邻两字（bigram），并在末尾补上最后一个字，
+使每个字都是某个词元的开头；字母数字按单词切分。查询时每段中文转换为由 bigram
+组成的短语（相邻匹配，相当于子串匹配），单个字用前缀查询。
+
+索引由 build_search_index 命令按评分ID水位增量更新：只重建水位之后有新评分的
+餐厅以及尚未入索引的餐厅。评分的修改和删除需要用 --full 全量重建：新索引写入影子表，
+写完后在一个事务中替换旧表，重建期间的搜索仍使用完整的旧索引。
+
+SQLite 没有编译 FTS5 时迁移不会创建搜索表，available 为 False，搜索退回名称模糊匹配。
+"""
+from django.db import connections, transaction
+import re
+from .models import Rating, Restaurant
+
+SEARCH_TABLE = 'recommender_restaurant_search'
+SHADOW_TABLE = f'{SEARCH_TABLE}_rebuild'
+STATE_TABLE = 'recommender_search_state'
+
+_TOKEN_RE = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+|[0-9a-z]+')
+_CJK_RE = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]')
+
+
+def _bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text):
+    """预分词，返回空格分隔的词元"""
+    tokens = []
+    for run in _TOKEN_RE.findall((text or '').lower()):
+        if _CJK_RE.match(run):
+            tokens.extend(_bigrams(run))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return ' '.join(tokens)
+
+
+def build_match_query(query):
+    """把用户输入转换为 FTS5 MATCH 表达式，没有可搜索内容时返回None"""
+    parts = []
+    for run in _TOKEN_RE.findall((query or '').lower()):
+        if _CJK_RE.match(run) and len(run) > 1:
+            parts.append('"{}"'.format(' '.join(_bigrams(run))))
+        else:
+            parts.append(f'"{run}"*')
+    return ' AND '.join(parts) or None
+
+
+class RestaurantSearchIndex:
+    """FTS5 搜索索引的读写"""
+
+    # 各数据库别名的搜索表是否存在（迁移之后不会改变）
+    _available = {}
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.connection = connections[using]
+
+    @property
+    def available(self):
+        """搜索表是否存在：只有支持 FTS5 的 SQLite 会在迁移中创建"""
+        if self.using not in self._available:
+            self._available[self.using] = (
+                self.connection.vendor == 'sqlite'
+                and SEARCH_TABLE in self.connection.introspection.table_names()
+            )
+        return self._available[self.using]
+
+    def _create_table(self, cursor, table):
+        """创建 FTS5 表，与迁移 0005 中的定义相同"""
+        cursor.execute(f"CREATE VIRTUAL TABLE {table} USING fts5(name, comments, tokenize='unicode61', prefix='1')")
+        cursor.execute(f"INSERT INTO {table}({table}, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+
+    def watermark(self):
+        """已入索引的最大评分ID"""
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SELECT value FROM {STATE_TABLE} WHERE name = 'rating_watermark'")
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _set_watermark(self, cursor, value):
+        cursor.execute(
+            f"INSERT OR REPLACE INTO {STATE_TABLE} (name, value) VALUES ('rating_watermark', %s)",
+            [value]
+        )
+
+    def pending_restaurants(self):
+        """需要（重新）建索引的餐厅：水位之后有新评分的，以及尚未入索引的"""
+        watermark = self.watermark()
+        changed = set(
+            Rating.objects.filter(id__gt=watermark).values_list('restaurant_id', flat=True).distinct()
+        )
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rest_id FROM {Restaurant._meta.db_table} '
+                f'WHERE rest_id NOT IN (SELECT rowid FROM {SEARCH_TABLE})'
+            )
+            changed.update(row[0] for row in cursor.fetchall())
+        return sorted(changed)
+
+    def update(self, full=False, batch_size=1000, progress=None):
+        """增量（或全量）更新索引，返回重建的餐厅数
+
+        progress(完成数, 总数) 在每批写入后调用。
+        """
+        # 先记下水位，之后新增的评分留给下一次更新
+        new_watermark = Rating.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        if full:
+            # 全量重建写入影子表，最后再替换，重建期间搜索仍使用旧索引
+            table = SHADOW_TABLE
+            with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS {SHADOW_TABLE}')
+                self._create_table(cursor, SHADOW_TABLE)
+            rest_ids = list(Restaurant.objects.order_by('rest_id').values_list('rest_id', flat=True))
+        else:
+            table = SEARCH_TABLE
+            rest_ids = self.pending_restaurants()
+            # 删除已不存在的餐厅
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {SEARCH_TABLE} '
+                    f'WHERE rowid NOT IN (SELECT rest_id FROM {Restaurant._meta.db_table})'
+                )
+
+        for start in range(0, len(rest_ids), batch_size):
+            batch = rest_ids[start:start + batch_size]
+            with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+                self._index_batch(cursor, batch, new_watermark, table)
+            if progress:
+                progress(min(start + batch_size, len(rest_ids)), len(rest_ids))
+
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            if full:
+                # 合并内部的 b-tree 段（加快查询）后替换旧表
+                cursor.execute(f"INSERT INTO {SHADOW_TABLE}({SHADOW_TABLE}) VALUES ('optimize')")
+                cursor.execute(f'DROP TABLE {SEARCH_TABLE}')
+                cursor.execute(f'ALTER TABLE {SHADOW_TABLE} RENAME TO {SEARCH_TABLE}')
+            self._set_watermark(cursor, new_watermark)
+        return len(rest_ids)
+
+    def _index_batch(self, cursor, rest_ids, max_rating_id, table=SEARCH_TABLE):
+        """重建一批餐厅的文档"""
+        names = dict(Restaurant.objects.filter(rest_id__in=rest_ids).values_list('rest_id', 'name'))
+        comments = {}
+        for restaurant_id, comment in Rating.objects.filter(
+            restaurant_id__in=rest_ids, id__lte=max_rating_id
+        ).exclude(comment__isnull=True).exclude(comment='').values_list('restaurant_id', 'comment').iterator():
+            comments.setdefault(restaurant_id, []).append(tokenize(comment))
+
+        cursor.executemany(f'DELETE FROM {table} WHERE rowid = %s', [(r,) for r in rest_ids])
+        cursor.executemany(
+            f'INSERT INTO {table} (rowid, name, comments) VALUES (%s, %s, %s)',
+            [
+                (rest_id, tokenize(name), ' '.join(comments.get(rest_id, ())))
+                for rest_id, name in names.items()
+            ]
+        )
+
+    def search(self, query, offset=0, limit=20):
+        """搜索餐厅，返回(匹配总数, [(rest_id, 得分)])，得分越高越相关"""
+        match = build_match_query(query)
+        if match is None:
+            return 0, []
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', [match])
+            total = cursor.fetchone()[0]
+            cursor.execute(
+                f'SELECT rowid, rank FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY rank LIMIT %s OFFSET %s',
+                [match, limit, offset]
+            )
+            # bm25 越小越相关，取负数作为得分
+            hits = [(rest_id, -rank) for rest_id, rank in cursor.fetchall()]
+        return total, hits
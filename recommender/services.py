@@ -2,95 +2,347 @@ from .algorithms.base import (
     PopularityRecommender,
     ContentBasedRecommender,
     CollaborativeRecommender,
+    MatrixFactorizationRecommender,
     HybridRecommender
 )
-from .models import Restaurant, Rating
+from .algorithms.ann import FEATURE_FIELDS as ANN_FEATURE_FIELDS, get_ann_index
+from .algorithms.batch import align_rated_items, init_worker, iter_chunks, map_ordered, top_n_for_users
+from .algorithms.factorization import get_mf_model
+from .algorithms.keywords import get_keyword_index
+from .algorithms.matrix import get_rating_matrix
+from .cache import cached_method
+from .hydration import hydrate_restaurants, load_restaurants, pack_restaurants
+from .leaderboards import get_leaderboards
+from .models import Restaurant, Rating, RestaurantLink, UserRecommendation
+from .search import RestaurantSearchIndex
 from django.db.models import Avg, Count, F, Func, Value, FloatField
 from django.db.models.functions import Abs
 from django.core.cache import cache
+from django.utils import timezone
+from functools import partial
 import numpy as np
 
+# 首页评分榜：标题 -> 平均分字段
+HOMEPAGE_TOP_RATED = (
+    ('综合评分最高', 'avg_rating'),
+    ('口味最佳', 'avg_flavor_rating'),
+    ('环境优雅', 'avg_env_rating'),
+    ('服务贴心', 'avg_service_rating'),
+)
+
+# get_top_rated_by_category 的维度名 -> 平均分字段
+TOP_RATED_CATEGORIES = (
+    ('overall', 'avg_rating'),
+    ('flavor', 'avg_flavor_rating'),
+    ('environment', 'avg_env_rating'),
+    ('service', 'avg_service_rating'),
+)
+
+# 各季节首页推荐使用的关键词
+SEASON_KEYWORDS = {
+    '春': ['春笋', '春卷', '清淡', '养生'],
+    '夏': ['冷面', '凉菜', '冰品', '烧烤'],
+    '秋': ['螃蟹', '牛肉', '火锅', '秋葵'],
+    '冬': ['火锅', '暖锅', '羊肉', '炖汤'],
+}
+
+
+def season_of_month(month):
+    """月份对应的季节"""
+    if month in [3, 4, 5]:
+        return '春'
+    elif month in [6, 7, 8]:
+        return '夏'
+    elif month in [9, 10, 11]:
+        return '秋'
+    return '冬'
+
+
+class HomepageSnapshot:
+    """首页各板块（季节推荐、热门餐厅、各维度评分榜）的快照，整体缓存"""
+
+    def __init__(self, season, season_keywords, seasonal_restaurants, popular_restaurants, top_rated, created_at):
+        self.season = season
+        self.season_keywords = season_keywords
+        self.seasonal_restaurants = seasonal_restaurants
+        self.popular_restaurants = popular_restaurants
+        self.top_rated = top_rated
+        self.created_at = created_at
+
+    def _sections(self):
+        return {
+            'seasonal_restaurants': self.seasonal_restaurants,
+            'popular_restaurants': self.popular_restaurants,
+            'top_rated': self.top_rated,
+        }
+
+    def _with_sections(self, sections):
+        return HomepageSnapshot(
+            self.season, self.season_keywords, sections['seasonal_restaurants'],
+            sections['popular_restaurants'], sections['top_rated'], self.created_at
+        )
+
+    def pack(self):
+        """写入缓存的紧凑形式：各板块只保存餐厅ID"""
+        return self._with_sections(pack_restaurants(self._sections()))
+
+    def hydrate(self):
+        """从缓存读取后还原各板块的餐厅（一次查询）"""
+        return self._with_sections(hydrate_restaurants(self._sections()))
+
+    def as_context(self):
+        """模板上下文"""
+        return {
+            'current_season': self.season,
+            'season_keywords': self.season_keywords,
+            'seasonal_restaurants': self.seasonal_restaurants,
+            'popular_restaurants': self.popular_restaurants,
+            'top_rated': self.top_rated,
+        }
+
 class RecommenderService:
     def __init__(self):
         self.popularity_rec = PopularityRecommender()
         self.content_rec = ContentBasedRecommender()
         self.collab_rec = CollaborativeRecommender()
+        self.mf_rec = MatrixFactorizationRecommender()
         self.hybrid_rec = HybridRecommender()
 
+    @cached_method(timeout=600, pack=partial(pack_restaurants, attrs=('popularity_score',)), unpack=hydrate_restaurants)
     def get_popular_restaurants(self, limit=4):
-        """获取热门餐厅"""
+        """获取热门餐厅（按热度得分，与 PopularityRecommender 相同）"""
         try:
-            return Restaurant.objects.filter(
-                review_count__gte=10
-            ).exclude(
-                name__iexact='nan'
-            ).annotate(
-                popularity_score=(F('avg_rating') * F('review_count'))
-            ).order_by(
-                '-popularity_score'
-            )[:limit]
+            return self.popularity_rec.recommend(n_recommendations=limit)
         except Exception as e:
             print(f"Error in get_popular_restaurants: {e}")
             return Restaurant.objects.none()
 
     def get_similar_restaurants(self, restaurant_id, limit=6):
-        """获取相似餐厅"""
+        """获取相似餐厅：优先读取 build_restaurant_links 预先计算的相似餐厅（附带 similarity_score），
+        该餐厅没有关联记录时退回实时计算"""
+        links = RestaurantLink.objects.filter(
+            source=restaurant_id
+        ).select_related('target').order_by('-weight')[:limit]
+        restaurants = []
+        for link in links:
+            link.target.similarity_score = link.weight
+            restaurants.append(link.target)
+        if restaurants:
+            return restaurants
         return self.content_rec.recommend(restaurant_id=restaurant_id, n_recommendations=limit)
 
     def get_personalized_recommendations(self, user_id, limit=6):
-        """获取个性化推荐"""
+        """获取个性化推荐：优先使用离线训练的矩阵分解模型，模型中没有该用户时退回协同过滤"""
+        recommendations = self.mf_rec.recommend(user_id=user_id, n_recommendations=limit)
+        if recommendations:
+            return recommendations
         return self.collab_rec.recommend(user_id=user_id, n_recommendations=limit)
 
+    def get_stored_recommendations(self, user_id, current_restaurant_id=None, limit=6):
+        """读取预先计算的推荐，过滤用户已评分的餐厅和当前餐厅
+
+        用户不在推荐表中（或过滤后为空）时返回None，由调用方决定如何兜底。
+        """
+        recommendations = UserRecommendation.objects.filter(
+            user_id=user_id
+        ).exclude(
+            restaurant_id__in=Rating.objects.filter(user_id=user_id).values('restaurant_id')
+        )
+        if current_restaurant_id:
+            recommendations = recommendations.exclude(restaurant_id=current_restaurant_id)
+        restaurants = [
+            r.restaurant for r in recommendations.select_related('restaurant').order_by('rank')[:limit]
+        ]
+        return restaurants or None
+
+    @cached_method(timeout=1800, scopes=lambda user_id, **kwargs: [f'user:{user_id}'],
+                   pack=partial(pack_restaurants, attrs=('match_score',)), unpack=hydrate_restaurants)
+    def get_user_recommendations(self, user_id, current_restaurant_id=None, limit=6):
+        """页面使用的个性化推荐：优先读取预计算结果，缺失时再实时计算"""
+        restaurants = self.get_stored_recommendations(user_id, current_restaurant_id, limit)
+        if restaurants is not None:
+            return restaurants
+        return self.get_personalized_recommendations_fast(
+            user_id=user_id,
+            current_restaurant_id=current_restaurant_id,
+            limit=limit
+        )
+
+    def get_batch_recommendations(self, user_ids, limit=10, chunk_size=1000, workers=1):
+        """批量获取个性化推荐
+
+        user_ids 可以是列表或迭代器，按块读取；每块用户的预测评分通过一次矩阵乘法
+        （用户因子 @ 餐厅因子ᵀ）计算，workers 大于1时分发到进程池。
+        按输入顺序逐个产出 {'user_id', 'restaurants', 'scores', 'source'}；
+        模型中没有的用户退回热门餐厅，source 为 'popular'。
+        """
+        fallback = [r.rest_id for r in self.get_popular_restaurants(limit)]
+        model = get_mf_model()
+        if model is None:
+            for user_id in user_ids:
+                yield {'user_id': user_id, 'restaurants': fallback, 'scores': None, 'source': 'popular'}
+            return
+
+        rated_indptr, rated_indices = align_rated_items(model, get_rating_matrix())
+        valid_ids = self.mf_rec.filter_valid_restaurants(Restaurant.objects.all()).values_list('rest_id', flat=True)
+        candidate_mask = np.isin(model.restaurant_ids, np.fromiter(valid_ids.iterator(), dtype=np.int64))
+
+        def tasks():
+            for chunk in iter_chunks(user_ids, chunk_size):
+                rows = model.user_index.lookup(np.array(chunk, dtype=np.int64))
+                yield (chunk, rows), rows[rows >= 0]
+
+        results = map_ordered(
+            partial(top_n_for_users, n=limit), tasks(), workers=workers,
+            initializer=init_worker,
+            initargs=(model.user_factors, model.item_factors, rated_indptr, rated_indices, candidate_mask)
+        )
+        for (chunk, rows), (columns, scores) in results:
+            known = 0
+            for user_id, row in zip(chunk, rows.tolist()):
+                if row < 0:
+                    yield {'user_id': user_id, 'restaurants': fallback, 'scores': None, 'source': 'popular'}
+                    continue
+                valid = scores[known] > -np.inf
+                yield {
+                    'user_id': user_id,
+                    'restaurants': model.restaurant_ids[columns[known][valid]].tolist(),
+                    'scores': scores[known][valid].tolist(),
+                    'source': 'mf'
+                }
+                known += 1
+
     def get_hybrid_recommendations(self, user_id=None, restaurant_id=None, limit=6):
-        """获取混合推荐"""
+        """获取混合推荐，按得分排序的餐厅列表；各阶段耗时见 self.hybrid_rec.last_timings"""
         return self.hybrid_rec.recommend(
             user_id=user_id,
             restaurant_id=restaurant_id,
             n_recommendations=limit
         )
 
+    @cached_method(timeout=600, scopes=lambda **kwargs: ['homepage'],
+                   pack=HomepageSnapshot.pack, unpack=HomepageSnapshot.hydrate)
+    def get_homepage_snapshot(self, month):
+        """计算首页各板块，结果为 HomepageSnapshot
+
+        快照按时间过期（10分钟），单条评分变化不会使其失效，否则写入频繁时几乎每个请求
+        都要重新计算；可以由 refresh_homepage 命令定时预热，离线任务完成后随 global 失效。
+        """
+        season = season_of_month(month)
+        season_keywords = SEASON_KEYWORDS[season]
+        valid = Restaurant.objects.exclude(name__iexact='nan')
+
+        # 季节推荐：名称包含季节关键词（通过关键词索引查找，不扫描名称）、4分以上的餐厅，
+        # 不足6个时补充高评分餐厅
+        seasonal_restaurants = self.top_restaurants_among(
+            get_keyword_index().search_any(season_keywords).tolist(),
+            valid.filter(review_count__gt=0, avg_rating__gte=4.0),
+            '-avg_rating', 6
+        )
+        if len(seasonal_restaurants) < 6:
+            seasonal_restaurants += list(valid.filter(
+                review_count__gt=0,
+                avg_rating__gte=4.5
+            ).exclude(
+                rest_id__in=[r.rest_id for r in seasonal_restaurants]
+            ).order_by('-avg_rating')[:6 - len(seasonal_restaurants)])
+
+        popular_restaurants = list(valid.filter(review_count__gt=0).order_by('-review_count')[:6])
+
+        top_rated = self.top_rated_lists(HOMEPAGE_TOP_RATED, 6, min_reviews=1)
+
+        return HomepageSnapshot(
+            season, season_keywords, seasonal_restaurants, popular_restaurants, top_rated, timezone.now()
+        )
+
+    def search_restaurants(self, query, page=1, page_size=20):
+        """按名称和评论全文搜索餐厅，按相关度排序并分页
+
+        返回 {'total': 匹配总数, 'restaurants': 当前页的餐厅列表（附带 search_score 属性）}，
+        餐厅从进程内目录读取。
+        数据库不支持 FTS5 时退回按名称模糊匹配、按评论数排序。
+        """
+        offset = (page - 1) * page_size
+        index = RestaurantSearchIndex()
+        if not index.available:
+            matches = Restaurant.objects.filter(name__icontains=query).order_by('-review_count', 'rest_id')
+            return {'total': matches.count(), 'restaurants': list(matches[offset:offset + page_size])}
+
+        total, hits = index.search(query, offset=offset, limit=page_size)
+        restaurants = load_restaurants([rest_id for rest_id, _ in hits])
+        results = []
+        for rest_id, score in hits:
+            restaurant = restaurants.get(rest_id)
+            if restaurant is not None:
+                restaurant.search_score = score
+                results.append(restaurant)
+        return {'total': total, 'restaurants': results}
+
+    def top_restaurants_among(self, rest_ids, queryset, order_field, limit, max_in=500):
+        """在给定的餐厅ID中按字段排序取前limit个，排序相同时按 rest_id 升序
+
+        ID不多时用一条 rest_id IN 查询；ID很多时（常见关键词可能命中数万家餐厅）不再拆成
+        大量 IN 查询，而是按排序字段顺序流式读取 queryset，取前limit个属于给定ID的餐厅，
+        命中的餐厅越多越早结束，始终只执行一条查询。
+        """
+        if len(rest_ids) <= max_in:
+            return list(queryset.filter(rest_id__in=rest_ids).order_by(order_field, 'rest_id')[:limit])
+        wanted = set(rest_ids)
+        result = []
+        if limit <= 0:
+            return result
+        for restaurant in queryset.order_by(order_field, 'rest_id').iterator(chunk_size=max_in):
+            if restaurant.rest_id in wanted:
+                result.append(restaurant)
+                if len(result) >= limit:
+                    break
+        return result
+
     def get_top_rated_by_category(self, limit_per_category=5):
-        """获取各评分维度的最佳餐厅"""
+        """获取各评分维度的最佳餐厅（评论数不少于10条）"""
+        return self.top_rated_lists(TOP_RATED_CATEGORIES, limit_per_category, min_reviews=10)
+
+    def top_rated_lists(self, categories, limit, min_reviews):
+        """从进程内排行榜一次取出各维度的前limit家餐厅
+
+        categories 为 (名称, 平均分字段) 序列，返回 {名称: 餐厅列表}；餐厅从进程内目录读取。
+        """
+        top = get_leaderboards(min_reviews).top(limit)
+        restaurants = load_restaurants(sorted({r for field in top for r in top[field]}))
         return {
-            'overall': Restaurant.objects.filter(review_count__gte=10).order_by('-avg_rating')[:limit_per_category],
-            'flavor': Restaurant.objects.filter(review_count__gte=10).order_by('-avg_flavor_rating')[:limit_per_category],
-            'environment': Restaurant.objects.filter(review_count__gte=10).order_by('-avg_env_rating')[:limit_per_category],
-            'service': Restaurant.objects.filter(review_count__gte=10).order_by('-avg_service_rating')[:limit_per_category]
+            name: [restaurants[r] for r in top[field] if r in restaurants]
+            for name, field in categories
         }
 
+    @cached_method(timeout=3600, scopes=lambda restaurant_id, **kwargs: [f'restaurant:{restaurant_id}'],
+                   pack=partial(pack_restaurants, attrs=('similarity_score',)), unpack=hydrate_restaurants)
     def get_similar_restaurants_fast(self, restaurant_id, limit=4):
-        """快速获取相似餐厅"""
+        """快速获取相似餐厅
+
+        相似度得分 = 5 - 四个平均评分维度的L1距离 / 4，在近似最近邻索引上查询，
+        按得分、平均分降序返回餐厅列表（附带 similarity_score 属性）。
+        """
         try:
             # 1. 获取当前餐厅
             target = Restaurant.objects.get(rest_id=restaurant_id)
-            
-            # 2. 使用预计算的评分数据快速筛选
-            similar_restaurants = Restaurant.objects.filter(
-                review_count__gte=10  # 只考虑有足够评价的餐厅
-            ).exclude(
-                rest_id=restaurant_id
-            ).exclude(
-                name__iexact='nan'
-            ).annotate(
-                # 使用 Abs 函数计算差异
-                rating_diff=Abs(F('avg_rating') - target.avg_rating),
-                flavor_diff=Abs(F('avg_flavor_rating') - target.avg_flavor_rating),
-                env_diff=Abs(F('avg_env_rating') - target.avg_env_rating),
-                service_diff=Abs(F('avg_service_rating') - target.avg_service_rating)
-            ).annotate(
-                # 计算综合相似度得分
-                similarity_score=Value(5.0, output_field=FloatField()) - (
-                    F('rating_diff') + 
-                    F('flavor_diff') + 
-                    F('env_diff') + 
-                    F('service_diff')
-                ) / 4.0
-            ).filter(
-                similarity_score__gt=0
-            ).order_by('-similarity_score', '-avg_rating')[:limit]
-            
+
+            # 2. 在索引中查询L1距离最近的餐厅
+            index = get_ann_index()
+            vector = np.array([getattr(target, f) or 0 for f in ANN_FEATURE_FIELDS], dtype=np.float64)
+            rest_ids, distances = index.query(vector, k=limit, exclude_id=target.rest_id)
+
+            # 3. 只保留得分为正的餐厅，按索引返回的顺序加载
+            scores = 5.0 - distances / 4.0
+            keep = scores > 0
+            restaurants = Restaurant.objects.in_bulk(rest_ids[keep].tolist())
+            similar_restaurants = []
+            for rest_id, score in zip(rest_ids[keep].tolist(), scores[keep].tolist()):
+                restaurant = restaurants.get(rest_id)
+                if restaurant is not None:
+                    restaurant.similarity_score = score
+                    similar_restaurants.append(restaurant)
             return similar_restaurants
-            
+
         except Restaurant.DoesNotExist:
             return Restaurant.objects.none()
         except Exception as e:
@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .cache import invalidate_ratings
+from .models import Rating
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, **kwargs):
+    """评分新增或修改：相关餐厅（包括改动前的餐厅）、用户的缓存失效，记录变化的餐厅"""
+    previous_restaurant_id = getattr(instance, '_previous_restaurant_id', None)
+    if previous_restaurant_id == instance.restaurant_id:
+        previous_restaurant_id = None
+    invalidate_ratings([instance.user_id], [instance.restaurant_id, previous_restaurant_id])
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    """评分删除：相关餐厅、用户的缓存失效，记录变化的餐厅"""
+    invalidate_ratings([instance.user_id], [instance.restaurant_id])
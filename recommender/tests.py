@@ -1,3 +1,1272 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from django.db.utils import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.timezone import make_aware
+from concurrent.futures import Future
+from datetime import datetime
+from functools import partial
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+import importlib
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import tempfile
+import threading
+import time
+from .algorithms.ann import L1LSHIndex, key_multipliers
+from .algorithms.base import CollaborativeRecommender, ContentBasedRecommender, HybridRecommender, PopularityRecommender
+from .algorithms.keywords import KeywordIndex, reset_keyword_index
+from .algorithms.matrix import (
+    RatingMatrix, RestaurantFeatureMatrix, get_feature_matrix, get_rating_matrix, publish_feature_matrix,
+    reset_feature_matrix, reset_rating_matrix,
+)
+from .algorithms.factorization import (
+    MatrixFactorizationModel, _plan_blocks, get_mf_model, reset_mf_model, train_als,
+)
+from .artifacts import ArtifactHandle, ArtifactStore
+from .bulk_load import SQLiteBulkLoader
+from .cache import RecommenderCache, recommender_cache
+from .checks import check_shared_cache
+from .catalogue import RATING_FIELDS, RestaurantCatalogue, get_catalogue, reset_catalogue
+from .leaderboards import LEADERBOARD_FIELDS, RatingLeaderboards, get_leaderboards, reset_leaderboards
+from .management.commands.import_restaurant_data import Command as ImportCommand, RATING_DEFAULTS
+from .models import Rating, Restaurant, RestaurantLink, UserRecommendation, popularity_score
+from .search import RestaurantSearchIndex
+from . import views
+from .services import HOMEPAGE_TOP_RATED, SEASON_KEYWORDS, RecommenderService, season_of_month
 
-# Create your tests here.
+
+def write_import_files(data_dir, n_restaurants=6, n_users=8):
+    """写入一组小的 restaurants/ratings/links CSV，返回评分条数"""
+    with open(os.path.join(data_dir, 'restaurants.csv'), 'w', encoding='utf-8') as f:
+        f.write('restId,name\n')
+        for rest_id in range(1, n_restaurants + 1):
+            f.write(f'{rest_id},火锅{rest_id}\n')
+    with open(os.path.join(data_dir, 'links.csv'), 'w', encoding='utf-8') as f:
+        f.write('restId,dianpingId\n')
+        for rest_id in range(1, n_restaurants + 1):
+            f.write(f'{rest_id},{5000000 + rest_id}\n')
+    count = 0
+    with open(os.path.join(data_dir, 'ratings.csv'), 'w', encoding='utf-8') as f:
+        f.write('userId,restId,rating,rating_env,rating_flavor,rating_service,timestamp,comment\n')
+        for user_id in range(1, n_users + 1):
+            for rest_id in range(1, n_restaurants + 1):
+                if (user_id + rest_id) % 3:
+                    score = (user_id * rest_id) % 5 + 1
+                    f.write(f'{user_id},{rest_id},{score},{score},{6 - score},3,{1300000000000 + count * 1000},好吃\n')
+                    count += 1
+    return count
+
+
+def rating_index_names():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+            [Rating._meta.db_table]
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+class Killed(BaseException):
+    """模拟进程被杀死"""
+
+
+class StreamingImportResumeTests(TransactionTestCase):
+    """流式导入中途被杀死后续传：评分表的索引必须恢复"""
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('仅适用于 SQLite 加载器')
+        self.data_dir = tempfile.mkdtemp()
+        self.artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, self.artifact_dir, ignore_errors=True)
+        self.n_ratings = write_import_files(self.data_dir)
+
+    def run_import(self, *args):
+        with override_settings(RECOMMENDER_ARTIFACT_DIR=self.artifact_dir):
+            call_command(
+                'import_restaurant_data', '--data-dir', self.data_dir, '--chunksize', '5', *args,
+                stdout=StringIO(), stderr=StringIO()
+            )
+
+    def test_resume_after_kill_restores_indexes(self):
+        expected = rating_index_names()
+        original_load = SQLiteBulkLoader.load
+        calls = []
+
+        def load_then_die(loader, df, ignore_conflicts=False):
+            if calls:
+                raise Killed()
+            calls.append(1)
+            return original_load(loader, df, ignore_conflicts)
+
+        # 被杀死的进程不会执行加载会话的收尾代码
+        with mock.patch.object(SQLiteBulkLoader, 'load', load_then_die), \
+                mock.patch.object(SQLiteBulkLoader, '_restore_indexes'), \
+                self.assertRaises(Killed):
+            self.run_import('--streaming')
+        self.assertLess(rating_index_names(), expected)
+        self.assertEqual(Rating.objects.count(), 5)
+
+        self.run_import('--resume')
+        self.assertEqual(rating_index_names(), expected)
+        self.assertEqual(Rating.objects.count(), self.n_ratings)
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, '.import_checkpoint.json')))
+        restaurant = Restaurant.objects.get(pk=1)
+        self.assertEqual(restaurant.review_count, Rating.objects.filter(restaurant=restaurant).count())
+
+    def test_bulk_import_applies_pragmas_before_the_transaction(self):
+        expected = rating_index_names()
+        with CaptureQueriesContext(connection) as queries:
+            self.run_import()
+        executed = [query['sql'] for query in queries]
+        self.assertIn('PRAGMA journal_mode = WAL', executed)
+        self.assertIn('PRAGMA synchronous = NORMAL', executed)
+        self.assertLess(executed.index('PRAGMA synchronous = NORMAL'), executed.index('BEGIN'))
+        self.assertEqual(rating_index_names(), expected)
+        self.assertEqual(Rating.objects.count(), self.n_ratings)
+
+
+    def snapshot(self):
+        ratings = list(Rating.objects.order_by('user_id', 'restaurant_id').values_list(
+            'user_id', 'restaurant_id', 'rating', 'rating_env', 'rating_flavor', 'rating_service', 'timestamp', 'comment'
+        ))
+        restaurants = list(Restaurant.objects.order_by('rest_id').values_list(
+            'rest_id', 'name', 'dianping_id', *AGGREGATE_FIELDS
+        ))
+        return ratings, restaurants
+
+    def test_streaming_import_matches_bulk_import(self):
+        # 缺失的评分维度和评论按默认值填充，两种路径的结果必须相同
+        with open(os.path.join(self.data_dir, 'ratings.csv'), 'a', encoding='utf-8') as f:
+            f.write('9,1,4,,5,,1400000000000,\n')
+            f.write('9,2,3,2,2,2,1400000001500,\n')
+        self.run_import()
+        bulk = self.snapshot()
+        self.assertEqual(len(bulk[0]), self.n_ratings + 2)
+
+        self.run_import('--streaming')
+        self.assertEqual(self.snapshot(), bulk)
+
+
+class L1LSHIndexTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.features = rng.uniform(1, 5, size=(200, 4))
+        self.ids = np.arange(1, 201)
+
+    def test_more_projections_than_fixed_multipliers(self):
+        for n_projections in (5, 6, 8):
+            self.assertEqual(len(set(key_multipliers(n_projections).tolist())), n_projections)
+            index = L1LSHIndex.build(self.ids, self.features, self.features[:, 0], n_projections=n_projections)
+            ids, _ = index.query(self.features[0], k=4, exclude_id=1)
+            self.assertEqual(len(ids), 4)
+
+    def test_query_matches_exact_when_candidates_cover_all(self):
+        index = L1LSHIndex.build(self.ids, self.features, self.features[:, 0], bucket_width=100.0)
+        for position in range(0, 200, 20):
+            approx = index.query(self.features[position], k=4, exclude_id=int(self.ids[position]))
+            exact = index.exact(self.features[position], k=4, exclude_id=int(self.ids[position]))
+            np.testing.assert_array_equal(approx[0], exact[0])
+
+    def test_invalid_parameters(self):
+        with self.assertRaises(ValueError):
+            L1LSHIndex.build(self.ids, self.features, self.features[:, 0], n_projections=0)
+
+
+class ArtifactStoreTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.store = ArtifactStore(root)
+
+    def test_concurrent_publishers_in_the_same_second(self):
+        errors, versions = [], []
+
+        def publish(value):
+            try:
+                versions.append(self.store.publish('test', {'x': np.full(3, value)}, keep=20))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch('time.strftime', return_value='20240101000000'):
+            threads = [threading.Thread(target=publish, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(versions)), 8)
+        self.assertEqual(self.store.versions('test'), sorted(versions))
+        self.assertIn(self.store.current_version('test'), versions)
+
+    def test_handle_builds_in_memory_without_publishing(self):
+        handle = ArtifactHandle('test', lambda artifact: (artifact.version, artifact['x'].tolist()),
+                                build=lambda: ({'x': np.arange(3)}, {}), store=self.store)
+        self.assertEqual(handle.get(), (None, [0, 1, 2]))
+        self.assertIsNone(self.store.current_version('test'))
+        self.assertEqual(self.store.versions('test'), [])
+
+        version = self.store.publish('test', {'x': np.arange(2)})
+        self.assertEqual(handle.get(), (version, [0, 1]))
+
+
+def reference_als(matrix, n_factors, reg, iterations, seed):
+    """逐行求解正规方程的ALS，用于核对分块批量求解的结果"""
+    def solve(indptr, indices, data, fixed):
+        result = np.zeros((len(indptr) - 1, n_factors))
+        for row in range(len(indptr) - 1):
+            lo, hi = indptr[row], indptr[row + 1]
+            if hi == lo:
+                continue
+            factors = fixed[indices[lo:hi]]
+            gram = factors.T @ factors + reg * (hi - lo) * np.eye(n_factors)
+            result[row] = np.linalg.solve(gram, factors.T @ data[lo:hi].astype(np.float64))
+        return result
+
+    item_factors = np.random.default_rng(seed).normal(scale=0.1, size=(matrix.n_restaurants, n_factors))
+    for _ in range(iterations):
+        user_factors = solve(matrix.indptr, matrix.indices, matrix.data, item_factors)
+        item_factors = solve(matrix.col_indptr, matrix.col_indices, matrix.col_data, user_factors)
+    return user_factors, item_factors
+
+
+class MatrixFactorizationTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        pairs = rng.choice(40 * 30, size=500, replace=False)
+        self.matrix = RatingMatrix(pairs // 30 + 1, pairs % 30 + 101, rng.integers(1, 6, size=500))
+
+    def test_blocked_als_matches_row_by_row_solve(self):
+        expected = reference_als(self.matrix, 4, 0.1, 3, seed=7)
+        for max_entries, n_threads in ((4096, 1), (16, 3)):
+            with mock.patch('recommender.algorithms.factorization._plan_blocks',
+                            partial(_plan_blocks, max_entries=max_entries)):
+                actual = train_als(self.matrix, n_factors=4, reg=0.1, iterations=3, n_threads=n_threads, seed=7)
+            np.testing.assert_allclose(actual[0], expected[0], rtol=1e-8, atol=1e-10)
+            np.testing.assert_allclose(actual[1], expected[1], rtol=1e-8, atol=1e-10)
+
+    def test_scores_and_top_n(self):
+        user_factors, item_factors = train_als(self.matrix, n_factors=4, iterations=3)
+        model = MatrixFactorizationModel(self.matrix.user_ids, self.matrix.restaurant_ids, user_factors, item_factors)
+        user_id = int(self.matrix.user_ids[5])
+        scores = model.score_user(user_id)
+        np.testing.assert_allclose(scores, model.item_factors @ model.user_factors[5], rtol=1e-6)
+        self.assertIsNone(model.score_user(999))
+
+        exclude = model.restaurant_ids[np.argsort(-scores)[:2]].tolist()
+        ids, top_scores = model.top_n(scores, 5, exclude_ids=exclude + [999])
+        ranked = sorted(
+            (-float(score), position) for position, score in enumerate(scores)
+            if int(model.restaurant_ids[position]) not in exclude
+        )[:5]
+        self.assertEqual(ids.tolist(), [int(model.restaurant_ids[position]) for _, position in ranked])
+        np.testing.assert_allclose(top_scores, [-score for score, _ in ranked])
+
+        # 同分时按餐厅在模型中的位置排序；n 超过可选数量时返回全部
+        ids, _ = model.top_n(np.ones(len(scores), dtype=np.float32), 100, exclude_ids=exclude)
+        self.assertEqual(ids.tolist(), [r for r in model.restaurant_ids.tolist() if r not in exclude])
+
+
+class TrainMatrixFactorizationTests(TestCase):
+    def setUp(self):
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        settings_override = override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_mf_model()
+        self.addCleanup(reset_mf_model)
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 5)])
+        for user_id, restaurant_id, score in [(1, 1, 5), (1, 2, 3), (2, 2, 4), (2, 3, 2), (3, 1, 4), (3, 4, 5)]:
+            rate(user_id, restaurant_id, score)
+
+    def test_train_mf_publishes_to_the_store_workers_read(self):
+        self.assertIsNone(get_mf_model())
+        call_command('train_mf', '--factors', '2', '--iterations', '3', '--threads', '1', stdout=StringIO())
+        model = get_mf_model()
+        self.assertIsNotNone(model)
+        self.assertEqual(model.n_factors, 2)
+        self.assertEqual(sorted(model.user_ids.tolist()), [1, 2, 3])
+        self.assertEqual(sorted(model.restaurant_ids.tolist()), [1, 2, 3, 4])
+
+
+class BatchRecommendationTests(TestCase):
+    """批量/预计算的推荐与逐用户实时计算的结果一致"""
+
+    def setUp(self):
+        cache.clear()
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        settings_override = override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for reset in (reset_mf_model, reset_rating_matrix):
+            reset()
+            self.addCleanup(reset)
+        rng = np.random.default_rng(2)
+        Restaurant.objects.bulk_create([
+            Restaurant(rest_id=i, name='nan' if i == 7 else f'餐厅{i}') for i in range(1, 31)
+        ])
+        Rating.objects.bulk_create([
+            Rating(
+                user_id=user_id, restaurant_id=rest_id, rating=int(rng.integers(1, 6)), rating_env=3,
+                rating_flavor=3, rating_service=3, timestamp=timezone.now()
+            )
+            for user_id in range(1, 26)
+            for rest_id in rng.choice(np.arange(1, 30), size=rng.integers(2, 8), replace=False).tolist()
+        ])
+        Restaurant.objects.refresh_rating_aggregates()
+        call_command('train_mf', '--factors', '4', '--iterations', '3', '--threads', '1', stdout=StringIO())
+        self.service = RecommenderService()
+        self.user_ids = list(range(1, 26))
+
+    def live(self, user_id, n, restaurant_id=None):
+        return [r.rest_id for r in self.service.mf_rec.recommend(
+            user_id=user_id, restaurant_id=restaurant_id, n_recommendations=n
+        )]
+
+    def test_batch_matches_per_user_recommendations(self):
+        popular = [r.rest_id for r in self.service.get_popular_restaurants(5)]
+        for workers in (1, 2):
+            results = list(self.service.get_batch_recommendations(
+                self.user_ids + [999], limit=5, chunk_size=7, workers=workers
+            ))
+            self.assertEqual([r['user_id'] for r in results], self.user_ids + [999])
+            for result in results[:-1]:
+                self.assertEqual(result['source'], 'mf')
+                self.assertEqual(result['restaurants'], self.live(result['user_id'], 5), result['user_id'])
+                self.assertEqual(result['scores'], sorted(result['scores'], reverse=True))
+            self.assertEqual(results[-1], {'user_id': 999, 'restaurants': popular, 'scores': None, 'source': 'popular'})
+
+    def test_materialized_recommendations_match_live(self):
+        with mock.patch('sys.stderr', new_callable=StringIO):
+            call_command('materialize_recommendations', '--limit', '6', '--workers', '1', '--chunk-size', '7',
+                         stdout=StringIO())
+        self.assertEqual(set(UserRecommendation.objects.values_list('user_id', flat=True)), set(self.user_ids))
+        for user_id in self.user_ids:
+            stored = self.service.get_stored_recommendations(user_id, limit=6)
+            self.assertEqual([r.rest_id for r in stored], self.live(user_id, 6), user_id)
+            # 页面读取时去掉当前餐厅，与实时计算时排除当前餐厅的结果相同
+            current = stored[0].rest_id
+            stored = self.service.get_stored_recommendations(user_id, current_restaurant_id=current, limit=4)
+            self.assertEqual([r.rest_id for r in stored], self.live(user_id, 4, restaurant_id=current), user_id)
+
+        # 用户新评分的餐厅不再出现在预计算的推荐中
+        rest_id = self.live(1, 1)[0]
+        rate(1, rest_id, 5)
+        stored = self.service.get_stored_recommendations(1, limit=5)
+        self.assertEqual([r.rest_id for r in stored], self.live(1, 5))
+        self.assertNotIn(rest_id, [r.rest_id for r in stored])
+
+
+class RecommenderCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 6)])
+
+    def test_querysets_are_evaluated_before_caching(self):
+        recommender_cache.get_or_set('test', [], lambda: Restaurant.objects.order_by('rest_id')[:3], 60)
+        with CaptureQueriesContext(connection) as queries:
+            cached = recommender_cache.get_or_set('test', [], lambda: None, 60)
+        self.assertIsInstance(cached, list)
+        self.assertEqual([r.rest_id for r in cached], [1, 2, 3])
+        self.assertEqual(len(queries), 0)
+
+    def test_single_flight_rebuild_on_miss(self):
+        rec_cache = RecommenderCache(wait_timeout=5)
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], {}
+
+        def slow_builder():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        def fetch(name):
+            results[name] = rec_cache.get_or_set('single', [], slow_builder, 60)
+
+        holder = threading.Thread(target=fetch, args=('holder',))
+        holder.start()
+        self.assertTrue(started.wait(5))
+        # 锁被占用时，后到的请求等待持锁者的结果而不是自己计算
+        waiter = threading.Thread(target=fetch, args=('waiter',))
+        waiter.start()
+        time.sleep(0.2)
+        release.set()
+        holder.join()
+        waiter.join()
+        self.assertEqual(results, {'holder': 'value', 'waiter': 'value'})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(rec_cache.stats()['single']['misses'], 2)
+
+        # 持锁者迟迟没有写入结果时，等待超时后自行计算
+        rec_cache = RecommenderCache(wait_timeout=0.1)
+        key = rec_cache.make_key('abandoned', [])
+        rec_cache.backend.add(rec_cache._lock_key(key), 1, 60)
+        self.assertEqual(rec_cache.get_or_set('abandoned', [], lambda: 'own', 60), 'own')
+
+    def test_expired_entries_are_served_stale_while_locked(self):
+        rec_cache = RecommenderCache(beta=0)
+        rec_cache.get_or_set('stale', [], lambda: 'old', 0)
+        key = rec_cache.make_key('stale', [])
+        rec_cache.backend.add(rec_cache._lock_key(key), 1, 60)
+        builder = mock.Mock(return_value='new')
+        self.assertEqual(rec_cache.get_or_set('stale', [], builder, 60), 'old')
+        builder.assert_not_called()
+        self.assertEqual(rec_cache.stats()['stale']['stale'], 1)
+
+        rec_cache.backend.delete(rec_cache._lock_key(key))
+        self.assertEqual(rec_cache.get_or_set('stale', [], builder, 60), 'new')
+        self.assertEqual(rec_cache.get_or_set('stale', [], builder, 60), 'new')
+        builder.assert_called_once()
+        self.assertIsNone(rec_cache.backend.get(rec_cache._lock_key(key)))
+
+    def test_xfetch_refreshes_slow_entries_early(self):
+        rec_cache = RecommenderCache()
+        key = rec_cache.make_key('xfetch', [])
+        for delta, draw, refreshed in ((30.0, 0.99, True), (30.0, 0.0, False), (0.001, 0.99, False)):
+            # 条目还有60秒才过期，上次计算耗时 delta 秒
+            rec_cache.backend.set(key, ('old', time.time() + 60, delta), 3600)
+            with mock.patch('recommender.cache.random.random', return_value=draw):
+                value = rec_cache.get_or_set('xfetch', [], lambda: 'new', 60)
+            self.assertEqual(value, 'new' if refreshed else 'old', (delta, draw))
+
+        rec_cache = RecommenderCache(beta=0)
+        rec_cache.backend.set(key, ('old', time.time() + 60, 30.0), 3600)
+        with mock.patch('recommender.cache.random.random', return_value=0.99):
+            self.assertEqual(rec_cache.get_or_set('xfetch', [], lambda: 'new', 60), 'old')
+
+    def test_rating_changes_bump_restaurant_and_user_but_not_homepage(self):
+        scopes = ['homepage', 'restaurant:1', 'restaurant:2', 'user:7']
+        before = recommender_cache.generations(scopes)
+        with self.captureOnCommitCallbacks(execute=True):
+            Rating.objects.create(
+                user_id=7, restaurant_id=1, rating=4, rating_env=4, rating_flavor=4, rating_service=4,
+                timestamp=timezone.now()
+            )
+        after = recommender_cache.generations(scopes)
+        self.assertEqual(after[0], before[0])
+        self.assertGreater(after[1], before[1])
+        self.assertEqual(after[2], before[2])
+        self.assertGreater(after[3], before[3])
+
+
+def rate(user_id, restaurant_id, score):
+    return Rating.objects.create(
+        user_id=user_id, restaurant_id=restaurant_id, rating=score, rating_env=score,
+        rating_flavor=score, rating_service=score, timestamp=timezone.now()
+    )
+
+
+def catalogue_rows(catalogue):
+    cards = catalogue.in_bulk(catalogue.rest_ids)
+    return [
+        (card.rest_id, card.name, card.avg_rating, card.avg_flavor_rating, card.avg_env_rating,
+         card.avg_service_rating, card.review_count)
+        for card in cards.values()
+    ]
+
+
+@override_settings(RECOMMENDER_CATALOGUE_REFRESH_INTERVAL=0)
+class CatalogueChangeLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_catalogue()
+        self.addCleanup(reset_catalogue)
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 21)])
+
+    def test_rating_changes_patch_only_changed_rows(self):
+        before = get_catalogue()
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(1, 3, 5)
+            rate(2, 3, 2)
+            rate(1, 7, 4)
+        with CaptureQueriesContext(connection) as queries:
+            after = get_catalogue()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('IN', queries[0]['sql'])
+        self.assertEqual(catalogue_rows(after), catalogue_rows(RestaurantCatalogue.from_queryset()))
+        # 旧目录不变，正在使用它的请求不受影响
+        self.assertEqual(before.get(3).review_count, 0)
+        self.assertEqual(after.get(3).review_count, 2)
+        self.assertEqual(after.get(3).avg_rating, 3.5)
+
+    def test_global_change_or_missing_log_reloads(self):
+        get_catalogue()
+        recommender_cache.invalidate_all()
+        with CaptureQueriesContext(connection) as queries:
+            get_catalogue()
+        self.assertNotIn('IN', queries[0]['sql'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(1, 3, 5)
+        # 变化记录已过期
+        generation = recommender_cache.generations(['ratings'])[0]
+        cache.delete(recommender_cache._changes_key('ratings', generation))
+        with CaptureQueriesContext(connection) as queries:
+            catalogue = get_catalogue()
+        self.assertNotIn('IN', queries[0]['sql'])
+        self.assertEqual(catalogue.get(3).review_count, 1)
+
+
+class ReplicaMaxAgeTests(TestCase):
+    """其他进程的变化记录没有送达时，进程内对象最迟在 RECOMMENDER_REPLICA_MAX_AGE 后重新加载"""
+
+    def setUp(self):
+        cache.clear()
+        for reset in (reset_catalogue, reset_leaderboards, reset_rating_matrix, reset_feature_matrix):
+            reset()
+            self.addCleanup(reset)
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        settings_override = override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 6)])
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(1, 1, 4)
+
+    def test_reload_after_max_age_without_change_log(self):
+        get_catalogue(), get_leaderboards(1), get_rating_matrix(), get_feature_matrix()
+        # 写入者的代数和变化记录没有送达本进程
+        with mock.patch('recommender.cache.transaction.on_commit'):
+            rate(2, 3, 5)
+        self.assertEqual(get_catalogue().get(3).review_count, 0)
+        self.assertNotIn(2, get_rating_matrix().user_index)
+
+        with override_settings(RECOMMENDER_REPLICA_MAX_AGE=0):
+            self.assertEqual(get_catalogue().get(3).review_count, 1)
+            self.assertEqual(get_leaderboards(1).top(1)['avg_rating'], [3])
+            self.assertIn(2, get_rating_matrix().user_index)
+            self.assertEqual(get_feature_matrix().restaurant_ids.tolist(), [1, 3])
+
+
+@override_settings(RECOMMENDER_LEADERBOARD_REFRESH_INTERVAL=0)
+class LeaderboardChangeLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_leaderboards()
+        self.addCleanup(reset_leaderboards)
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 11)])
+
+    def test_logged_changes_are_applied_in_place(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for rest_id in range(1, 6):
+                rate(rest_id, rest_id, rest_id)
+        leaderboards = get_leaderboards(1)
+        self.assertEqual(leaderboards.top(3)['avg_rating'], [5, 4, 3])
+
+        # 其他进程写入的评分只通过变化记录传播
+        with mock.patch('recommender.cache.transaction.on_commit'):
+            rate(9, 2, 5)
+            rate(9, 8, 5)
+            Rating.objects.get(restaurant_id=5).delete()
+        recommender_cache.log_changes('ratings', [2, 8, 5])
+        with CaptureQueriesContext(connection) as queries:
+            updated = get_leaderboards(1)
+        self.assertIs(updated, leaderboards)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(updated.top(10), RatingLeaderboards.from_queryset(1).top(10))
+        self.assertEqual(updated.top(3)['avg_rating'], [8, 4, 2])
+
+
+class RatingMatrixRefreshTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_rating_matrix()
+        self.addCleanup(reset_rating_matrix)
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 6)])
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(1, 1, 5)
+
+    def test_rebuilt_after_rating_changes(self):
+        matrix = get_rating_matrix()
+        self.assertEqual(matrix.nnz, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(2, 3, 4)
+        with override_settings(RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL=3600):
+            self.assertIs(get_rating_matrix(), matrix)
+        with override_settings(RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL=0):
+            matrix = get_rating_matrix()
+        self.assertEqual(matrix.nnz, 2)
+        self.assertIn(2, matrix.user_index)
+
+        recommender_cache.invalidate_all()
+        with override_settings(RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL=0):
+            self.assertIsNot(get_rating_matrix(), matrix)
+
+
+@override_settings(RECOMMENDER_FEATURE_MATRIX_REFRESH_INTERVAL=0)
+class FeatureMatrixRefreshTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        settings_override = override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_feature_matrix()
+        self.addCleanup(reset_feature_matrix)
+        Restaurant.objects.bulk_create([
+            Restaurant(rest_id=i, name='nan' if i == 4 else f'餐厅{i}') for i in range(1, 9)
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            for rest_id in (1, 2, 4, 6):
+                rate(1, rest_id, rest_id % 5 + 1)
+
+    def assert_matrix_equal(self, matrix, expected):
+        np.testing.assert_array_equal(matrix.restaurant_ids, expected.restaurant_ids)
+        np.testing.assert_allclose(matrix.features, expected.features)
+        np.testing.assert_allclose(matrix.norms, expected.norms)
+
+    def test_uses_valid_restaurants_and_applies_rating_changes(self):
+        valid = ContentBasedRecommender().filter_valid_restaurants(Restaurant.objects.all())
+        matrix = get_feature_matrix()
+        self.assertEqual(matrix.restaurant_ids.tolist(), sorted(valid.values_list('rest_id', flat=True)))
+        published = matrix.version
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rate(2, 3, 1)
+            rate(2, 6, 1)
+            Rating.objects.get(restaurant_id=2).delete()
+        updated = get_feature_matrix()
+        self.assertEqual(updated.version, published)
+        self.assert_matrix_equal(updated, RestaurantFeatureMatrix.from_queryset())
+        self.assertEqual(updated.restaurant_ids.tolist(), [1, 3, 6])
+        # 正在使用的旧矩阵不变
+        self.assertEqual(matrix.restaurant_ids.tolist(), [1, 2, 6])
+
+        version = publish_feature_matrix()
+        self.assertEqual(get_feature_matrix().version, version)
+
+
+class SharedCacheCheckTests(TestCase):
+    def test_warns_about_process_local_backend(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([w.id for w in check_shared_cache(None)], ['recommender.W001'])
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/1'
+        }}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class KeywordIndexTests(TestCase):
+    names = [
+        '老北京火锅', '重庆火锅城', '小火锅', '火车站烧烤', '锅包肉', 'BBQ Grill', 'bbq house',
+        'Café Été', 'CAFÉ ÉTÉ', 'Straße', '', 'nan', '春卷王', '冷面冰品', '火锅',
+    ]
+    keywords = ['火锅', '火', '锅包', '火锅城', 'bbq', 'BBQ', 'Bbq h', 'café', 'CAFÉ', 'été', 'ÉTÉ',
+                'STRASSE', 'straße', '春笋', '', 'nan']
+
+    def setUp(self):
+        Restaurant.objects.bulk_create([
+            Restaurant(rest_id=i, name=name, avg_rating=(i * 7) % 5, review_count=i)
+            for i, name in enumerate(self.names, start=1)
+        ])
+
+    def test_matches_icontains(self):
+        index = KeywordIndex.from_queryset()
+        for keyword in self.keywords:
+            expected = list(Restaurant.objects.filter(name__icontains=keyword).order_by('rest_id')
+                            .values_list('rest_id', flat=True))
+            self.assertEqual(index.search(keyword).tolist(), expected, keyword)
+
+    def test_search_any_matches_ored_icontains(self):
+        index = KeywordIndex.from_queryset()
+        keywords = ['火锅', '冰品', 'bbq']
+        query = Q()
+        for keyword in keywords:
+            query |= Q(name__icontains=keyword)
+        expected = list(Restaurant.objects.filter(query).order_by('rest_id').values_list('rest_id', flat=True))
+        self.assertEqual(index.search_any(keywords).tolist(), expected)
+
+    def test_top_restaurants_among_matches_single_query(self):
+        service = RecommenderService()
+        queryset = Restaurant.objects.exclude(name__iexact='nan')
+        rest_ids = KeywordIndex.from_queryset().search_any(['火', 'bbq', 'café']).tolist()
+        expected = list(queryset.filter(rest_id__in=rest_ids).order_by('-avg_rating', 'rest_id')[:4])
+        for max_in in (500, 2):
+            with CaptureQueriesContext(connection) as queries:
+                result = service.top_restaurants_among(rest_ids, queryset, '-avg_rating', 4, max_in=max_in)
+            self.assertEqual(result, expected)
+            self.assertEqual(len(queries), 1)
+
+
+class RestaurantSearchIndexTests(TransactionTestCase):
+    def setUp(self):
+        self.index = RestaurantSearchIndex()
+        if not self.index.available:
+            self.skipTest('数据库不支持 FTS5')
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'火锅{i}号店') for i in range(1, 21)])
+        self.index.update()
+
+    def test_full_rebuild_keeps_old_index_searchable(self):
+        totals = []
+        self.index.update(full=True, batch_size=5, progress=lambda done, total: totals.append(
+            self.index.search('火锅')[0]
+        ))
+        self.assertEqual(totals, [20, 20, 20, 20])
+        self.assertEqual(self.index.search('火锅')[0], 20)
+        self.assertEqual(self.index.search('7号')[1][0][0], 7)
+
+    def test_migration_skips_without_fts5(self):
+        migration = importlib.import_module('recommender.migrations.0005_restaurant_search')
+
+        class NoFTS5Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def execute(self, sql, params=None):
+                raise OperationalError('no such module: fts5')
+
+        schema_editor = mock.Mock()
+        schema_editor.connection.vendor = 'sqlite'
+        schema_editor.connection.alias = 'default'
+        schema_editor.connection.cursor = NoFTS5Cursor
+        migration.create_search_tables(None, schema_editor)
+        schema_editor.execute.assert_not_called()
+
+
+@override_settings(RECOMMENDER_CATALOGUE_REFRESH_INTERVAL=0, RECOMMENDER_LEADERBOARD_REFRESH_INTERVAL=0)
+class HomepageSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for reset in (reset_catalogue, reset_leaderboards, reset_keyword_index):
+            reset()
+            self.addCleanup(reset)
+        rng = np.random.default_rng(4)
+        perms = [rng.permutation(20) for _ in range(4)]
+        Restaurant.objects.bulk_create([
+            Restaurant(
+                rest_id=i, name='nan' if i == 5 else (f'火锅{i}' if i % 3 == 0 else f'川菜{i}'),
+                review_count=i, avg_rating=3.0 + perms[0][i - 1] / 10, avg_flavor_rating=3.0 + perms[1][i - 1] / 10,
+                avg_env_rating=3.0 + perms[2][i - 1] / 10, avg_service_rating=3.0 + perms[3][i - 1] / 10,
+            )
+            for i in range(1, 21)
+        ])
+
+    def legacy_sections(self, season_keywords):
+        """改写前 HomeView 逐板块查询的结果（rest_id）"""
+        valid = Restaurant.objects.exclude(name__iexact='nan')
+        season_query = Q()
+        for keyword in season_keywords:
+            season_query |= Q(name__icontains=keyword)
+        seasonal = list(valid.filter(season_query, review_count__gt=0, avg_rating__gte=4.0).order_by('-avg_rating')[:6])
+        if len(seasonal) < 6:
+            seasonal += list(valid.filter(review_count__gt=0, avg_rating__gte=4.5).exclude(
+                rest_id__in=[r.rest_id for r in seasonal]
+            ).order_by('-avg_rating')[:6 - len(seasonal)])
+        return {
+            'seasonal_restaurants': [r.rest_id for r in seasonal],
+            'popular_restaurants': list(valid.filter(review_count__gt=0).order_by(
+                '-review_count').values_list('rest_id', flat=True)[:6]),
+            'top_rated': {
+                name: list(valid.filter(**{f'{field}__gt': 0}).order_by(f'-{field}').values_list('rest_id', flat=True)[:6])
+                for name, field in HOMEPAGE_TOP_RATED
+            },
+        }
+
+    def sections(self, snapshot):
+        return {
+            'seasonal_restaurants': [r.rest_id for r in snapshot.seasonal_restaurants],
+            'popular_restaurants': [r.rest_id for r in snapshot.popular_restaurants],
+            'top_rated': {name: [r.rest_id for r in rows] for name, rows in snapshot.top_rated.items()},
+        }
+
+    def test_snapshot_matches_per_section_queries(self):
+        service = RecommenderService()
+        for month in (1, 4, 10):
+            snapshot = service.get_homepage_snapshot(month=month)
+            self.assertEqual(snapshot.season_keywords, SEASON_KEYWORDS[season_of_month(month)])
+            self.assertEqual(self.sections(snapshot), self.legacy_sections(snapshot.season_keywords), month)
+
+    def test_snapshot_is_cached_until_refreshed(self):
+        service = RecommenderService()
+        first = service.get_homepage_snapshot(month=10)
+        with self.assertNumQueries(0):
+            cached = service.get_homepage_snapshot(month=10)
+        self.assertEqual(self.sections(cached), self.sections(first))
+        self.assertEqual(cached.created_at, first.created_at)
+
+        # 单条评分变化不会使首页快照失效
+        with self.captureOnCommitCallbacks(execute=True):
+            Restaurant.objects.filter(pk=1).update(review_count=100)
+            rate(1, 1, 5)
+        self.assertEqual(self.sections(service.get_homepage_snapshot(month=10)), self.sections(first))
+
+        # refresh_homepage 重新计算并写入缓存，之后的请求读到新快照
+        with mock.patch('recommender.management.commands.refresh_homepage.datetime') as now:
+            now.now.return_value = datetime(2024, 10, 1)
+            call_command('refresh_homepage', stdout=StringIO())
+        refreshed = service.get_homepage_snapshot(month=10)
+        self.assertGreater(refreshed.created_at, first.created_at)
+        self.assertEqual(refreshed.popular_restaurants[0].rest_id, 1)
+        self.assertEqual(self.sections(refreshed), self.legacy_sections(refreshed.season_keywords))
+
+        # 离线任务使全部缓存失效后重新计算
+        recommender_cache.invalidate_all()
+        self.assertGreater(service.get_homepage_snapshot(month=10).created_at, refreshed.created_at)
+
+
+class RecommendationApiTests(TestCase):
+    def setUp(self):
+        Restaurant.objects.bulk_create([
+            Restaurant(rest_id=i, name=f'餐厅{i}', avg_rating=i % 5, review_count=i) for i in range(1, 11)
+        ])
+
+    def test_similar_api_queries_fallback_concurrently(self):
+        similar = Restaurant.objects.get(pk=3)
+        similar.similarity_score = 4.5
+        url = '/api/restaurant/1/similar/'
+        fallback_done = threading.Event()
+        original_alist = views._alist
+
+        async def alist_then_signal(queryset):
+            result = await original_alist(queryset)
+            fallback_done.set()
+            return result
+
+        def similar_waiting_for_fallback(*args, **kwargs):
+            # 兜底查询在模型查询返回之前完成，说明两者是同时进行的
+            self.assertTrue(fallback_done.wait(5))
+            return [similar]
+
+        with mock.patch.object(RecommenderService, 'get_similar_restaurants_fast', similar_waiting_for_fallback), \
+                mock.patch.object(views, '_alist', alist_then_signal):
+            data = self.client.get(url).json()
+        self.assertEqual(data['restaurants'][0]['rest_id'], 3)
+        self.assertEqual(data['restaurants'][0]['similarity_score'], 4.5)
+
+        with mock.patch.object(RecommenderService, 'get_similar_restaurants_fast', return_value=[]):
+            data = self.client.get(url).json()
+        self.assertEqual(
+            [r['rest_id'] for r in data['restaurants']],
+            list(views._fallback_restaurants(1).values_list('rest_id', flat=True))
+        )
+
+    def test_detail_page_caches_ids_and_plain_values(self):
+        cache.clear()
+        Rating.objects.create(
+            user_id=7, restaurant_id=2, rating=4, rating_env=3, rating_flavor=5, rating_service=2,
+            timestamp=timezone.now(), comment='好吃'
+        )
+        first = self.client.get('/restaurant/2/')
+        self.assertEqual(first.context['restaurant'].rest_id, 2)
+        self.assertEqual(first.context['ratings'][0]['comment'], '好吃')
+        for name in ('restaurant_card', 'restaurant_rating_rows'):
+            cached = cache.get(recommender_cache.make_key(name, ['restaurant:2'], 2))
+            self.assertIsNotNone(cached, name)
+            self.assertFalse(any(isinstance(item, (Restaurant, Rating)) for item in cached), name)
+        self.assertEqual(self.client.get('/restaurant/2/').content, first.content)
+        self.assertEqual(self.client.get('/restaurant/999/').status_code, 404)
+
+
+AGGREGATE_FIELDS = (
+    'review_count', 'rating_sum', 'flavor_rating_sum', 'env_rating_sum', 'service_rating_sum',
+    'avg_rating', 'avg_flavor_rating', 'avg_env_rating', 'avg_service_rating', 'popularity_score',
+)
+
+
+def legacy_collaborative(user_id, n_recommendations):
+    """改写前逐用户遍历字典的协同过滤，返回推荐的 rest_id 列表（未过滤无效餐厅）"""
+    matrix = {}
+    for rating in Rating.objects.all():
+        matrix.setdefault(rating.user_id, {})[rating.restaurant_id] = rating.rating
+    target = matrix[user_id]
+    similar_users = []
+    for other_user, other_ratings in matrix.items():
+        if other_user == user_id:
+            continue
+        common = set(target) & set(other_ratings)
+        if not common:
+            continue
+        vector1 = np.array([target[r] for r in common])
+        vector2 = np.array([other_ratings[r] for r in common])
+        similarity = np.dot(vector1, vector2) / (np.linalg.norm(vector1) * np.linalg.norm(vector2))
+        similar_users.append((other_user, similarity))
+    similar_users.sort(key=lambda x: x[1], reverse=True)
+    scores = {}
+    for other_user, similarity in similar_users[:10]:
+        for rest_id, rating in matrix[other_user].items():
+            if rest_id not in target:
+                scores.setdefault(rest_id, []).append(rating * similarity)
+    ranked = sorted(((r, np.mean(v)) for r, v in scores.items()), key=lambda x: x[1], reverse=True)
+    return [r for r, _ in ranked[:n_recommendations]]
+
+
+def aggregates():
+    return {r['rest_id']: r for r in Restaurant.objects.values('rest_id', *AGGREGATE_FIELDS)}
+
+
+class InlineExecutor:
+    """在调用线程中立即执行任务的执行器"""
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+def legacy_hybrid_scores(results, n_recommendations):
+    """改写前用字典逐条合并的混合推荐得分，返回 [(rest_id, 得分), ...]"""
+    weights = {'popularity': 0.3, 'content': 0.3, 'collaborative': 0.4}
+    restaurant_scores = {}
+    for name, recs in results.items():
+        for i, rest in enumerate(recs):
+            score = weights[name] * (1.0 - i/len(recs))
+            restaurant_scores[rest.rest_id] = restaurant_scores.get(rest.rest_id, 0) + score
+    return sorted(restaurant_scores.items(), key=lambda x: x[1], reverse=True)[:n_recommendations]
+
+
+class LegacyEquivalenceTests(TestCase):
+    """改写后的实现与原来逐条 ORM 实现的结果一致"""
+
+    def setUp(self):
+        cache.clear()
+        reset_rating_matrix()
+        self.addCleanup(reset_rating_matrix)
+        rng = np.random.default_rng(1)
+        Restaurant.objects.bulk_create([
+            Restaurant(rest_id=i, name='nan' if i == 7 else f'餐厅{i}') for i in range(1, 31)
+        ])
+        ratings = []
+        for user_id in range(1, 41):
+            for rest_id in rng.choice(np.arange(1, 31), size=rng.integers(1, 12), replace=False).tolist():
+                scores = rng.integers(1, 6, size=4).tolist()
+                ratings.append(Rating(
+                    user_id=user_id, restaurant_id=rest_id, rating=scores[0], rating_env=scores[1],
+                    rating_flavor=scores[2], rating_service=scores[3], timestamp=timezone.now()
+                ))
+        # bulk_create 不维护累计字段，由各测试自行统计
+        Rating.objects.bulk_create(ratings)
+
+    def test_rating_matrix_matches_per_user_loop(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        recommender = CollaborativeRecommender()
+        valid = set(recommender.filter_valid_restaurants(Restaurant.objects.all()).values_list('rest_id', flat=True))
+        for user_id in range(1, 41):
+            expected = legacy_collaborative(user_id, 8)
+            result = [r.rest_id for r in recommender.recommend(user_id=user_id, n_recommendations=8)]
+            self.assertEqual(result, [r for r in expected if r in valid], user_id)
+
+    def test_rating_matrix_rows_match_orm(self):
+        matrix = RatingMatrix.from_queryset()
+        for user_id, user_idx in matrix.user_index.items():
+            items, values = matrix.user_row(user_idx)
+            self.assertEqual(
+                list(zip(matrix.restaurant_ids[items].tolist(), values.tolist())),
+                list(Rating.objects.filter(user_id=user_id).order_by('id').values_list('restaurant_id', 'rating'))
+            )
+
+    def test_hybrid_fusion_matches_dict_merge(self):
+        rng = np.random.default_rng(6)
+        recommender = HybridRecommender()
+        for n in (1, 3, 5, 8):
+            # 来源之间大量重叠、同分，检验得分和同分时的顺序
+            results = {
+                name: [SimpleNamespace(rest_id=int(r)) for r in rng.choice(12, size=rng.integers(0, 7), replace=False)]
+                for name in HybridRecommender.weights
+            }
+            expected = legacy_hybrid_scores(results, n)
+            fused = recommender.fuse(results, n)
+            self.assertEqual([r.rest_id for r in fused], [rest_id for rest_id, _ in expected], results)
+            self.assertEqual([r.hybrid_score for r in fused], [score for _, score in expected])
+
+        Restaurant.objects.refresh_rating_aggregates()
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        reset_feature_matrix()
+        self.addCleanup(reset_feature_matrix)
+        # 测试事务中的数据对工作线程的数据库连接不可见，子推荐器改为在当前线程执行
+        with override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir), \
+                mock.patch('recommender.algorithms.base._get_executor', return_value=InlineExecutor()), \
+                mock.patch('recommender.algorithms.base.close_old_connections'):
+            for user_id, restaurant_id in ((3, 4), (5, None), (None, 9)):
+                results = {'popularity': list(recommender.popularity_rec.recommend(n_recommendations=6))}
+                if restaurant_id:
+                    results['content'] = list(recommender.content_rec.recommend(
+                        restaurant_id=restaurant_id, n_recommendations=6
+                    ))
+                if user_id:
+                    results['collaborative'] = list(recommender.collab_rec.recommend(user_id=user_id, n_recommendations=6))
+                self.assertTrue(all(results.values()))
+                self.assertEqual(
+                    [(r.rest_id, r.hybrid_score) for r in recommender.recommend(user_id, restaurant_id, 6)],
+                    legacy_hybrid_scores(results, 6)
+                )
+
+    def test_build_restaurant_links_matches_pairwise_cosine(self):
+        with mock.patch('sys.stderr', new_callable=StringIO):
+            call_command('build_restaurant_links', '--top-k', '4', '--min-common', '2', '--workers', '2',
+                         stdout=StringIO())
+        vectors = {}
+        for user_id, rest_id, score in Rating.objects.values_list('user_id', 'restaurant_id', 'rating'):
+            vectors.setdefault(rest_id, {})[user_id] = score
+        norms = {r: np.sqrt(sum(v * v for v in vector.values())) for r, vector in vectors.items()}
+        for source, vector in vectors.items():
+            candidates = []
+            for target, other in vectors.items():
+                common = set(vector) & set(other)
+                if target != source and len(common) >= 2:
+                    similarity = sum(vector[u] * other[u] for u in common) / (norms[source] * norms[target])
+                    candidates.append((-similarity, target))
+            expected = sorted(candidates)[:4]
+            links = list(RestaurantLink.objects.filter(source=source).order_by('-weight', 'target_id'))
+            self.assertEqual([link.target_id for link in links], [target for _, target in expected], source)
+            np.testing.assert_allclose([link.weight for link in links], [-score for score, _ in expected])
+
+    def test_similar_restaurants_read_links_before_live_computation(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir, ignore_errors=True)
+        reset_feature_matrix()
+        self.addCleanup(reset_feature_matrix)
+        RestaurantLink.objects.bulk_create([
+            RestaurantLink(source_id=1, target_id=target, weight=weight)
+            for target, weight in ((5, 0.2), (3, 0.9), (8, 0.5))
+        ])
+        service = RecommenderService()
+        with self.assertNumQueries(1):
+            similar = service.get_similar_restaurants(1, limit=2)
+        self.assertEqual([(r.rest_id, r.similarity_score) for r in similar], [(3, 0.9), (8, 0.5)])
+
+        with override_settings(RECOMMENDER_ARTIFACT_DIR=artifact_dir):
+            live = service.content_rec.recommend(restaurant_id=2, n_recommendations=3)
+            self.assertEqual(len(live), 3)
+            self.assertEqual(
+                [r.rest_id for r in service.get_similar_restaurants(2, limit=3)], [r.rest_id for r in live]
+            )
+
+    def test_refresh_rating_aggregates_matches_update_ratings(self):
+        Restaurant.objects.refresh_rating_aggregates(batch_size=7)
+        bulk = aggregates()
+        for restaurant in Restaurant.objects.all():
+            restaurant.update_ratings()
+        self.assertEqual(bulk, aggregates())
+        for rest_id, row in bulk.items():
+            self.assertEqual(row['popularity_score'] > 0, row['review_count'] > 0)
+            self.assertAlmostEqual(row['popularity_score'], popularity_score(row['rating_sum'], row['review_count']))
+
+    def test_adjust_ratings_matches_update_ratings(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        rng = np.random.default_rng(2)
+        ratings = list(Rating.objects.order_by('id'))
+        for rating in ratings[:40]:
+            # 修改评分、换餐厅或删除，都通过 adjust_ratings 增量维护
+            action = rng.integers(3)
+            if action == 0:
+                rating.rating = int(rng.integers(1, 6))
+                rating.rating_service = int(rng.integers(1, 6))
+                rating.save()
+            elif action == 1:
+                rated = set(Rating.objects.filter(user_id=rating.user_id).values_list('restaurant_id', flat=True))
+                rating.restaurant_id = int(rng.choice(sorted(set(range(1, 31)) - rated)))
+                rating.save()
+            else:
+                rating.delete()
+        rate(99, 30, 5)
+        incremental = aggregates()
+        for restaurant in Restaurant.objects.all():
+            restaurant.update_ratings()
+        recomputed = aggregates()
+        for rest_id in recomputed:
+            for field in AGGREGATE_FIELDS:
+                self.assertAlmostEqual(incremental[rest_id][field], recomputed[rest_id][field], msg=(rest_id, field))
+
+    def test_bulk_create_with_aggregates_invalidates_like_signals(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        scopes = ['user:98', 'user:99', 'restaurant:29', 'restaurant:30', 'restaurant:1', 'ratings']
+        before = recommender_cache.generations(scopes)
+        with self.captureOnCommitCallbacks(execute=True):
+            Rating.objects.bulk_create_with_aggregates([
+                Rating(user_id=user_id, restaurant_id=rest_id, rating=4, rating_env=3, rating_flavor=5,
+                       rating_service=2, timestamp=timezone.now())
+                for user_id in (98, 99) for rest_id in (29, 30)
+            ])
+        after = recommender_cache.generations(scopes)
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 1, 1, 1, 0, 1])
+        self.assertEqual(recommender_cache.changes_between('ratings', [0, before[-1]], [0, after[-1]]), {29, 30})
+
+        incremental = aggregates()
+        for restaurant in Restaurant.objects.filter(rest_id__in=[29, 30]):
+            restaurant.update_ratings()
+        self.assertEqual(incremental, aggregates())
+
+    def test_clean_ratings_matches_row_loop(self):
+        df = pd.DataFrame({
+            'userId': [1, 2, 3, 4, 5, 6],
+            'restId': [10, 11, 12, 13, 14, 15],
+            'rating': [4.0, np.nan, 3.7, 5.0, 2.0, 1.0],
+            'rating_env': [1.0, 2.0, 3.0, np.nan, 5.0, 4.0],
+            'rating_flavor': [2.0, 2.0, 2.0, 2.0, 2.0, 'x'],
+            'rating_service': [3.0, 3.0, 3.0, 3.0, 3.0, 3.0],
+            'timestamp': [1300000000123.0, 1300000001999.0, np.nan, 1.5e12, 1300000000000.5, 1.3e12],
+            'comment': ['好吃', np.nan, '一般', '', '不错', '差'],
+        }).fillna(RATING_DEFAULTS)
+
+        expected = []
+        for _, row in df.iterrows():
+            # 改写前的逐行处理
+            try:
+                expected.append((
+                    row['userId'], row['restId'],
+                    int(row['rating']), int(row['rating_env']), int(row['rating_flavor']), int(row['rating_service']),
+                    make_aware(datetime.fromtimestamp(row['timestamp'] / 1000)), str(row.get('comment', ''))
+                ))
+            except Exception:
+                continue
+
+        cleaned = ImportCommand(stdout=StringIO()).clean_ratings(df)
+        result = list(cleaned[[
+            'user_id', 'restaurant_id', 'rating', 'rating_env', 'rating_flavor', 'rating_service', 'timestamp', 'comment'
+        ]].itertuples(index=False, name=None))
+        self.assertEqual(result, expected)
+
+    def test_leaderboards_match_order_by_queries(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        for min_reviews in (1, 3):
+            top = RatingLeaderboards.from_queryset(min_reviews).top(6)
+            for field in RATING_FIELDS:
+                expected = list(Restaurant.objects.filter(
+                    review_count__gte=min_reviews, **{f'{field}__gt': 0}
+                ).exclude(name__iexact='nan').order_by(f'-{field}', 'rest_id').values_list('rest_id', flat=True)[:6])
+                self.assertEqual(top[field], expected, (min_reviews, field))
+
+    def test_leaderboard_updates_match_reload(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        leaderboards = RatingLeaderboards.from_queryset(3)
+        rng = np.random.default_rng(3)
+        for rating in Rating.objects.order_by('?')[:30]:
+            rest_id = rating.restaurant_id
+            if rng.integers(2):
+                rating.delete()
+            else:
+                rating.rating = int(rng.integers(1, 6))
+                rating.save()
+            leaderboards.update(*Restaurant.objects.values_list(
+                'rest_id', 'name', 'review_count', *RATING_FIELDS
+            ).get(pk=rest_id))
+        self.assertEqual(leaderboards.top(30), RatingLeaderboards.from_queryset(3).top(30))
+        self.assertEqual(len(leaderboards), len(RatingLeaderboards.from_queryset(3)))
+
+    def test_bounded_leaderboards_refill_after_updates(self):
+        Restaurant.objects.refresh_rating_aggregates()
+        leaderboards = RatingLeaderboards.from_queryset(1, size=3)
+        rng = np.random.default_rng(5)
+        # 榜首的餐厅分数下降或被删除后，榜外的餐厅要补上
+        for _ in range(40):
+            rest_id = leaderboards.top(1)['avg_rating'][0] if rng.integers(2) else int(
+                rng.choice(Restaurant.objects.values_list('rest_id', flat=True))
+            )
+            ratings = Rating.objects.filter(restaurant_id=rest_id)
+            if ratings.count() > 1 and rng.integers(2):
+                ratings.first().delete()
+            elif ratings.exists():
+                rating = ratings.first()
+                rating.rating = int(rng.integers(1, 6))
+                rating.save()
+            leaderboards.update(*Restaurant.objects.values_list(*LEADERBOARD_FIELDS).get(pk=rest_id))
+            self.assertEqual(leaderboards.top(3), RatingLeaderboards.from_queryset(1).top(3))
+        self.assertTrue(all(len(board) <= 3 for board in leaderboards._boards.values()))
+        with self.assertRaises(ValueError):
+            leaderboards.top(4)
+
+
+class PopularityScoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 5)])
+
+    def scores(self):
+        return dict(Restaurant.objects.values_list('rest_id', 'popularity_score'))
+
+    def test_scores_follow_rating_changes(self):
+        # 每条评分通过 adjust_ratings 增量维护：(3.0 * 10 + 评分和) / (10 + 评论数)
+        rate(1, 1, 5)
+        rate(2, 1, 4)
+        rate(1, 2, 1)
+        self.assertEqual(self.scores(), {1: 39 / 12, 2: 31 / 11, 3: 0.0, 4: 0.0})
+
+        rating = Rating.objects.get(user_id=1, restaurant_id=1)
+        rating.rating = 2
+        rating.save()
+        Rating.objects.get(user_id=1, restaurant_id=2).delete()
+        self.assertEqual(self.scores(), {1: 36 / 12, 2: 0.0, 3: 0.0, 4: 0.0})
+
+        # update_ratings 从评分表重新统计
+        Restaurant.objects.update(popularity_score=0)
+        for restaurant in Restaurant.objects.all():
+            restaurant.update_ratings()
+        self.assertEqual(self.scores(), {1: 36 / 12, 2: 0.0, 3: 0.0, 4: 0.0})
+
+    def test_refresh_popularity_applies_new_prior(self):
+        for user_id in range(1, 21):
+            rate(user_id, 1, 5)
+        rate(1, 2, 5)
+        rate(2, 2, 5)
+        for user_id in range(1, 9):
+            rate(user_id, 3, 4)
+        # 默认先验下，8条4分评论的餐厅排在只有两条满分评论的餐厅之前
+        ranking = [r.rest_id for r in PopularityRecommender().recommend(n_recommendations=4)]
+        self.assertEqual(ranking, [1, 3, 2])
+
+        generation = recommender_cache.generations(['global'])[0]
+        with override_settings(RECOMMENDER_POPULARITY_PRIOR_MEAN=4.5, RECOMMENDER_POPULARITY_PRIOR_COUNT=0):
+            call_command('refresh_popularity', stdout=StringIO())
+            expected = {
+                r.rest_id: popularity_score(r.rating_sum, r.review_count) for r in Restaurant.objects.all()
+            }
+        self.assertEqual(self.scores(), expected)
+        self.assertEqual(self.scores(), {1: 5.0, 2: 5.0, 3: 4.0, 4: 0.0})
+        ranking = [r.rest_id for r in PopularityRecommender().recommend(n_recommendations=4)]
+        self.assertEqual(ranking[-1], 3)
+        self.assertGreater(recommender_cache.generations(['global'])[0], generation)
+
+
+class CacheGenerationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Restaurant.objects.bulk_create([Restaurant(rest_id=i, name=f'餐厅{i}') for i in range(1, 4)])
+
+    def test_bump_changes_keys_and_rebuilds(self):
+        calls = []
+        build = lambda: calls.append(1) or len(calls)
+        self.assertEqual(recommender_cache.get_or_set('test', ['restaurant:1'], build, 60), 1)
+        self.assertEqual(recommender_cache.get_or_set('test', ['restaurant:1'], build, 60), 1)
+        recommender_cache.bump('restaurant:2')
+        self.assertEqual(recommender_cache.get_or_set('test', ['restaurant:1'], build, 60), 1)
+        recommender_cache.bump('restaurant:1')
+        self.assertEqual(recommender_cache.get_or_set('test', ['restaurant:1'], build, 60), 2)
+        recommender_cache.invalidate_all()
+        self.assertEqual(recommender_cache.get_or_set('test', ['restaurant:1'], build, 60), 3)
+
+    def test_rating_changes_bump_old_and_new_restaurant(self):
+        scopes = ['restaurant:1', 'restaurant:2', 'restaurant:3', 'user:5', 'ratings']
+        with self.captureOnCommitCallbacks(execute=True):
+            rating = rate(5, 1, 3)
+        before = recommender_cache.generations(scopes)
+        with self.captureOnCommitCallbacks(execute=True):
+            rating.restaurant_id = 2
+            rating.save()
+        after = recommender_cache.generations(scopes)
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 1, 0, 1, 1])
+        self.assertEqual(recommender_cache.changes_between('ratings', [0, before[4]], [0, after[4]]), {1, 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rating.delete()
+        final = recommender_cache.generations(scopes)
+        self.assertEqual([b - a for a, b in zip(after, final)], [0, 1, 0, 1, 1])
@@ -14,4 +14,6 @@ urlpatterns = [
     path('api/restaurant/<int:rest_id>/ratings/', views.restaurant_ratings_api, name='restaurant_ratings_api'),
     path('api/restaurant/<int:rest_id>/similar/', views.similar_restaurants_api, name='similar_restaurants_api'),
     path('api/restaurant/<int:rest_id>/recommendations/', views.restaurant_recommendations_api, name='recommendations_api'),
+    path('api/search/', views.search_api, name='search_api'),
+    path('api/cache/stats/', views.cache_stats_api, name='cache_stats_api'),
 ] 
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""管理命令共用的小工具"""
+from contextlib import contextmanager
+import time
+
+
+class Timer:
+    """记录各阶段耗时"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, label):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.timings[label] = elapsed
+        self.stdout.write(f'  {label}: {elapsed:.3f} 秒')
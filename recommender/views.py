@@ -1,10 +1,11 @@
 from django.shortcuts import render, get_object_or_404
+from django.db import close_old_connections
 from django.views.generic import ListView, DetailView
-from django.db.models import Avg, Count, Prefetch, Q
-from .models import Restaurant, RestaurantLink, Rating
+from django.db.models import Count
+from .models import Restaurant, Rating
 from .services import RecommenderService
-from django.core.cache import cache
-from django.conf import settings
+from .cache import recommender_cache
+from .hydration import hydrate_restaurants, pack_restaurants
 from django.http import Http404, JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth import login, logout
@@ -14,6 +15,8 @@ from django.contrib.auth.views import LoginView
 from django.urls import reverse_lazy
 from django.shortcuts import redirect
 from datetime import datetime
+from asgiref.sync import sync_to_async
+import asyncio
 
 def index(request):
     recommender = RestaurantRecommender()
@@ -73,96 +76,25 @@ class HomeView(ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # 获取当前季节
-        month = datetime.now().month
-        if month in [3, 4, 5]:
-            season = '春'
-            season_keywords = ['春笋', '春卷', '清淡', '养生']
-        elif month in [6, 7, 8]:
-            season = '夏'
-            season_keywords = ['冷面', '凉菜', '冰品', '烧烤']
-        elif month in [9, 10, 11]:
-            season = '秋'
-            season_keywords = ['螃蟹', '牛肉', '火锅', '秋葵']
-        else:
-            season = '冬'
-            season_keywords = ['火锅', '暖锅', '羊肉', '炖汤']
-
-        # 构建季节性查询条件
-        season_query = Q()
-        for keyword in season_keywords:
-            season_query |= Q(name__icontains=keyword)
-
-        # 获取季节推荐餐厅
-        seasonal_restaurants = Restaurant.objects.filter(
-            season_query,
-            review_count__gt=0,
-            avg_rating__gte=4.0  # 只推荐4分以上的餐厅
-        ).exclude(
-            name__iexact='nan'
-        ).order_by('-avg_rating')[:6]
-
-        # 如果季节性推荐不足6个，补充高评分餐厅
-        if seasonal_restaurants.count() < 6:
-            existing_ids = set(seasonal_restaurants.values_list('rest_id', flat=True))
-            additional_restaurants = Restaurant.objects.filter(
-                review_count__gt=0,
-                avg_rating__gte=4.5
-            ).exclude(
-                rest_id__in=existing_ids
-            ).exclude(
-                name__iexact='nan'
-            ).order_by('-avg_rating')[:6-seasonal_restaurants.count()]
-            
-            seasonal_restaurants = list(seasonal_restaurants) + list(additional_restaurants)
-
-        # 添加季节信息到上下文
-        context['current_season'] = season
-        context['seasonal_restaurants'] = seasonal_restaurants
-        context['season_keywords'] = season_keywords
-
-        # 原有的其他上下文数据保持不变
-        context['popular_restaurants'] = Restaurant.objects.filter(
-            review_count__gt=0
-        ).exclude(
-            name__iexact='nan'
-        ).order_by('-review_count')[:6]
-        
-        context['top_rated'] = {
-            '综合评分最高': Restaurant.objects.filter(
-                avg_rating__gt=0
-            ).exclude(
-                name__iexact='nan'
-            ).order_by('-avg_rating')[:6],
-            
-            '口味最佳': Restaurant.objects.filter(
-                avg_flavor_rating__gt=0
-            ).exclude(
-                name__iexact='nan'
-            ).order_by('-avg_flavor_rating')[:6],
-            
-            '环境优雅': Restaurant.objects.filter(
-                avg_env_rating__gt=0
-            ).exclude(
-                name__iexact='nan'
-            ).order_by('-avg_env_rating')[:6],
-            
-            '服务贴心': Restaurant.objects.filter(
-                avg_service_rating__gt=0
-            ).exclude(
-                name__iexact='nan'
-            ).order_by('-avg_service_rating')[:6]
-        }
+        # 季节推荐、热门餐厅和各维度评分榜来自整体缓存的首页快照，匿名访问不产生查询
+        service = RecommenderService()
+        snapshot = service.get_homepage_snapshot(month=datetime.now().month)
+        context.update(snapshot.as_context())
         
         if self.request.user.is_authenticated:
-            service = RecommenderService()
-            context['personalized_recommendations'] = service.get_personalized_recommendations_fast(
+            # 与详情页共用同一个按用户缓存的结果（多取的一家供详情页去掉当前餐厅）
+            context['personalized_recommendations'] = service.get_user_recommendations(
                 user_id=self.request.user.id,
-                limit=6
-            )
+                limit=7
+            )[:6]
         
         return context
 
+# 详情页展示的评价字段
+RATING_DISPLAY_FIELDS = (
+    'user_id', 'rating', 'rating_flavor', 'rating_env', 'rating_service', 'comment', 'timestamp'
+)
+
 class RestaurantDetailView(DetailView):
     model = Restaurant
     template_name = 'recommender/restaurant_detail.html'
@@ -171,71 +103,103 @@ class RestaurantDetailView(DetailView):
     
     def get_object(self, queryset=None):
         rest_id = self.kwargs.get(self.pk_url_kwarg)
-        # 尝试从缓存获取餐厅基本信息
-        cache_key = f'restaurant_basic_{rest_id}'
-        restaurant = cache.get(cache_key)
-        
-        if not restaurant:
-            restaurant = get_object_or_404(Restaurant, rest_id=rest_id)
-            # 缓存1小时
-            cache.set(cache_key, restaurant, 3600)
-        
-        return restaurant
+        # 餐厅基本信息：缓存中只保存餐厅ID（评分变化时随餐厅代数失效），从进程内目录还原
+        packed = recommender_cache.get_or_set(
+            'restaurant_card', [f'restaurant:{rest_id}'],
+            lambda: pack_restaurants([get_object_or_404(Restaurant, rest_id=rest_id)]),
+            3600, rest_id
+        )
+        restaurants = hydrate_restaurants(packed)
+        if not restaurants:
+            raise Http404('餐厅不存在')
+        return restaurants[0]
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         rest_id = self.object.rest_id
         
-        # 1. 获取最新评价（使用缓存）
-        cache_key = f'restaurant_ratings_{rest_id}'
-        ratings = cache.get(cache_key)
-        if ratings is None:
-            ratings = list(Rating.objects.filter(
+        # 1. 获取最新评价（缓存中只保存模板用到的字段）
+        context['ratings'] = recommender_cache.get_or_set(
+            'restaurant_rating_rows', [f'restaurant:{rest_id}'],
+            lambda: list(Rating.objects.filter(
                 restaurant_id=rest_id
-            ).select_related().order_by(
+            ).order_by(
                 '-timestamp'
-            )[:5])  # 只显示最新5条评价
-            cache.set(cache_key, ratings, 1800)  # 缓存30分钟
-        context['ratings'] = ratings
+            ).values(*RATING_DISPLAY_FIELDS)[:5]),  # 只显示最新5条评价
+            1800, rest_id
+        )
         
-        # 2. 获取相似餐厅（使用缓存）
-        cache_key = f'similar_restaurants_{rest_id}'
-        similar_restaurants = cache.get(cache_key)
-        if similar_restaurants is None:
-            service = RecommenderService()
-            similar_restaurants = service.get_similar_restaurants_fast(
+        # 2. 获取相似餐厅（缓存中只有餐厅ID和得分）
+        service = RecommenderService()
+        packed = {
+            'similar': service.get_similar_restaurants_fast.packed(
+                service,
                 restaurant_id=rest_id,
                 limit=4  # 减少推荐数量
             )
-            cache.set(cache_key, similar_restaurants, 3600)  # 缓存1小时
-        context['similar_restaurants'] = similar_restaurants
+        }
         
-        # 3. 获取个性化推荐（使用缓存）
+        # 3. 获取个性化推荐（按用户缓存，再去掉当前餐厅，不为每个 用户×餐厅 单独缓存）
         if self.request.user.is_authenticated:
-            user_id = self.request.user.id
-            cache_key = f'user_recommendations_{user_id}_{rest_id}'
-            recommended_restaurants = cache.get(cache_key)
-            if recommended_restaurants is None:
-                service = RecommenderService()
-                recommended_restaurants = service.get_personalized_recommendations_fast(
-                    user_id=user_id,
-                    current_restaurant_id=rest_id,
-                    limit=4  # 减少推荐数量
-                )
-                cache.set(cache_key, recommended_restaurants, 1800)  # 缓存30分钟
-            context['recommended_restaurants'] = recommended_restaurants
+            packed['recommended'] = service.get_user_recommendations.packed(
+                service, user_id=self.request.user.id, limit=7
+            )
+        
+        # 两部分的餐厅一次查询还原
+        restaurants = hydrate_restaurants(packed)
+        context['similar_restaurants'] = restaurants['similar']
+        if 'recommended' in restaurants:
+            context['recommended_restaurants'] = [
+                r for r in restaurants['recommended'] if r.rest_id != rest_id
+            ][:4]  # 减少推荐数量
         
         return context
 
+def _call_and_close(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # 工作线程有自己的数据库连接，按 CONN_MAX_AGE 及时关闭
+        close_old_connections()
+
+async def _in_thread(func, *args, **kwargs):
+    """在线程池中执行同步代码（NumPy 计算及其中的 ORM 查询），不阻塞事件循环
+
+    thread_sensitive=False：不占用异步 ORM 所在的共享线程，可以与异步查询同时进行。
+    结果需要在线程内求值（例如用 list() 包装查询集），不要在事件循环中触发查询。
+    """
+    return await sync_to_async(_call_and_close, thread_sensitive=False)(func, *args, **kwargs)
+
+async def _alist(queryset):
+    """用异步 ORM 取出查询集的全部结果"""
+    return [obj async for obj in queryset]
+
+def _restaurant_summary(restaurant):
+    return {
+        'rest_id': restaurant.rest_id,
+        'name': restaurant.name,
+        'avg_rating': restaurant.avg_rating
+    }
+
+def _fallback_restaurants(rest_id):
+    """评分最高的其他餐厅，作为推荐结果为空时的兜底"""
+    return Restaurant.objects.filter(
+        review_count__gt=0
+    ).exclude(
+        rest_id=rest_id
+    ).exclude(
+        name__iexact='nan'
+    ).only('rest_id', 'name', 'avg_rating').order_by('-avg_rating')[:6]
+
 @require_http_methods(["GET"])
-def restaurant_ratings_api(request, rest_id):
+async def restaurant_ratings_api(request, rest_id):
     try:
         # 限制查询数量并只选择需要的字段
-        ratings = Rating.objects.filter(restaurant_id=rest_id).only(
+        ratings = await _alist(Rating.objects.filter(restaurant_id=rest_id).only(
             'user_id', 'rating', 'rating_flavor', 
             'rating_env', 'rating_service', 
             'comment', 'timestamp'
-        ).order_by('-timestamp')[:10]  # 减少到10条评价
+        ).order_by('-timestamp')[:10])  # 减少到10条评价
         
         data = {
             'ratings': [{
@@ -253,46 +217,48 @@ def restaurant_ratings_api(request, rest_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 @require_http_methods(["GET"])
-def similar_restaurants_api(request, rest_id):
+async def similar_restaurants_api(request, rest_id):
     try:
-        # 简化相似餐厅的获取逻辑
-        restaurants = Restaurant.objects.filter(
-            review_count__gt=0
-        ).exclude(
-            rest_id=rest_id
-        ).exclude(
-            name__iexact='nan'
-        ).order_by('-avg_rating')[:6]  # 简单地获取评分最高的6家餐厅
-        
+        # 近似最近邻查询在线程中执行，兜底的评分榜同时查询
+        service = RecommenderService()
+        similar, fallback = await asyncio.gather(
+            _in_thread(lambda: list(service.get_similar_restaurants_fast(restaurant_id=rest_id, limit=6))),
+            _alist(_fallback_restaurants(rest_id))
+        )
         data = {
             'restaurants': [{
-                'rest_id': r.rest_id,
-                'name': r.name,
-                'avg_rating': r.avg_rating
-            } for r in restaurants]
+                **_restaurant_summary(r),
+                'similarity_score': getattr(r, 'similarity_score', None)
+            } for r in (similar or fallback)]
         }
         return JsonResponse(data)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 @require_http_methods(["GET"])
-def restaurant_recommendations_api(request, rest_id):
+async def restaurant_recommendations_api(request, rest_id):
     try:
-        # 简化推荐逻辑
-        restaurants = Restaurant.objects.filter(
-            review_count__gt=0
-        ).exclude(
-            rest_id=rest_id
-        ).exclude(
-            name__iexact='nan'
-        ).order_by('?')[:6]  # 随机获取6家餐厅
-        
+        user = await request.auser()
+        if user.is_authenticated:
+            # 与页面共用按用户缓存的个性化推荐（多取一家，去掉当前餐厅后仍有6家）
+            service = RecommenderService()
+            recommendations, fallback = await asyncio.gather(
+                _in_thread(lambda: list(service.get_user_recommendations(user_id=user.id, limit=7))),
+                _alist(_fallback_restaurants(rest_id))
+            )
+            restaurants = [r for r in recommendations if r.rest_id != rest_id][:6] or fallback
+        else:
+            # 未登录时随机获取6家餐厅
+            restaurants = await _alist(Restaurant.objects.filter(
+                review_count__gt=0
+            ).exclude(
+                rest_id=rest_id
+            ).exclude(
+                name__iexact='nan'
+            ).only('rest_id', 'name', 'avg_rating').order_by('?')[:6])
+
         data = {
-            'restaurants': [{
-                'rest_id': r.rest_id,
-                'name': r.name,
-                'avg_rating': r.avg_rating
-            } for r in restaurants]
+            'restaurants': [_restaurant_summary(r) for r in restaurants]
         }
         return JsonResponse(data)
     except Exception as e:
@@ -333,3 +299,41 @@ def logout_view(request):
     messages.success(request, '已成功退出登录')
     return redirect('recommender:home')
 
+@require_http_methods(["GET"])
+def search_api(request):
+    """按名称和评论搜索餐厅：?q=关键词&page=1&page_size=20"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', 20)), 1), 50)
+    except ValueError:
+        return JsonResponse({'error': 'page 和 page_size 必须是整数'}, status=400)
+    if not query:
+        return JsonResponse({'error': '缺少搜索关键词 q'}, status=400)
+
+    try:
+        service = RecommenderService()
+        result = service.search_restaurants(query, page=page, page_size=page_size)
+        data = {
+            'query': query,
+            'page': page,
+            'page_size': page_size,
+            'total': result['total'],
+            'restaurants': [{
+                'rest_id': r.rest_id,
+                'name': r.name,
+                'avg_rating': r.avg_rating,
+                'review_count': r.review_count,
+                'score': getattr(r, 'search_score', None)
+            } for r in result['restaurants']]
+        }
+        return JsonResponse(data)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+def cache_stats_api(request):
+    """当前进程内推荐缓存的命中/未命中统计（仅管理员可见）"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'forbidden'}, status=403)
+    return JsonResponse({'stats': recommender_cache.stats()})
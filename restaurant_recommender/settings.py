@@ -83,6 +83,26 @@ DATABASES = {
 }
 
 
+# 推荐缓存的代数、评分变化记录和缓存结果必须放在所有进程（Web 工作进程、管理命令）共享的
+# 缓存中，否则一个进程的失效和变化其他进程看不到。设置 RECOMMENDER_REDIS_URL
+# （例如 redis://127.0.0.1:6379/1，需要安装 redis）；未设置时退回进程内缓存，只适用于
+# 单进程的开发服务器，系统检查会给出警告（recommender.W001）
+RECOMMENDER_REDIS_URL = os.environ.get('RECOMMENDER_REDIS_URL')
+if RECOMMENDER_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': RECOMMENDER_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -132,3 +152,29 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # 媒体文件设置
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# 推荐模型等离线计算产物的保存目录
+RECOMMENDER_ARTIFACT_DIR = os.path.join(BASE_DIR, 'artifacts')
+
+# 进程内餐厅目录两次更新（应用评分变化或重新加载）之间的最短间隔（秒）
+RECOMMENDER_CATALOGUE_REFRESH_INTERVAL = 5
+
+# 进程内各维度排行榜两次更新（应用评分变化或重新加载）之间的最短间隔（秒）
+RECOMMENDER_LEADERBOARD_REFRESH_INTERVAL = 5
+
+# 每个评分维度排行榜保留的餐厅数（首页和分类榜单取的前N名不能超过它）
+RECOMMENDER_LEADERBOARD_SIZE = 50
+
+# 进程内的餐厅目录、排行榜、评分矩阵和特征矩阵最长多久（秒）完整重新加载一次，
+# 即使没有收到评分变化记录
+RECOMMENDER_REPLICA_MAX_AGE = 3600
+
+# 进程内用户-餐厅评分矩阵在评分变化后两次重新构建之间的最短间隔（秒）
+RECOMMENDER_RATING_MATRIX_REFRESH_INTERVAL = 60
+
+# 进程内餐厅特征矩阵两次应用评分变化之间的最短间隔（秒）
+RECOMMENDER_FEATURE_MATRIX_REFRESH_INTERVAL = 5
+
+# 热度得分（贝叶斯平均）的先验平均分和先验评论数；修改后需运行 refresh_popularity 重算
+RECOMMENDER_POPULARITY_PRIOR_MEAN = 3.0
+RECOMMENDER_POPULARITY_PRIOR_COUNT = 10